@@ -5,10 +5,8 @@ Copyright (c) 2018 University of Pennsylvania. All rights reserved.
 Use of this source code is governed by license located in license file: https://github.com/CBICA/BrainChart/blob/main/LICENSE
 """
 
-from PyQt5 import QtCore, QtGui, QtWidgets
 import argparse
 import os, sys
-from BrainChart.mainwindow import MainWindow
 
 
 def main():
@@ -23,6 +21,10 @@ def main():
     harmonization_model_file = args.harmonization_model_file
     SPARE_model_file = args.SPARE_model_file
 
+    # Qt is imported here so the processing modules can be used headless
+    from PyQt5 import QtWidgets
+    from BrainChart.mainwindow import MainWindow
+
     app = QtWidgets.QApplication(sys.argv)
     mw = MainWindow(dataFile=data_file,
                     harmonizationModelFile=harmonization_model_file,
@@ -0,0 +1,103 @@
+# This Python file uses the following encoding: utf-8
+"""
+contact: software@cbica.upenn.edu
+Copyright (c) 2018 University of Pennsylvania. All rights reserved.
+Use of this source code is governed by license located in license file: https://github.com/CBICA/BrainChart/blob/main/LICENSE
+"""
+
+import argparse
+import sys, time
+from BrainChart.dataio import DataIO
+from BrainChart.processes import Processes
+
+
+# Output formats of `SaveDataFile` and those `DoSPAREChunked` streams to
+OUTPUT_EXTENSIONS = ('.pkl.gz', '.pkl', '.pkl.zst', '.csv', '.csv.gz', '.parquet', '.feather')
+CHUNKED_EXTENSIONS = ('.csv', '.csv.gz', '.parquet')
+
+
+def main():
+    """Entry point of `nibax-batch`, runs harmonization and SPARE-* without
+    a display. Qt is never imported."""
+    parser = argparse.ArgumentParser(description='iSTAGING headless harmonization and SPARE-* computation')
+    parser.add_argument('--data_file', type=str, help='Data file containing data frame (.pkl.gz, .pkl, .pkl.zst, .csv, .parquet or .feather).', required=True)
+    parser.add_argument('--output_file', type=str, help='Output file for the data frame with the results (.pkl.gz, .pkl, .pkl.zst, .csv, .parquet or .feather).', required=True)
+    parser.add_argument('--harmonization_model_file', type=str, help='Harmonization model file or model bundle.', default=None, required=False)
+    parser.add_argument('--SPARE_model_file', type=str, help='Model file or model bundle for SPARE-scores.', default=None, required=False)
+    parser.add_argument('--save_harmonization_model_file', type=str, help='Save the harmonization model with the parameters of new sites to this file (model bundle for `.harmonization`).', default=None, required=False)
+    parser.add_argument('--chunksize', type=int, help='Number of rows processed at once.', default=10000, required=False)
+    parser.add_argument('--n_jobs', type=int, help='Number of worker processes for SPARE-* (-1 for all CPUs).', default=1, required=False)
+    parser.add_argument('--compact_dtypes', action='store_true', help='Keep ROIs as float32 and strings as categoricals in memory, the output has the original data types.')
+    parser.add_argument('--timing', action='store_true', help='Print the time of each step.')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.harmonization_model_file is None and args.SPARE_model_file is None:
+        parser.error('At least one of --harmonization_model_file and --SPARE_model_file is required.')
+    if not args.output_file.endswith(OUTPUT_EXTENSIONS):
+        parser.error('--output_file must end with one of ' + ', '.join(OUTPUT_EXTENSIONS) + '.')
+
+    dio = DataIO()
+    p = Processes()
+    timing = []
+    start = time.time()
+
+    def Step(name, t):
+        timing.append((name, time.time() - t))
+        return time.time()
+
+    if args.SPARE_model_file is not None:
+        BrainAgeModel, ADModel = dio.ReadSPAREModel(args.SPARE_model_file)
+        t = Step('Read SPARE-* model', start)
+    else:
+        t = start
+
+    if args.harmonization_model_file is None and args.output_file.endswith(CHUNKED_EXTENSIONS):
+        # SPARE-* only, stream the data through in chunks
+        n_rows, _ = p.DoSPAREChunked(args.data_file, args.output_file, ADModel, BrainAgeModel,
+                                     args.chunksize, args.n_jobs)
+        t = Step('SPARE-* (%d rows)' % (n_rows), t)
+    elif args.harmonization_model_file is None:
+        # SPARE-* only, the output format is written from the full frame
+        data = dio.ReadDataFile(args.data_file)
+        if args.compact_dtypes:
+            data = dio.OptimizeDataTypes(data)
+        t = Step('Read data (%d rows)' % (data.shape[0]), t)
+
+        data = p.DoSPARE(data, ADModel, BrainAgeModel, args.n_jobs)
+        t = Step('SPARE-*', t)
+
+        if args.compact_dtypes:
+            data = dio.RestoreDataTypes(data)
+        dio.SaveDataFile(data, args.output_file)
+        t = Step('Write data', t)
+    else:
+        model = dio.ReadHarmonizationModel(args.harmonization_model_file)
+        t = Step('Read harmonization model', t)
+        data = dio.ReadDataFile(args.data_file)
+        if args.compact_dtypes:
+            data = dio.OptimizeDataTypes(data)
+        t = Step('Read data (%d rows)' % (data.shape[0]), t)
+
+        data = p.DoHarmonization(data, model, args.chunksize)
+        t = Step('Harmonization', t)
+        if args.save_harmonization_model_file is not None:
+            dio.SaveHarmonizationModel(model, args.save_harmonization_model_file)
+
+        if args.SPARE_model_file is not None:
+            data = p.DoSPARE(data, ADModel, BrainAgeModel, args.n_jobs)
+            t = Step('SPARE-*', t)
+
+        if args.compact_dtypes:
+            data = dio.RestoreDataTypes(data)
+        dio.SaveDataFile(data, args.output_file)
+        t = Step('Write data', t)
+
+    if args.timing:
+        for name, seconds in timing:
+            print('%-40s %8.2f s' % (name, seconds))
+        print('%-40s %8.2f s' % ('Total', time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
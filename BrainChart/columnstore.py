@@ -0,0 +1,108 @@
+# This Python file uses the following encoding: utf-8
+"""
+contact: software@cbica.upenn.edu
+Copyright (c) 2018 University of Pennsylvania. All rights reserved.
+Use of this source code is governed by license located in license file: https://github.com/CBICA/BrainChart/blob/main/LICENSE
+"""
+
+import pandas as pd
+import threading
+from collections import OrderedDict
+from BrainChart.dataio import DataIO
+
+
+# Columns that are loaded when the store is opened and never evicted
+KEY_COLUMNS = ['participant_id', 'Age', 'Sex', 'SITE']
+
+
+class ColumnStore:
+    """Data frame in a Feather or Parquet file whose columns are loaded on
+    first access.
+
+    Only the schema and the key columns are read when the store is opened.
+    Other columns are cached and the least recently used ones are evicted
+    when the cache exceeds `memory_budget` bytes. Feather files are memory
+    mapped, so a column is only read from disk when it is accessed."""
+
+    def __init__(self, filename, memory_budget=1 << 30, key_columns=KEY_COLUMNS,
+                 dtype_tolerance=None):
+        """The constructor. With `dtype_tolerance` the columns get compact
+        data types when loaded, see `DataIO.OptimizeDataTypes`; `dtypes`
+        then holds the data types of loaded columns and the stored ones of
+        the others."""
+        self.filename = filename
+        self.memory_budget = memory_budget
+        self.dtype_tolerance = dtype_tolerance
+        self.dio = DataIO()
+        self.lock = threading.Lock()
+
+        schema = self.dio.GetSchema(filename)
+        self.columns = pd.Index(self.dio.GetColumnNames(filename))
+        # Data types as pandas would create them, without reading any data
+        self.dtypes = schema.empty_table().to_pandas().dtypes[self.columns].copy()
+
+        self.key_columns = [c for c in key_columns if c in self.columns]
+        self.keys = self.Read(self.key_columns)
+        self.index = self.keys.index
+        self.cache = OrderedDict()
+        self.nbytes = 0
+
+
+    def GetShape(self):
+        """Returns the shape of the full data frame."""
+        return (len(self.index), len(self.columns))
+
+
+    def GetColumns(self, columns):
+        """Returns the selected columns as data frame, loading the ones that
+        are not cached with one read."""
+        columns = list(columns)
+        with self.lock:
+            missing = [c for c in dict.fromkeys(columns)
+                       if c not in self.key_columns and c not in self.cache]
+            if missing:
+                d = self.Read(missing)
+                for c in missing:
+                    s = pd.Series(d[c].values, index=self.index, name=c)
+                    self.cache[c] = s
+                    self.nbytes += s.memory_usage(index=False, deep=True)
+
+            for c in columns:
+                if c in self.cache:
+                    self.cache.move_to_end(c)
+            result = pd.DataFrame({c: self.keys[c] if c in self.key_columns else self.cache[c]
+                                   for c in dict.fromkeys(columns)},
+                                  index=self.index)
+            self.Evict(columns)
+
+        return result[columns]
+
+
+    def Read(self, columns=None):
+        """Reads `columns` from the file."""
+        d = self.dio.ReadColumnarFile(self.filename, columns)
+        if self.dtype_tolerance is not None:
+            d = self.dio.OptimizeDataTypes(d, self.dtype_tolerance, report=False)
+            for c in d.columns:
+                self.dtypes[c] = d[c].dtype
+        return d
+
+
+    def Evict(self, keep=()):
+        """Drops least recently used columns until the cache fits into the
+        memory budget. Columns in `keep` stay."""
+        for c in list(self.cache):
+            if self.nbytes <= self.memory_budget:
+                break
+            if c in keep:
+                continue
+            s = self.cache.pop(c)
+            self.nbytes -= s.memory_usage(index=False, deep=True)
+
+
+    def Materialize(self):
+        """Returns the full data frame."""
+        d = self.dio.ReadColumnarFile(self.filename)
+        if self.dtype_tolerance is not None:
+            d = self.dio.OptimizeDataTypes(d, self.dtype_tolerance)
+        return d
@@ -6,8 +6,22 @@ Use of this source code is governed by license located in license file: https://
 """
 
 import pandas as pd
+import numpy as np
 import joblib
-import os, sys
+import io, os, sys, time
+import hashlib, json, struct, zlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Extensions of (compressed) pickle files
+PICKLE_EXTENSIONS = ('.pkl', '.pkl.gz', '.pkl.zst')
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Schema metadata of columnar copies with the stamp of their source
+SOURCE_METADATA_KEY = b'brainchart_source'
+
 
 class DataIO:
     def __init__(self):
@@ -15,12 +29,325 @@ class DataIO:
 
 
     def ReadPickleFile(self,filename):
-        data = pd.read_pickle(filename)
+        """Reads a pickle file, uncompressed or compressed with gzip or zstd.
+        The compression is detected from the file content, so single-stream
+        gzip files work as well as blocked gzip files (see
+        `BlockedGzipWriter`), which are decompressed with several threads."""
+        start = time.time()
+        with open(filename, 'rb') as f:
+            magic = f.read(4)
+            f.seek(0)
+            if magic.startswith(GZIP_MAGIC) and BlockedGzipReader.IsBlocked(f):
+                stream = io.BufferedReader(BlockedGzipReader(f), buffer_size=1 << 24)
+            elif magic.startswith(GZIP_MAGIC):
+                import gzip
+                stream = io.BufferedReader(gzip.GzipFile(fileobj=f), buffer_size=1 << 24)
+            elif magic == ZSTD_MAGIC:
+                import zstandard
+                stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f, closefd=False),
+                                           buffer_size=1 << 24)
+            else:
+                stream = None
+            if stream is None:
+                data = pd.read_pickle(f, compression=None)
+            else:
+                # Closing the stream stops the decompression threads
+                with stream:
+                    data = pd.read_pickle(stream, compression=None)
+        self.ReportThroughput('Read', filename, time.time() - start)
         return data
 
 
     def SavePickleFile(self,data,filename):
-        data.to_pickle(filename)
+        """Saves a pickle file, compressed with multi-threaded blocked gzip
+        for `.gz` and multi-threaded zstd for `.zst`."""
+        start = time.time()
+        with open(filename, 'wb') as f:
+            if filename.endswith('.gz'):
+                stream = BlockedGzipWriter(f)
+            elif filename.endswith('.zst'):
+                import zstandard
+                stream = zstandard.ZstdCompressor(level=3, threads=-1).stream_writer(f, closefd=False)
+            else:
+                stream = None
+            if stream is None:
+                pd.to_pickle(data, f, compression=None)
+            else:
+                with stream:
+                    pd.to_pickle(data, stream, compression=None)
+        self.ReportThroughput('Saved', filename, time.time() - start)
+
+
+    def OptimizeDataTypes(self, data, tolerance=1e-3, max_unique=0.5, exclude=(), report=True):
+        """Returns `data` with compact data types. float64 columns become
+        float32 if no value changes by more than `tolerance` (absolute, in
+        the unit of the column), e.g. volumes in mm3 and ages but not ICVs
+        of about 1.5e6 with the default. String columns with at most
+        `max_unique` unique values per row become categoricals. Columns in
+        `exclude` are kept. `RestoreDataTypes` undoes the conversion."""
+        dtypes = {}
+        for c in data.columns:
+            if c in exclude:
+                continue
+            column = data[c]
+            if column.dtype == np.float64:
+                x = column.to_numpy()
+                with np.errstate(over='ignore', invalid='ignore'):
+                    y = x.astype(np.float32).astype(np.float64)
+                    ok = (np.abs(y - x) <= tolerance) | (y == x) | np.isnan(x)
+                if ok.all():
+                    dtypes[c] = np.float32
+            elif (column.dtype == object and
+                  pd.api.types.infer_dtype(column, skipna=True) == 'string' and
+                  column.nunique() <= max_unique * max(len(column), 1)):
+                dtypes[c] = 'category'
+        before = data.memory_usage(deep=True).sum() if report else 0
+        data = data.astype(dtypes)
+
+        if report:
+            after = data.memory_usage(deep=True).sum()
+            n_float = sum(1 for t in dtypes.values() if t is np.float32)
+            print('Optimized data types: %.1f MB -> %.1f MB (%d float32, %d categorical columns)'
+                  % (before / 2**20, after / 2**20, n_float, len(dtypes) - n_float))
+        return data
+
+
+    def RestoreFloat64(self, data, columns=None):
+        """Returns `data` with the float32 `columns` (all by default) as
+        float64, e.g. for numerics that need double precision."""
+        if columns is None:
+            columns = data.columns
+        dtypes = {c: np.float64 for c in columns if data[c].dtype == np.float32}
+        return data.astype(dtypes)
+
+
+    def RestoreDataTypes(self, data):
+        """Returns `data` with the data types `OptimizeDataTypes` replaced,
+        float64 for float32 and object for categorical string columns, e.g.
+        before the data is saved."""
+        data = self.RestoreFloat64(data)
+        dtypes = {c: object for c in data.columns
+                  if data[c].dtype.name == 'category' and
+                  pd.api.types.infer_dtype(data[c].cat.categories, skipna=True) == 'string'}
+        return data.astype(dtypes)
+
+
+    def ReportThroughput(self, action, filename, seconds):
+        """Prints the size of `filename` and the throughput in MB/s."""
+        mb = os.path.getsize(filename) / 2**20
+        print('%s %s: %.0f MB in %.1f s (%.0f MB/s)' % (action, filename, mb, seconds,
+                                                      mb / max(seconds, 1e-9)))
+
+
+    def ReadDataFile(self, filename, columns=None):
+        """Reads a data frame from a pickle, CSV, Parquet or Feather file.
+        `columns` selects a subset of columns, which is only read from disk
+        for the columnar formats. A pickle file is read from its columnar
+        copy (see `ConvertToColumnar`) if that is up to date."""
+        if filename.endswith(('.csv', '.csv.gz')):
+            return pd.read_csv(filename, usecols=columns)
+        elif filename.endswith(('.parquet', '.feather')):
+            return self.ReadColumnarFile(filename, columns)
+
+        if self.HasColumnarCopy(filename):
+            return self.ReadColumnarFile(self.GetColumnarFileName(filename), columns)
+        data = self.ReadPickleFile(filename)
+        if columns is not None:
+            data = data[columns]
+        return data
+
+
+    def SaveDataFile(self, data, filename):
+        """Saves a data frame to a pickle, CSV, Parquet or Feather file."""
+        if filename.endswith(('.csv', '.csv.gz')):
+            data.to_csv(filename, index=False)
+        elif filename.endswith(('.parquet', '.feather')):
+            self.SaveColumnarFile(data, filename)
+        else:
+            self.SavePickleFile(data, filename)
+
+
+    def ReadColumnarFile(self, filename, columns=None, memory_map=True):
+        """Reads the `columns` (all by default) of a Parquet or Feather file.
+        With `memory_map` the file is mapped instead of read; for
+        uncompressed Feather files the columns are then not copied until
+        they are converted to pandas."""
+        import pyarrow.feather as feather
+        import pyarrow.parquet as pq
+        if filename.endswith('.feather'):
+            read = columns
+            if columns is not None:
+                # Stored index columns are not added automatically
+                read = list(columns) + [c for c in self.GetIndexColumnNames(filename)
+                                        if c not in columns]
+            table = feather.read_table(filename, columns=read, memory_map=memory_map)
+        else:
+            table = pq.read_table(filename, columns=columns, memory_map=memory_map)
+        data = table.to_pandas()
+        if columns is not None:
+            # Columns in the requested order
+            data = data[list(columns)]
+        return data
+
+
+    def SaveColumnarFile(self, data, filename, source=None):
+        """Saves a data frame to a Parquet or (uncompressed, so it can be
+        memory-mapped) Feather file. `source` is the stamp (see
+        `GetFileStamp`) of the file the data was read from, it is kept in the
+        schema metadata."""
+        import pyarrow as pa
+        import pyarrow.feather as feather
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(data)
+        if source is not None:
+            metadata = dict(table.schema.metadata or {})
+            metadata[SOURCE_METADATA_KEY] = json.dumps(source).encode()
+            table = table.replace_schema_metadata(metadata)
+        if filename.endswith('.feather'):
+            feather.write_feather(table, filename, compression='uncompressed')
+        else:
+            pq.write_table(table, filename)
+
+
+    def GetSchema(self, filename):
+        """Returns the Arrow schema of a Parquet or Feather file."""
+        import pyarrow.dataset as ds
+        return ds.dataset(filename, format='feather' if filename.endswith('.feather') else 'parquet').schema
+
+
+    def GetIndexColumnNames(self, filename):
+        """Returns the columns of a Parquet or Feather file that store the
+        index of the data frame."""
+        metadata = self.GetSchema(filename).pandas_metadata
+        if not metadata:
+            return []
+        return [c for c in metadata.get('index_columns', []) if isinstance(c, str)]
+
+
+    def GetColumnNames(self, filename):
+        """Returns the column names of a Parquet or Feather file without
+        reading any data."""
+        index = self.GetIndexColumnNames(filename)
+        return [c for c in self.GetSchema(filename).names if c not in index]
+
+
+    def GetColumnarFileName(self, filename):
+        """Returns the name of the columnar copy of a pickle file."""
+        for ext in PICKLE_EXTENSIONS:
+            if filename.endswith(ext):
+                return filename[:-len(ext)] + '.feather'
+        return filename + '.feather'
+
+
+    def GetFileStamp(self, filename):
+        """Returns size and modification time (ns) of `filename`. Converted
+        copies record the stamp of their source, so any change of the source
+        makes them stale, also if the copy is newer."""
+        stat = os.stat(filename)
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+    def HasColumnarCopy(self, filename):
+        """Checks if the pickle file `filename` has an up to date columnar
+        copy, i.e. one that recorded the current stamp of the file."""
+        import pyarrow as pa
+        columnar = self.GetColumnarFileName(filename)
+        if not os.path.exists(columnar):
+            return False
+        try:
+            source = (self.GetSchema(columnar).metadata or {}).get(SOURCE_METADATA_KEY)
+        except (pa.ArrowException, OSError):
+            return False
+        return source is not None and json.loads(source) == self.GetFileStamp(filename)
+
+
+    def ConvertToColumnar(self, filename, data=None, source=None):
+        """Writes the columnar copy of the pickle file `filename`, from `data`
+        if it was read already. `source` is the stamp of the file when `data`
+        was read (see `GetFileStamp`). Returns the name of the copy or None
+        if the data can not be stored in columnar form."""
+        import pyarrow as pa
+        if source is None:
+            source = self.GetFileStamp(filename)
+        if data is None:
+            data = self.ReadPickleFile(filename)
+        columnar = self.GetColumnarFileName(filename)
+        try:
+            self.SaveColumnarFile(data, columnar, source)
+        except (pa.ArrowException, OSError) as e:
+            print('Could not convert `' + filename + '` to columnar format: ' + str(e))
+            if os.path.exists(columnar):
+                os.remove(columnar)
+            return None
+        return columnar
+
+
+    def ReadHarmonizationModel(self, filename, verify=True):
+        """Reads a harmonization model from a pickle file or from a model
+        bundle (directory or its `manifest.json`, see
+        `BrainChart.harmonization.SaveHarmonizationBundle`). A pickle file is
+        read from its bundle if that is up to date."""
+        from BrainChart.harmonization import ReadHarmonizationBundle
+        if self.IsArrayBundle(filename):
+            return ReadHarmonizationBundle(filename, verify=verify)
+        if self.HasBundle(filename, '.harmonization'):
+            return ReadHarmonizationBundle(self.GetBundleName(filename, '.harmonization'),
+                                           verify=verify)
+        return self.ReadPickleFile(filename)
+
+
+    def SaveHarmonizationModel(self, model, filename, source=None):
+        """Saves a harmonization model including the parameters of new sites,
+        as model bundle if `filename` ends with `.harmonization` and as
+        pickle file otherwise. `source` is the stamp of the model file a
+        bundle is converted from (see `GetFileStamp`)."""
+        if filename.endswith('.harmonization'):
+            from BrainChart.harmonization import SaveHarmonizationBundle
+            SaveHarmonizationBundle(model, filename, source)
+        else:
+            pd.to_pickle(model, filename)
+
+
+    def ConvertHarmonizationModel(self, filename, model=None, source=None):
+        """Writes the bundle of the harmonization model file `filename`, from
+        `model` if it was read already. `source` is the stamp of the file
+        when `model` was read (see `GetFileStamp`). Returns the name of the
+        bundle or None if the model can not be stored as bundle."""
+        if source is None:
+            source = self.GetFileStamp(filename)
+        if model is None:
+            model = self.ReadHarmonizationModel(filename)
+        bundle = self.GetBundleName(filename, '.harmonization')
+        try:
+            self.SaveHarmonizationModel(model, bundle, source)
+        except (KeyError, ValueError, OSError) as e:
+            print('Could not convert `' + filename + '` to a model bundle: ' + str(e))
+            return None
+        return bundle
+
+
+    def ReadDataChunks(self, filename, chunksize, columns=None):
+        """Yields the data in `filename` as data frames of at most `chunksize`
+        rows. CSV and Parquet files are read incrementally. Pickle files can
+        not be read partially, so they are loaded once and then sliced."""
+        if filename.endswith(('.csv', '.csv.gz')):
+            for chunk in pd.read_csv(filename, chunksize=chunksize, usecols=columns):
+                yield chunk
+        elif filename.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            parquet_file = pq.ParquetFile(filename)
+            for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+                yield batch.to_pandas()
+        elif filename.endswith('.feather'):
+            data = self.ReadColumnarFile(filename, columns)
+            for start in range(0, data.shape[0], chunksize):
+                yield data.iloc[start:(start+chunksize)].copy()
+        else:
+            data = self.ReadPickleFile(filename)
+            if columns is not None:
+                data = data[columns]
+            for start in range(0, data.shape[0], chunksize):
+                yield data.iloc[start:(start+chunksize)].copy()
 
     def ReadMUSEDictionary(salf):
         # Load MUSE dictionary file
@@ -36,8 +363,322 @@ class DataIO:
         return MUSEDictNAMEtoID, MUSEDictIDtoNAME
 
         
-    def ReadSPAREModel(self, filename):
+    def ReadSPAREModel(self, filename, verify=True):
+        """Reads the SPARE-BA and SPARE-AD models from a model file or from a
+        model bundle (directory or its `manifest.json`, see
+        `BrainChart.spare.SaveSPAREBundle`). A model file is read from its
+        bundle if that is up to date."""
+        from BrainChart.spare import ReadSPAREBundle
+        if self.IsArrayBundle(filename):
+            return ReadSPAREBundle(filename, verify=verify)
+        if self.HasSPAREBundle(filename):
+            return ReadSPAREBundle(self.GetSPAREBundleName(filename), verify=verify)
+
         with open(filename, "rb") as file:
             BrainAgeModel, ADModel = joblib.load(filename)
         
         return BrainAgeModel, ADModel
+
+
+    def SaveSPAREModel(self, BrainAgeModel, ADModel, filename, source=None):
+        """Saves the SPARE-* models to a model bundle directory. `source` is
+        the stamp of the model file they are converted from (see
+        `GetFileStamp`)."""
+        from BrainChart.spare import SaveSPAREBundle
+        SaveSPAREBundle(BrainAgeModel, ADModel, filename, source)
+
+
+    def GetSPAREBundleName(self, filename):
+        """Returns the name of the bundle of a SPARE-* model file."""
+        return self.GetBundleName(filename, '.spare')
+
+
+    def HasSPAREBundle(self, filename):
+        """Checks if the SPARE-* model file `filename` has an up to date
+        bundle."""
+        return self.HasBundle(filename, '.spare')
+
+
+    def GetBundleName(self, filename, extension):
+        """Returns the name of the bundle of a model file, i.e. the file name
+        with `extension` instead of the pickle extension."""
+        for ext in PICKLE_EXTENSIONS:
+            if filename.endswith(ext):
+                return filename[:-len(ext)] + extension
+        return filename + extension
+
+
+    def HasBundle(self, filename, extension):
+        """Checks if the model file `filename` has an up to date bundle, i.e.
+        one whose manifest recorded the current stamp of the file."""
+        manifest = os.path.join(self.GetBundleName(filename, extension), 'manifest.json')
+        if not os.path.exists(manifest):
+            return False
+        try:
+            with open(manifest) as f:
+                source = json.load(f).get('source')
+        except (ValueError, OSError):
+            return False
+        return source is not None and source == self.GetFileStamp(filename)
+
+
+    def ConvertSPAREModel(self, filename, models=None, source=None):
+        """Writes the bundle of the SPARE-* model file `filename`, from
+        `models` (SPARE-BA and SPARE-AD model) if they were read already.
+        `source` is the stamp of the file when `models` were read (see
+        `GetFileStamp`). Returns the name of the bundle or None if the models
+        can not be stored as bundle."""
+        if source is None:
+            source = self.GetFileStamp(filename)
+        if models is None:
+            models = self.ReadSPAREModel(filename)
+        bundle = self.GetSPAREBundleName(filename)
+        try:
+            self.SaveSPAREModel(models[0], models[1], bundle, source)
+        except (ValueError, OSError) as e:
+            print('Could not convert `' + filename + '` to a model bundle: ' + str(e))
+            return None
+        return bundle
+
+
+    def IsArrayBundle(self, filename):
+        """Checks if `filename` is an array bundle directory or its manifest."""
+        if os.path.basename(filename) == 'manifest.json':
+            return True
+        return os.path.isfile(os.path.join(filename, 'manifest.json'))
+
+
+    def SaveArrayBundle(self, dirname, arrays, metadata, kind, source=None):
+        """Saves `arrays` (name -> array) as `.npy` files in the directory
+        `dirname` that can be memory-mapped. The manifest `manifest.json`
+        holds the format `kind`, the JSON `metadata`, the stamp `source` of
+        the file the bundle was converted from (see `GetFileStamp`) and the
+        data type, shape and SHA-256 of every array. It is written last, so
+        an interrupted save does not leave a valid bundle."""
+        os.makedirs(dirname, exist_ok=True)
+        manifest_file = os.path.join(dirname, 'manifest.json')
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+
+        entries = {}
+        for name, a in arrays.items():
+            a = np.ascontiguousarray(a)
+            if a.dtype.hasobject:
+                raise ValueError('Array `' + name + '` holds Python objects and can not be memory-mapped.')
+            path = os.path.join(dirname, name + '.npy')
+            np.save(path, a, allow_pickle=False)
+            entries[name] = {'file': name + '.npy', 'dtype': a.dtype.str,
+                             'shape': list(a.shape), 'sha256': self.HashFile(path)}
+
+        manifest = {'format': kind, 'version': 1, 'metadata': metadata, 'arrays': entries}
+        if source is not None:
+            manifest['source'] = source
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(manifest_file + '.tmp', manifest_file)
+
+
+    def ReadArrayBundle(self, dirname, kind=None, mmap_mode='r', verify=True):
+        """Returns the arrays (memory-mapped with `mmap_mode`) and the
+        metadata of an array bundle. Data type and shape of every array are
+        checked against the manifest, with `verify` also the checksums."""
+        if os.path.basename(dirname) == 'manifest.json':
+            dirname = os.path.dirname(dirname)
+        with open(os.path.join(dirname, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if kind is not None and manifest.get('format') != kind:
+            raise ValueError('`%s` is not a %s bundle.' % (dirname, kind))
+
+        arrays = {}
+        for name, entry in manifest['arrays'].items():
+            path = os.path.join(dirname, entry['file'])
+            if verify and self.HashFile(path) != entry['sha256']:
+                raise ValueError('Checksum of `%s` does not match the manifest.' % (path))
+            # Empty arrays can not be mapped
+            empty = 0 in entry['shape']
+            a = np.load(path, mmap_mode=None if empty else mmap_mode, allow_pickle=False)
+            if a.dtype.str != entry['dtype'] or list(a.shape) != entry['shape']:
+                raise ValueError('`%s` does not match the manifest.' % (path))
+            arrays[name] = a
+        return arrays, manifest['metadata']
+
+
+    def HashFile(self, filename):
+        """Returns the SHA-256 of a file."""
+        h = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        return h.hexdigest()
+
+
+class ChunkWriter:
+    """Writes a data frame chunk by chunk to a CSV or Parquet file."""
+
+    def __init__(self, filename):
+        if not filename.endswith(('.csv', '.csv.gz', '.parquet')):
+            raise ValueError('Chunked output must be a CSV or Parquet file: ' + filename)
+        self.filename = filename
+        self.writer = None
+        self.n_chunks = 0
+
+
+    def Write(self, chunk):
+        """Appends `chunk` to the output file."""
+        if self.filename.endswith('.parquet'):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if self.writer is None:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                self.writer = pq.ParquetWriter(self.filename, table.schema)
+            else:
+                # Keep the schema of the first chunk, e.g. for all-NaN columns
+                table = pa.Table.from_pandas(chunk, schema=self.writer.schema,
+                                             preserve_index=False)
+            self.writer.write_table(table)
+        else:
+            chunk.to_csv(self.filename, mode='w' if self.n_chunks == 0 else 'a',
+                         header=(self.n_chunks == 0), index=False)
+        self.n_chunks += 1
+
+
+    def Close(self):
+        """Finalizes the output file."""
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class BlockedGzipWriter(io.RawIOBase):
+    """Writes a gzip file as a series of independently compressed members.
+    Each member holds `blocksize` bytes and stores its compressed size in the
+    extra field of its header, like BGZF. Blocks are compressed in `threads`
+    threads. Any gzip reader can read the file; `BlockedGzipReader` reads the
+    blocks in parallel."""
+
+    def __init__(self, f, blocksize=1 << 22, level=1, threads=None):
+        self.f = f
+        self.blocksize = blocksize
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = []
+        self.buffer = bytearray()
+
+
+    def writable(self):
+        return True
+
+
+    def write(self, b):
+        b = memoryview(b).cast('B')
+        self.buffer += b
+        while len(self.buffer) >= self.blocksize:
+            self.Submit(bytes(self.buffer[:self.blocksize]))
+            del self.buffer[:self.blocksize]
+        return len(b)
+
+
+    def Submit(self, block):
+        """Compresses `block` in the pool and writes the finished members in
+        order, keeping a bounded number of blocks in flight."""
+        self.pending.append(self.pool.submit(self.CompressBlock, block, self.level))
+        while len(self.pending) > 2 * self.threads:
+            self.f.write(self.pending.pop(0).result())
+
+
+    @staticmethod
+    def CompressBlock(block, level):
+        """Returns `block` as one gzip member with its size in the header."""
+        c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = c.compress(block) + c.flush()
+        # Header with FEXTRA and the subfield `BX` holding the member size
+        size = 10 + 2 + 8 + len(deflated) + 8
+        header = (GZIP_MAGIC + b'\x08\x04' + b'\x00' * 4 + b'\x00\xff' +
+                  struct.pack('<H', 8) + b'BX' + struct.pack('<HI', 4, size))
+        trailer = struct.pack('<II', zlib.crc32(block), len(block) & 0xffffffff)
+        return header + deflated + trailer
+
+
+    def close(self):
+        if not self.closed:
+            if self.buffer:
+                self.Submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            for future in self.pending:
+                self.f.write(future.result())
+            self.pending = []
+            self.pool.shutdown()
+        super().close()
+
+
+class BlockedGzipReader(io.RawIOBase):
+    """Reads a gzip file written by `BlockedGzipWriter` and decompresses its
+    members in `threads` threads."""
+
+    def __init__(self, f, threads=None):
+        self.f = f
+        self.threads = threads or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = []
+        self.buffer = b''
+        self.offset = 0
+        self.eof = False
+
+
+    @staticmethod
+    def IsBlocked(f):
+        """Checks if the gzip member at the position of `f` stores its size."""
+        position = f.tell()
+        header = f.read(20)
+        f.seek(position)
+        return BlockedGzipReader.MemberSize(header) is not None
+
+
+    @staticmethod
+    def MemberSize(header):
+        """Returns the member size stored in a gzip header or None."""
+        if (len(header) < 20 or not header.startswith(GZIP_MAGIC) or
+            not header[3] & 0x04 or header[12:14] != b'BX'):
+            return None
+        return struct.unpack('<I', header[16:20])[0]
+
+
+    def readable(self):
+        return True
+
+
+    def Fill(self):
+        """Reads compressed members and queues them for decompression."""
+        while not self.eof and len(self.pending) < 2 * self.threads:
+            header = self.f.read(20)
+            if not header:
+                self.eof = True
+                break
+            size = self.MemberSize(header)
+            if size is None:
+                raise IOError('Corrupt blocked gzip member')
+            member = header + self.f.read(size - 20)
+            self.pending.append(self.pool.submit(zlib.decompress, member, 16 + zlib.MAX_WBITS))
+
+
+    def readinto(self, b):
+        while self.offset >= len(self.buffer):
+            self.Fill()
+            if not self.pending:
+                return 0
+            self.buffer = self.pending.pop(0).result()
+            self.offset = 0
+        n = min(len(b), len(self.buffer) - self.offset)
+        b[:n] = self.buffer[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+
+    def close(self):
+        if not self.closed:
+            for future in self.pending:
+                future.cancel()
+            self.pending = []
+            self.pool.shutdown()
+        super().close()
@@ -8,7 +8,7 @@ Use of this source code is governed by license located in license file: https://
 import pandas as pd
 import numpy as np
 from BrainChart.dataio import DataIO
-import neuroHarmonize as nh
+from BrainChart.normative import NormativeModel
 import importlib.resources as pkg_resources
 import sys
 import joblib
@@ -28,6 +28,9 @@ class DataModel:
         self.SPAREModel = None
         self.BrainAgeModel = None
         self.ADModel = None
+        # Normative curves of all ROIs by (model, age grid, Sex, ICV)
+        self.normative_cache = {}
+        self.normative_model = None
 
 
     def SetMUSEDictionaries(self, MUSEDictNAMEtoID, MUSEDictIDtoNAME):
@@ -69,6 +72,8 @@ class DataModel:
     def SetHarmonizationModel(self,m):
         """Setter for neuroHarmonize model"""
         self.harmonization_model = m
+        self.normative_cache.clear()
+        self.normative_model = None
 
 
     def SetSPAREModel(self,BrainAgeModel, ADModel):
@@ -88,32 +93,46 @@ class DataModel:
         return self.harmonization_model
 
 
-    def GetNormativeRange(self,roi):
+    def GetNormativeRange(self,roi,sex=0,icv=1450000,age=(25,95,200)):
         """Return normative range"""
-        
-        # Constructig the visualization of the normative range based on GAM
-        # model
-        covariates = pd.DataFrame(np.linspace(25, 95, 200), columns=['Age'])
-        # Fix ICV roughly to population average
-        covariates['ICV'] = 1450000 # mean ICV
-        # Fix Sex variable
-        covariates['Sex'] = 0
-        # No need to specify site, but column with name `SITE` must exist
-        covariates['SITE'] = 'None'
-        # Set the ROI to be predicted
         ROIs = self.harmonization_model['ROIs']
-        # Compute predicted mean for specific ROI
-        # TODO: This is inefficient because the mean values are predicted for
-        #       all ROIs every time. Computation is only necessary if the
-        #       covariates change (e.g. for different `Sex`).
-        _, stand_mean = nh.harmonizationApply(np.full((covariates.shape[0], len(ROIs)), np.nan),
-                                              covariates[['SITE','Age','Sex','ICV']],
-                                              self.harmonization_model, True)
+        age, stand_mean, sd = self.GetNormativeCurves(sex, icv, age)
+        # Column lookup of the specific ROI
         y = stand_mean[:,ROIs.index(roi)]
         # Get the normative range based on pooled variance
-        z = 2.*np.sqrt(self.harmonization_model['var_pooled'][ROIs.index(roi)])
+        z = 2.*sd[ROIs.index(roi)]
         # Return age and associated mean value as well as normative range
-        return covariates['Age'], y, z
+        return age, y, z
+
+
+    def GetNormativeCurves(self,sex=0,icv=1450000,age=(25,95,200)):
+        """Returns the age grid, the predicted mean of all ROIs (grid x ROIs)
+        and the pooled standard deviation of all ROIs. The curves are
+        computed once per model, age grid (start, stop, num), `sex` and
+        `icv`."""
+        model = self.harmonization_model
+        key = (id(model), tuple(age), sex, icv)
+        # The model is stored with the curves, so a new model that reuses
+        # the id of a released one does not hit the cache
+        if key in self.normative_cache and self.normative_cache[key][0] is model:
+            return self.normative_cache[key][1:]
+
+        # Predicted mean of all ROIs along the age grid for fixed covariates
+        normative = self.GetNormativeModel()
+        age = pd.Series(np.linspace(*age), name='Age')
+        stand_mean = normative.Predict(Age=age.values, Sex=sex, ICV=icv)
+        sd = normative.GetSD()
+
+        self.normative_cache[key] = (model, age, stand_mean, sd)
+        return age, stand_mean, sd
+
+
+    def GetNormativeModel(self):
+        """Returns the normative curve evaluator of the harmonization model"""
+        if (self.normative_model is None or
+            self.normative_model.model is not self.harmonization_model):
+            self.normative_model = NormativeModel(self.harmonization_model)
+        return self.normative_model
 
 
     def GetData(self,roi,hue):
@@ -172,6 +191,8 @@ class DataModel:
         del self.data
         del self.harmonization_model
         self.harmonization_model = None
+        self.normative_cache.clear()
+        self.normative_model = None
         self.data = None
 
     def GetDataStatistics(self):
@@ -0,0 +1,513 @@
+# This Python file uses the following encoding: utf-8
+"""
+contact: software@cbica.upenn.edu
+Copyright (c) 2018 University of Pennsylvania. All rights reserved.
+Use of this source code is governed by license located in license file: https://github.com/CBICA/BrainChart/blob/main/LICENSE
+"""
+
+import pandas as pd
+import numpy as np
+import os
+from BrainChart.normative import NormativeModel, GetSplines
+
+# Ages above the range of the age splines of the harmonization models
+# (`smooth_term_bounds` of 20 to 100 years) are harmonized as 100 years
+# instead of extrapolating the splines. The data keeps the actual ages.
+MAX_HARMONIZATION_AGE = 100
+
+
+class SiteRegistry:
+    """Location/scale parameters of sites that are not part of the training
+    data of a harmonization model.
+
+    The parameters are stored in the model dictionary under `new_SITE_params`
+    as {site: {'n', 'counts', 'gamma', 'M2', 'ids'}} with plain arrays, so
+    they are saved and loaded with the model. `gamma` is the mean and `M2`
+    the sum of squared deviations (over ROIs) of the standardized residuals
+    of the `n` reference rows seen so far, of `counts` (over ROIs) values as
+    missing values are skipped, so new reference rows are merged without
+    refitting. `ids` are the sorted keys of these rows (see
+    `HashHarmonizationInputs`), so rows are never merged twice. Only sites
+    with at least `min_reference` reference rows are stored."""
+
+    def __init__(self, model, min_reference=25):
+        """The constructor."""
+        self.model = model
+        self.min_reference = min_reference
+        if 'new_SITE_params' not in model:
+            model['new_SITE_params'] = {}
+        self.params = model['new_SITE_params']
+
+
+    def IsNew(self, sites):
+        """Returns which of `sites` are not training sites of the model."""
+        return ~pd.Index(sites).isin(self.model['SITE_labels'])
+
+
+    def Contains(self, site):
+        """Checks if parameters of `site` were stored."""
+        return site in self.params
+
+
+    def IsUsable(self, site):
+        """Checks if `site` has enough reference rows to be harmonized."""
+        return site in self.params and self.params[site]['n'] >= self.min_reference
+
+
+    def GetCounts(self, site):
+        """Returns the number of values (array over ROIs) of `site`, the
+        number of rows for parameters stored without them."""
+        p = self.params[site]
+        return p.get('counts', np.full(np.shape(p['gamma']), float(p['n'])))
+
+
+    def GetParameters(self, site):
+        """Returns gamma and delta (arrays over ROIs) of `site`."""
+        p = self.params[site]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return p['gamma'], p['M2'] / self.GetCounts(site)
+
+
+    def GetIds(self, site):
+        """Returns the keys of the reference rows merged into `site`, empty
+        for parameters stored without them."""
+        return self.params[site].get('ids', np.empty((0,), dtype=np.uint64))
+
+
+    def Update(self, site, n, gamma, M2, ids=None, counts=None):
+        """Merges the statistics of `n` new reference rows (mean `gamma` and
+        sum of squared deviations `M2` of `counts` values per ROI, `n` by
+        default) with keys `ids` into the parameters of `site`."""
+        ids = np.empty((0,), dtype=np.uint64) if ids is None else np.asarray(ids, dtype=np.uint64)
+        counts = (np.full(np.shape(gamma), float(n)) if counts is None
+                  else np.asarray(counts, dtype=np.float64))
+        # ROIs without values do not contribute
+        gamma = np.where(counts > 0, gamma, 0.)
+        M2 = np.where(counts > 0, M2, 0.)
+        if site not in self.params:
+            self.params[site] = {'n': int(n), 'counts': counts.copy(), 'gamma': gamma,
+                                 'M2': M2, 'ids': np.unique(ids)}
+            return
+        p = self.params[site]
+        old = self.GetCounts(site)
+        total = old + counts
+        w = np.divide(counts, total, out=np.zeros_like(total), where=total > 0)
+        d = gamma - p['gamma']
+        p['gamma'] = p['gamma'] + d * w
+        p['M2'] = p['M2'] + M2 + d**2 * old * w
+        p['n'] = int(p['n'] + n)
+        p['counts'] = total
+        p['ids'] = np.union1d(self.GetIds(site), ids)
+
+
+    def Fit(self, Z, sites, reference, update=False, ids=None):
+        """Estimates the parameters of new sites from the standardized
+        residuals `Z` of their `reference` rows in one groupby reduction.
+        New sites with less than `min_reference` reference rows are not
+        stored. Sites already stored are only updated with the reference
+        rows that are selected by `update` (True for all rows) and whose
+        keys `ids` (e.g. `HashHarmonizationInputs`) were not merged
+        before."""
+        sites = np.asarray(sites)
+        reference = np.asarray(reference, dtype=bool)
+        known = pd.Index(sites).isin(list(self.params))
+        reference = reference & (~known | update)
+        if ids is not None:
+            ids = np.asarray(ids, dtype=np.uint64)
+            for site in pd.unique(sites[reference & known]):
+                rows = reference & (sites == site)
+                reference[rows] = ~np.isin(ids[rows], self.GetIds(site))
+
+        grouped = pd.DataFrame(Z[reference]).groupby(sites[reference], sort=False)
+        n = grouped.size()
+        # Missing values are skipped, so each ROI has its own count
+        counts = grouped.count()
+        gamma = grouped.mean()
+        M2 = grouped.var(ddof=0).fillna(0.) * counts
+        site_ids = (pd.Series(ids[reference]).groupby(sites[reference], sort=False)
+                    if ids is not None else None)
+        for site in n.index:
+            if not self.Contains(site) and n[site] < self.min_reference:
+                continue
+            self.Update(site, n[site], gamma.loc[site].values, M2.loc[site].values,
+                        None if site_ids is None else site_ids.get_group(site).values,
+                        counts.loc[site].values)
+
+
+    def ToFrame(self):
+        """Returns the parameters as data frame with one row per site."""
+        sites = list(self.params)
+        return pd.DataFrame({'gamma': [self.GetParameters(s)[0] for s in sites],
+                             'delta': [self.GetParameters(s)[1] for s in sites],
+                             'n': [self.params[s]['n'] for s in sites]}, index=sites)
+
+
+def HarmonizeNewSites(bayes_data, residuals, stand_mean, model, sites, reference,
+                      min_reference=25, update=False, ids=None):
+    """Harmonizes the rows of sites that are not part of the harmonization
+    model in place.
+
+    Location (gamma) and scale (delta) of new sites come from the
+    `SiteRegistry` of the model. Sites not in the registry are fitted from
+    the standardized residuals of their `reference` rows (e.g.
+    `UseForComBatGAMHarmonization`) and stored. With `update` (True or a
+    mask over rows) the reference rows are merged into the parameters of
+    stored sites as well, skipping rows whose keys `ids` were merged
+    before. Sites with less than `min_reference` reference rows are left
+    unchanged and not stored.
+
+    `bayes_data`, `residuals` and `stand_mean` are the harmonized data, the
+    raw residuals and the standardized mean (rows x ROIs) as returned by
+    `ApplyHarmonization`. Returns the registry."""
+    registry = SiteRegistry(model, min_reference)
+    codes, labels = pd.factorize(np.asarray(sites))
+    labels = pd.Index(labels)
+    is_new = registry.IsNew(labels)
+    rows = (codes >= 0) & is_new[codes]
+
+    # Standardized residuals of the new sites only
+    sd = np.sqrt(np.ravel(model['var_pooled']))
+    Z = residuals[rows] / sd
+    codes = codes[rows]
+    if not np.isscalar(update):
+        update = np.asarray(update, dtype=bool)[rows]
+    if ids is not None:
+        ids = np.asarray(ids)[rows]
+    registry.Fit(Z, labels[codes], np.asarray(reference, dtype=bool)[rows], update, ids)
+
+    usable = np.array([registry.IsUsable(site) for site in labels], dtype=bool)
+    for site in labels[is_new & ~usable]:
+        print('New site `' + str(site) + '` has less than ' + str(min_reference) +
+              ' reference data points. Skipping harmonization.')
+    if not usable.any():
+        return registry
+
+    # Parameters of each row's site, rows of unusable sites are dropped
+    gamma = np.zeros((len(labels), sd.shape[0]))
+    delta = np.ones((len(labels), sd.shape[0]))
+    for i in np.flatnonzero(usable):
+        gamma[i], delta[i] = registry.GetParameters(labels[i])
+    keep = usable[codes]
+    rows = np.flatnonzero(rows)[keep]
+    codes = codes[keep]
+
+    # Remove location and scale of each row's site in place
+    if not keep.all():
+        Z = Z[keep]
+    Z -= gamma[codes]
+    Z *= sd
+    Z /= np.sqrt(delta[codes])
+    Z += np.broadcast_to(stand_mean, residuals.shape)[rows]
+    bayes_data[rows] = Z
+
+    return registry
+
+
+def GetHarmonizationColumns(model):
+    """Returns the names of the columns written by `HarmonizeData`."""
+    return (['H_' + x for x in model['ROIs']] +
+            ['RES_ICV_Sex_' + x for x in model['ROIs']] +
+            ['RES_' + x for x in model['ROIs']] +
+            ['RAW_RES_' + x for x in model['ROIs']])
+
+
+def HashHarmonizationInputs(data, model):
+    """Returns a hash per row of the columns the harmonization depends on.
+    The hashes do not depend on the data types: numbers are hashed rounded
+    to float32 and SITE and Sex as objects, so data with compact data types
+    (see `DataIO.OptimizeDataTypes`) gives the same hashes."""
+    columns = ['Age','DLICV_baseline'] + list(model['ROIs'])
+    inputs = pd.DataFrame(data[columns].to_numpy(dtype=np.float64).astype(np.float32),
+                          columns=columns)
+    inputs.insert(0, 'SITE', data['SITE'].astype(object).to_numpy())
+    inputs.insert(2, 'Sex', data['Sex'].astype(object).to_numpy())
+    return pd.Series(pd.util.hash_pandas_object(inputs, index=False).values, index=data.index)
+
+
+def GetRowsToHarmonize(data, model, hashes=None, previous=None):
+    """Returns a mask of the rows with complete inputs that lack harmonized
+    columns and a mask of the rows whose input `hashes` differ from the
+    `previous` ones (series indexed like `data`, rows without previous hash
+    are not considered changed)."""
+    complete = data[['SITE','Age','Sex','DLICV_baseline'] + list(model['ROIs'])].notnull().all(axis=1).values
+    columns = GetHarmonizationColumns(model)
+    if set(columns).issubset(data.columns):
+        lacking = complete & data[columns].isnull().any(axis=1).values
+    else:
+        lacking = complete
+
+    changed = np.zeros((data.shape[0],), dtype=bool)
+    if hashes is not None and previous is not None:
+        previous = previous.reindex(data.index)
+        changed = (complete & previous.notnull().values &
+                   (previous.values != hashes.values) & ~lacking)
+    return lacking, changed
+
+
+def GetHarmonizationCovariates(data):
+    """Returns the covariates of `data` as the harmonization model expects
+    them: `Sex` coded as 1 (M) and 0 (F), `Age` limited to
+    `MAX_HARMONIZATION_AGE` and float64 numbers, also for compact data with
+    float32 and categorical columns. The GUI and the batch processing both
+    harmonize with these covariates."""
+    return pd.DataFrame({'SITE': data['SITE'].to_numpy(),
+                         'Age': np.minimum(data['Age'].to_numpy(dtype=np.float64), MAX_HARMONIZATION_AGE),
+                         'Sex': data['Sex'].astype(object).map({'M':1,'F':0}).to_numpy(),
+                         'DLICV_baseline': data['DLICV_baseline'].to_numpy(dtype=np.float64)},
+                        index=data.index)
+
+
+def HarmonizeData(data, model, rows=None, chunksize=10000, update=False):
+    """Returns the harmonized ROIs (`H_`), harmonized residuals without Sex
+    and ICV effects (`RES_ICV_Sex_`), harmonized residuals (`RES_`) and raw
+    residuals (`RAW_RES_`) of the selected `rows` (boolean mask, all rows by
+    default) as data frame indexed like `data`.
+
+    The model is applied to chunks of `chunksize` rows, so memory depends on
+    the number of selected rows only. New sites are adapted once over all
+    selected rows, see `HarmonizeNewSites` for `update`. New sites without
+    stored parameters are fitted from all their reference rows in `data`,
+    also those that are not selected."""
+    if rows is None:
+        rows = np.ones((data.shape[0],), dtype=bool)
+    rows = np.asarray(rows, dtype=bool)
+    extra = GetUnselectedReferenceRows(data, model, rows)
+    idx = np.flatnonzero(rows | extra)
+    ROIs = list(model['ROIs'])
+    n = idx.shape[0]
+
+    bayes_data = np.empty((n, len(ROIs)))
+    stand_mean = np.empty((n, len(ROIs)))
+    residuals = np.empty((n, len(ROIs)))
+    for start in range(0, n, chunksize):
+        chunk = data.iloc[idx[start:start + chunksize]]
+        covars = GetHarmonizationCovariates(chunk)
+        Y = chunk[ROIs].to_numpy(dtype=np.float64)
+        b, m = ApplyHarmonization(Y, covars, model)
+        block = slice(start, start + chunk.shape[0])
+        bayes_data[block] = b
+        stand_mean[block] = m
+        residuals[block] = Y - m
+
+    if 'UseForComBatGAMHarmonization' in data.columns:
+        if not np.isscalar(update):
+            update = np.asarray(update, dtype=bool)[idx]
+        HarmonizeNewSites(bayes_data, residuals, stand_mean, model,
+                          data['SITE'].to_numpy()[idx],
+                          data['UseForComBatGAMHarmonization'].values[idx],
+                          update=update,
+                          ids=HashHarmonizationInputs(data.iloc[idx], model).values)
+    else:
+        print('Skipping out-of-sample harmonization because `UseForComBatGAMHarmonization` does not exist.')
+
+    # Sex and ICV effects of the GAM
+    start_index = len(model['SITE_labels'])
+    sex_icv = GetHarmonizationCovariates(data.iloc[idx])[['Sex','DLICV_baseline']]
+    sex_icv_effect = np.dot(sex_icv.values.astype(np.float64),
+                            model['B_hat'][start_index:(start_index+2),:])
+
+    return pd.DataFrame(np.hstack((bayes_data, bayes_data - sex_icv_effect,
+                                   bayes_data - stand_mean, residuals)),
+                        index=data.index[idx], columns=GetHarmonizationColumns(model))[rows[idx]]
+
+
+def GetUnselectedReferenceRows(data, model, rows):
+    """Returns a mask of the reference rows with complete inputs that are
+    not selected by `rows` of new sites that have selected rows but no
+    stored parameters."""
+    extra = np.zeros((data.shape[0],), dtype=bool)
+    if 'UseForComBatGAMHarmonization' not in data.columns or rows.all():
+        return extra
+    sites = data['SITE'].to_numpy()
+    stored = model.get('new_SITE_params', {})
+    selected = pd.unique(sites[rows])
+    unknown = [site for site in selected[SiteRegistry(model).IsNew(selected)]
+               if site not in stored]
+    if not unknown:
+        return extra
+    complete = data[['SITE','Age','Sex','DLICV_baseline'] + list(model['ROIs'])].notnull().all(axis=1).values
+    reference = data['UseForComBatGAMHarmonization'].values.astype(bool)
+    return ~rows & pd.Index(sites).isin(unknown) & reference & complete
+
+
+def ApplyHarmonization(data, covars, model):
+    """Returns the harmonized data and the standardized mean (rows x ROIs)
+    of `data` (rows x ROIs) like `harmonizationApply(data, covars, model,
+    True)` of neuroHarmonize 2.1, i.e. the standardized mean includes the
+    covariate effects. Only the arrays of the model are used, so compiled
+    models (see `CompileHarmonizationModel`) work as well. Covariates are
+    matched by position as in neuroHarmonize; rows of sites that are not
+    part of the model are NaN."""
+    data = np.asarray(data, dtype=np.float64)
+    site_col = covars.columns.get_loc('SITE')
+    smooth_model = model['smooth_model']
+    smooth_cols = list(smooth_model['smooth_cols']) if smooth_model['perform_smoothing'] else []
+    other_cols = [c for c in range(covars.shape[1]) if c != site_col and c not in smooth_cols]
+
+    normative = NormativeModel(model, [covars.columns[c] for c in other_cols])
+    stand_mean = normative.PredictValues([covars.iloc[:, c].to_numpy(dtype=np.float64)
+                                          for c in smooth_cols + other_cols])
+
+    # Remove location and scale of each row's site
+    codes = pd.Index(model['SITE_labels']).get_indexer(covars['SITE'].to_numpy())
+    train = codes >= 0
+    j = codes[train]
+    sd = np.sqrt(np.ravel(model['var_pooled']))
+    gamma_star = np.asarray(model['gamma_star'])
+    delta_star = np.asarray(model['delta_star'])
+    bayes_data = np.full(data.shape, np.nan)
+    bayes_data[train] = (((data[train] - stand_mean[train]) / sd - gamma_star[j])
+                         / np.sqrt(delta_star[j]) * sd + stand_mean[train])
+
+    # Data of the reference site is not changed
+    ref_level = model.get('info_dict', {}).get('ref_level')
+    if ref_level is not None:
+        ref = codes == ref_level
+        bayes_data[ref] = data[ref]
+
+    return bayes_data, stand_mean
+
+
+def CompileHarmonizationModel(model):
+    """Returns the parts of a neuroHarmonize model that `ApplyHarmonization`
+    and `NormativeModel` need: ROIs, sites, `B_hat`, `var_pooled`,
+    `gamma_star`, `delta_star`, the grand mean and the knots of the splines.
+    The statsmodels `bsplines_constructor` and the training data are
+    dropped."""
+    smooth_model = model['smooth_model']
+    splines = [{'knots': np.asarray(knots, dtype=np.float64), 'degree': int(degree),
+                'include_intercept': bool(include_intercept),
+                'ctransf': None if ctransf is None else np.asarray(ctransf, dtype=np.float64)}
+               for knots, degree, include_intercept, ctransf in GetSplines(smooth_model)]
+    if 'grand_mean' in model:
+        grand_mean = np.ravel(model['grand_mean']).astype(np.float64)
+    else:
+        grand_mean = np.asarray(model['stand_mean'], dtype=np.float64)[:, 0]
+
+    compiled = {'ROIs': list(model['ROIs']),
+                'SITE_labels': np.asarray(model['SITE_labels']),
+                'B_hat': np.asarray(model['B_hat'], dtype=np.float64),
+                'var_pooled': np.asarray(model['var_pooled'], dtype=np.float64),
+                'gamma_star': np.asarray(model['gamma_star'], dtype=np.float64),
+                'delta_star': np.asarray(model['delta_star'], dtype=np.float64),
+                'grand_mean': grand_mean,
+                'info_dict': {'ref_level': model.get('info_dict', {}).get('ref_level')},
+                'smooth_model': {'perform_smoothing': bool(smooth_model['perform_smoothing']),
+                                 'smooth_terms': list(smooth_model.get('smooth_terms', [])),
+                                 'smooth_cols': [int(c) for c in smooth_model.get('smooth_cols', [])],
+                                 'splines': splines}}
+    if 'Covariates' in model:
+        compiled['Covariates'] = list(model['Covariates'])
+    if 'new_SITE_params' in model:
+        compiled['new_SITE_params'] = {site: dict(p) for site, p in model['new_SITE_params'].items()}
+    return compiled
+
+
+def SaveHarmonizationBundle(model, dirname, source=None):
+    """Saves the compiled harmonization model (see
+    `CompileHarmonizationModel`) including the parameters of new sites as
+    array bundle (see `DataIO.SaveArrayBundle` for `source`)."""
+    from BrainChart.dataio import DataIO
+    compiled = CompileHarmonizationModel(model)
+    arrays = {name: compiled[name] for name in ('B_hat', 'var_pooled', 'gamma_star',
+                                                'delta_star', 'grand_mean')}
+    splines = []
+    for i, spline in enumerate(compiled['smooth_model']['splines']):
+        arrays['spline_%d_knots' % (i)] = spline['knots']
+        if spline['ctransf'] is not None:
+            arrays['spline_%d_ctransf' % (i)] = spline['ctransf']
+        splines.append({'degree': spline['degree'], 'include_intercept': spline['include_intercept']})
+    sites = []
+    for i, (site, p) in enumerate(compiled.get('new_SITE_params', {}).items()):
+        arrays['site_%d_gamma' % (i)] = np.asarray(p['gamma'], dtype=np.float64)
+        arrays['site_%d_M2' % (i)] = np.asarray(p['M2'], dtype=np.float64)
+        if 'counts' in p:
+            arrays['site_%d_counts' % (i)] = np.asarray(p['counts'], dtype=np.float64)
+        if 'ids' in p:
+            arrays['site_%d_ids' % (i)] = np.asarray(p['ids'], dtype=np.uint64)
+        sites.append({'site': np.asarray([site]).tolist()[0], 'n': int(p['n'])})
+
+    smooth_model = {k: v for k, v in compiled['smooth_model'].items() if k != 'splines'}
+    smooth_model['splines'] = splines
+    metadata = {'ROIs': compiled['ROIs'],
+                'SITE_labels': compiled['SITE_labels'].tolist(),
+                'ref_level': compiled['info_dict']['ref_level'],
+                'smooth_model': smooth_model,
+                'new_sites': sites}
+    if 'Covariates' in compiled:
+        metadata['Covariates'] = compiled['Covariates']
+    DataIO().SaveArrayBundle(dirname, arrays, metadata, 'Harmonization', source)
+
+
+def ReadHarmonizationBundle(dirname, verify=True):
+    """Returns the compiled harmonization model of an array bundle."""
+    from BrainChart.dataio import DataIO
+    if os.path.basename(dirname) == 'manifest.json':
+        dirname = os.path.dirname(dirname)
+    # The arrays are small and new sites are updated, so they are not mapped
+    arrays, metadata = DataIO().ReadArrayBundle(dirname, 'Harmonization', mmap_mode=None,
+                                                verify=verify)
+    smooth_model = dict(metadata['smooth_model'])
+    smooth_model['splines'] = [{'knots': arrays['spline_%d_knots' % (i)],
+                                'degree': spline['degree'],
+                                'include_intercept': spline['include_intercept'],
+                                'ctransf': arrays.get('spline_%d_ctransf' % (i))}
+                               for i, spline in enumerate(metadata['smooth_model']['splines'])]
+    new_sites = {}
+    for i, s in enumerate(metadata['new_sites']):
+        new_sites[s['site']] = {'n': s['n'],
+                                'gamma': arrays['site_%d_gamma' % (i)],
+                                'M2': arrays['site_%d_M2' % (i)]}
+        for name in ('ids', 'counts'):
+            if 'site_%d_%s' % (i, name) in arrays:
+                new_sites[s['site']][name] = arrays['site_%d_%s' % (i, name)]
+    model = {'ROIs': metadata['ROIs'],
+             'SITE_labels': np.asarray(metadata['SITE_labels']),
+             'info_dict': {'ref_level': metadata['ref_level']},
+             'smooth_model': smooth_model,
+             'new_SITE_params': new_sites}
+    for name in ('B_hat', 'var_pooled', 'gamma_star', 'delta_star', 'grand_mean'):
+        model[name] = arrays[name]
+    if 'Covariates' in metadata:
+        model['Covariates'] = metadata['Covariates']
+    return model
+
+
+def SummarizeResiduals(data, columns, by='SITE', whis=1.5, chunksize=32):
+    """Returns box plot statistics of `columns` per group of `by` (sorted,
+    only groups with rows) and the SD of each column over all rows.
+
+    The statistics are a data frame indexed by group with columns
+    (statistic, column) for the quartiles `q1`, `med` and `q3`, the whiskers
+    `whislo` and `whishi` at the furthest values within `whis` IQR of the
+    box (or at the box) as in matplotlib's `boxplot_stats`, the number of values `n` and the
+    SD `sd`. Missing values are ignored. All groups are summarized in one
+    groupby pass per chunk of `chunksize` columns."""
+    columns = list(columns)
+    codes, groups = pd.factorize(data[by], sort=True)
+    valid = codes >= 0
+    codes = codes[valid]
+
+    stats = []
+    for start in range(0, len(columns), chunksize):
+        chunk = columns[start:start + chunksize]
+        values = data[chunk].to_numpy(dtype=np.float64)[valid]
+        grouped = pd.DataFrame(values, columns=chunk).groupby(codes)
+        q = grouped.quantile([.25, .5, .75])
+        q1, med, q3 = [q.xs(p, level=1).to_numpy() for p in (.25, .5, .75)]
+        lo = (q1 - whis * (q3 - q1))[codes]
+        hi = (q3 + whis * (q3 - q1))[codes]
+        whislo = pd.DataFrame(np.where(values >= lo, values, np.nan), columns=chunk).groupby(codes).min()
+        whishi = pd.DataFrame(np.where(values <= hi, values, np.nan), columns=chunk).groupby(codes).max()
+        # Whiskers do not end inside the box, e.g. for tied values
+        whislo = np.fmin(whislo, q1)
+        whishi = np.fmax(whishi, q3)
+        stats.append(pd.concat({'q1': pd.DataFrame(q1, columns=chunk),
+                                'med': pd.DataFrame(med, columns=chunk),
+                                'q3': pd.DataFrame(q3, columns=chunk),
+                                'whislo': whislo, 'whishi': whishi,
+                                'n': grouped.count(), 'sd': grouped.std()}, axis=1))
+
+    stats = pd.concat(stats, axis=1) if stats else pd.DataFrame()
+    stats.index = pd.Index(np.asarray(groups), name=by)
+    return stats, data[columns].std()
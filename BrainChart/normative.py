@@ -0,0 +1,160 @@
+# This Python file uses the following encoding: utf-8
+"""
+contact: software@cbica.upenn.edu
+Copyright (c) 2018 University of Pennsylvania. All rights reserved.
+Use of this source code is governed by license located in license file: https://github.com/CBICA/BrainChart/blob/main/LICENSE
+"""
+
+import numpy as np
+from scipy.interpolate import BSpline
+from scipy.stats import norm
+
+
+# Names of the covariates in models and data that mean the same covariate
+COVARIATE_NAMES = {'DLICV_baseline': 'ICV', 'DLICV': 'ICV'}
+
+
+class NormativeModel:
+    """Normative curves of a neuroHarmonize model with a smooth (GAM) term.
+
+    The predicted mean of the ROIs is evaluated directly from the model as
+    grand mean + covariate effects + B-spline basis of the smooth terms,
+    i.e. the `stand_mean` of `harmonizationApply` without site effects.
+    All inputs are broadcast against each other, so curves for several
+    values of Sex or ICV are evaluated in one call.
+
+    `covariates` are the names of the covariates that are not smooth terms
+    in the order they were passed to `harmonizationLearn` (default the
+    `Covariates` of the model or Sex and ICV, as used throughout
+    BrainChart). Names are matched as in `COVARIATE_NAMES`, e.g. ICV for a
+    model trained with DLICV_baseline.
+
+    Models compiled with `BrainChart.harmonization.CompileHarmonizationModel`
+    are supported as well; they store the knots of the splines instead of the
+    statsmodels `bsplines_constructor`."""
+
+    def __init__(self, model, covariates=None):
+        """The constructor."""
+        self.model = model
+        self.ROIs = list(model['ROIs'])
+        smooth_model = model['smooth_model']
+        if smooth_model['perform_smoothing']:
+            self.smooth_terms = list(smooth_model['smooth_terms'])
+        else:
+            self.smooth_terms = []
+        if covariates is None:
+            if 'Covariates' in model:
+                covariates = [c for c in model['Covariates']
+                              if c != 'SITE' and c not in self.smooth_terms]
+            else:
+                covariates = ['Sex', 'ICV']
+        self.covariates = list(covariates)
+
+        self.B_hat = np.asarray(model['B_hat'], dtype=np.float64)
+        # neuroHarmonize 2.1 stores the grand mean, later versions only the
+        # standardized mean of the training data which is the grand mean for
+        # every sample
+        if 'grand_mean' in model:
+            self.grand_mean = np.ravel(model['grand_mean']).astype(np.float64)
+        else:
+            self.grand_mean = np.asarray(model['stand_mean'], dtype=np.float64)[:, 0]
+        self.sd = np.sqrt(np.ravel(model['var_pooled']).astype(np.float64))
+
+        # Rows of B_hat: sites, covariates, spline basis of each smooth term
+        n_sites = len(model['SITE_labels'])
+        n_covariates = len(self.covariates)
+        self.B_covariates = self.B_hat[n_sites:n_sites + n_covariates]
+        self.B_splines = self.B_hat[n_sites + n_covariates:]
+
+        # One B-spline per smooth term that evaluates all basis functions
+        self.splines = []
+        for knots, degree, include_intercept, ctransf in GetSplines(smooth_model):
+            n_bases = len(knots) - degree - 1
+            spline = BSpline(np.sort(knots), np.eye(n_bases), degree, extrapolate=False)
+            self.splines.append((spline, int(not include_intercept), ctransf))
+
+        if self.B_splines.shape[0] != sum(self.GetSplineBasis(i, np.zeros((0,))).shape[1]
+                                           for i in range(len(self.splines))):
+            raise ValueError('Harmonization model does not match covariates %s.'
+                             % self.covariates)
+
+
+    def GetSplineBasis(self, i, x):
+        """Returns the spline basis (len(x) x bases) of smooth term `i` as in
+        statsmodels' `BSplines.transform`. Rows outside of the knots are NaN."""
+        spline, k_const, ctransf = self.splines[i]
+        basis = spline(np.ravel(x))[:, k_const:]
+        if ctransf is not None:
+            basis = basis.dot(ctransf)
+        return basis
+
+
+    def GetBounds(self, i=0):
+        """Returns the valid range of smooth term `i`."""
+        knots = self.splines[i][0].t
+        return knots[0], knots[-1]
+
+
+    def Predict(self, rois=None, **covariates):
+        """Returns the predicted mean (samples x ROIs) for the given values of
+        the smooth terms and covariates, e.g. `Predict(Age=age, Sex=0,
+        ICV=1450000)`. Sex is coded as 1 (M) and 0 (F) like in
+        `GetHarmonizationCovariates`, 'M' and 'F' are converted. Values are
+        broadcast against each other and flattened. `rois` selects ROIs by
+        name, all ROIs by default."""
+        covariates = {COVARIATE_NAMES.get(c, c): v for c, v in covariates.items()}
+        if 'Sex' in covariates:
+            sex = np.asarray(covariates['Sex'])
+            if sex.dtype.kind in 'OUS':
+                covariates['Sex'] = np.where(sex == 'M', 1., np.where(sex == 'F', 0., np.nan))
+        missing = [c for c in self.smooth_terms + self.covariates
+                   if COVARIATE_NAMES.get(c, c) not in covariates]
+        if missing:
+            raise ValueError('Missing values of covariates %s.' % missing)
+        return self.PredictValues([covariates[COVARIATE_NAMES.get(c, c)]
+                                   for c in self.smooth_terms + self.covariates], rois)
+
+
+    def PredictValues(self, values, rois=None):
+        """Returns the predicted mean (samples x ROIs) for the `values` of the
+        smooth terms followed by the covariates, see `Predict`."""
+        values = np.broadcast_arrays(*[np.asarray(v, dtype=np.float64) for v in values])
+        values = [np.ravel(v) for v in values]
+        idx = slice(None) if rois is None else [self.ROIs.index(r) for r in rois]
+
+        X = np.column_stack(values[len(self.smooth_terms):] +
+                            [self.GetSplineBasis(i, values[i])
+                             for i in range(len(self.smooth_terms))])
+        B = np.vstack((self.B_covariates, self.B_splines))[:, idx]
+        return self.grand_mean[idx] + np.dot(X, B)
+
+
+    def GetSD(self, rois=None):
+        """Returns the pooled standard deviation of the ROIs."""
+        if rois is None:
+            return self.sd
+        return self.sd[[self.ROIs.index(r) for r in rois]]
+
+
+    def PredictPercentiles(self, percentiles, rois=None, **covariates):
+        """Returns the curves of the given percentiles (0-100) as array
+        (percentiles x samples x ROIs) assuming normal residuals with the
+        pooled variance of the model."""
+        mean = self.Predict(rois, **covariates)
+        z = norm.ppf(np.asarray(percentiles, dtype=np.float64) / 100.)
+        return mean[np.newaxis] + z[:, np.newaxis, np.newaxis] * self.GetSD(rois)
+
+
+def GetSplines(smooth_model):
+    """Returns knots, degree, `include_intercept` and constraint transform
+    (or None) of every smooth term of the smooth model of a harmonization
+    model, from the statsmodels `bsplines_constructor` or from the `splines`
+    of a compiled model."""
+    if not smooth_model['perform_smoothing']:
+        return []
+    if 'splines' in smooth_model:
+        return [(s['knots'], s['degree'], s['include_intercept'], s['ctransf'])
+                for s in smooth_model['splines']]
+    return [(smoother.knots, smoother.degree, smoother.include_intercept,
+             getattr(smoother, 'ctransf', None))
+            for smoother in smooth_model['bsplines_constructor'].smoothers]
@@ -7,18 +7,23 @@ Use of this source code is governed by license located in license file: https://
 from PyQt5 import QtCore, QtWidgets
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
-import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import seaborn as sns
-import random
+import numpy as np
 import pandas as pd
 import os
+from BrainChart.scatterrenderer import ScatterRenderer
 
 class PlotCanvas(FigureCanvas):
     """ A generic Plotting class that derives from FigureCanvasQTAgg
     and plots data as per different options"""
 
-    def __init__(self, parent=None, width=5, height=4, dpi=100):
-        """The constructor."""
+    def __init__(self, parent=None, width=5, height=4, dpi=100,
+                 n_participants=10, min_timepoints=5, seed=10):
+        """The constructor. `n_participants` participants with at least
+        `min_timepoints` timepoints are sampled with `seed` for the
+        longitudinal view, plot options `PARTICIPANTS` and `TIMEPOINTS`
+        override them."""
 
         # a figure instance to plot on
         fig = Figure(figsize=(width, height), dpi=dpi)
@@ -33,6 +38,29 @@ class PlotCanvas(FigureCanvas):
                 QtWidgets.QSizePolicy.Expanding)
         FigureCanvas.updateGeometry(self)
 
+        # Scatter of age trends and SPARE-*, see `GetScatterRenderer`
+        self.scatter = None
+
+        # Sampling of the longitudinal view
+        self.n_participants = n_participants
+        self.min_timepoints = min_timepoints
+        self.seed = seed
+
+    def GetScatterRenderer(self):
+        """Returns the scatter renderer of the axes, clearing plots of other
+        views first. Large data is rendered as density with a level of detail
+        that follows zoom and pan."""
+        if self.scatter is None:
+            self.axes.clear()
+            self.scatter = ScatterRenderer(self.axes)
+        return self.scatter
+
+    def RemoveScatterRenderer(self):
+        """Removes the scatter renderer before the axes are cleared."""
+        if self.scatter is not None:
+            self.scatter.Remove()
+            self.scatter = None
+
     def Plot(self,datamodel,plotOptions):
         """call appropriate plotting functionality as per plot options"""
         if(str(plotOptions['VIEW']) == 'AgeTrend'):
@@ -51,21 +79,16 @@ class PlotCanvas(FigureCanvas):
         if not currentHue:
             currentHue = 'Sex'
 
-        # clear plot
-        self.axes.clear()
-
-        # seaborn plot on axis
-        sns.scatterplot(x='Age', y=currentROI,  hue=currentHue,ax=self.axes, s=5,
-                       data=datamodel.GetData(currentROI,currentHue))
+        data = datamodel.GetData(currentROI,currentHue)
 
         # Plot normative range if according GAM model is available
+        curves = []
         if (datamodel.harmonization_model is not None) and (currentROI in ['H_' + x for x in datamodel.harmonization_model['ROIs']]):
             x,y,z = datamodel.GetNormativeRange(currentROI[2:])
-            print('Pooled variance: %f' % (z))
             # Plot three lines as expected mean and +/- 2 times standard deviation
-            sns.lineplot(x=x, y=y, ax=self.axes, linestyle='-', markers=False, color='k')
-            sns.lineplot(x=x, y=y+z, ax=self.axes, linestyle=':', markers=False, color='k')
-            sns.lineplot(x=x, y=y-z, ax=self.axes, linestyle=':', markers=False, color='k')
+            curves = [(x, y, {'linestyle': '-', 'color': 'k'}),
+                      (x, y+z, {'linestyle': ':', 'color': 'k'}),
+                      (x, y-z, {'linestyle': ':', 'color': 'k'})]
 
         # Set ROI name as y-label if applicable
         _, MUSEDictIDtoNAME = datamodel.GetMUSEDictionaries()
@@ -83,38 +106,39 @@ class PlotCanvas(FigureCanvas):
         if ylabel.startswith('RES_MUSE_'):
             ylabel = '(Residuals MUSE) ' + list(map(MUSEDictIDtoNAME.get, [currentROI.replace('RES_', '')]))[0]
 
-        self.axes.set(ylabel=ylabel)
-
-        # refresh canvas
-        self.draw()
+        # update the scatter, redraws the canvas
+        self.GetScatterRenderer().Update(data['Age'], data[currentROI], data[currentHue],
+                                         'Age', ylabel, currentHue, curves)
 
     def PlotSPARE(self,datamodel,plotOptions):
         """Plot SPARE"""
-        # clear plot
-        self.axes.clear()
-
         # set hue
         currentHue = plotOptions['HUE']
 
         if not currentHue:
             currentHue = 'Sex'
 
-        # seaborn plot on axis
+        # scatter plot on axis
         if (('SPARE_AD' in datamodel.GetColumnHeaderNames()) &
             ('SPARE_BA' in datamodel.GetColumnHeaderNames())):
             spare_data = datamodel.GetData(['SPARE_BA','SPARE_AD'],
                                            currentHue)
             spare_data.loc[:, 'SPARE_BA'] = spare_data['SPARE_BA'] - spare_data['Age'] 
-            sns.scatterplot(x='SPARE_AD', y='SPARE_BA', hue=currentHue,ax=self.axes,
-                            s=5, data=spare_data)
+            self.GetScatterRenderer().Update(spare_data['SPARE_AD'], spare_data['SPARE_BA'],
+                                             spare_data[currentHue], 'SPARE_AD', 'SPARE_BA',
+                                             currentHue)
         else:
+            # clear plot
+            self.RemoveScatterRenderer()
+            self.axes.clear()
+
             # Set error text on plot
             self.axes.text(0.5,0.5,'No SPARE-* scores available.',
                            va='center', ha='center')
             print('Plotting failed. Check data set for inclusion of SPARE-* indices.')
 
-        # refresh canvas
-        self.draw()
+            # refresh canvas
+            self.draw()
 
     
     def PlotLongitudinalTrends(self,datamodel,plotOptions):
@@ -122,35 +146,51 @@ class PlotCanvas(FigureCanvas):
 
         currentROI = plotOptions['ROI']
         currentHue = plotOptions['HUE']
-        N_samples=10
-        N_timepoints=5
-        seed=10
-
-        data=datamodel.GetData(['participant_id',currentROI],
-                               currentHue)
-        
-        # limit dataset by number of timepoints and sample
-        data_sample = data.copy()
-        data_sample.dropna(subset=[currentROI],inplace=True)
-        vc = data_sample['participant_id'].value_counts()
-        timepoints = vc[vc >= N_timepoints].index[:]
-        data_sample = data_sample[data_sample['participant_id'].isin(timepoints)]
-        random.seed(seed)
-        sampled_list = random.sample(list(data_sample['participant_id']), N_samples)
-        data_sample = data_sample[data_sample['participant_id'].isin(sampled_list)]
-        
+        n_participants = plotOptions.get('PARTICIPANTS', self.n_participants)
+        min_timepoints = plotOptions.get('TIMEPOINTS', self.min_timepoints)
+
         if not currentHue:
             currentHue = 'Sex'
 
+        data = datamodel.GetData(['participant_id',currentROI],
+                                 currentHue)
+        data = data[data[currentROI].notna() & data['Age'].notna()]
+
+        # group the rows by participant once, sorted by age within each
+        codes, participants = pd.factorize(data['participant_id'])
+        order = np.lexsort((data['Age'].to_numpy(), codes))
+        codes = codes[order]
+        valid = codes >= 0
+        order, codes = order[valid], codes[valid]
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        lengths = np.diff(np.r_[starts, codes.shape[0]])
+
+        # sample participants with enough timepoints
+        eligible = np.flatnonzero(lengths >= min_timepoints)
+        rng = np.random.RandomState(self.seed)
+        sampled = np.sort(rng.choice(eligible, min(n_participants, eligible.shape[0]), replace=False))
+        rows = np.concatenate([order[starts[i]:starts[i] + lengths[i]] for i in sampled] or [order[:0]])
+        data_sample = data.iloc[rows]
+
         # clear plot
+        self.RemoveScatterRenderer()
         self.axes.clear()
 
-        # longitudinal plot harmonized
-        _, ax = plt.subplots(1,1)
-        ax = sns.scatterplot(x='Age',y=currentROI,hue=currentHue,ax=self.axes,linewidth=1.5,s=50,data=data_sample)
-        for i in data_sample['participant_id']:
-            d = data_sample.index[data_sample['participant_id'] == i].tolist()
-            ax.plot(data_sample['Age'][d],data_sample[currentROI][d],c='0',linewidth=2)
+        if sampled.shape[0] == 0:
+            # Set error text on plot
+            self.axes.text(0.5,0.5,'No participants with %d or more timepoints.' % (min_timepoints),
+                           va='center', ha='center')
+            print('Plotting failed. No participants with %d or more timepoints.' % (min_timepoints))
+            self.draw()
+            return
+
+        # longitudinal plot harmonized, all trajectories as one collection
+        sns.scatterplot(x='Age',y=currentROI,hue=currentHue,ax=self.axes,linewidth=1.5,s=50,data=data_sample)
+        xy = np.column_stack((data_sample['Age'].to_numpy(dtype=np.float64),
+                              data_sample[currentROI].to_numpy(dtype=np.float64)))
+        segments = np.split(xy, np.cumsum(lengths[sampled])[:-1])
+        self.axes.add_collection(LineCollection(segments, colors='0', linewidths=2))
+        self.axes.autoscale_view()
 
         # Set ROI name as y-label if applicable
         _, MUSEDictIDtoNAME = datamodel.GetMUSEDictionaries()
@@ -176,4 +216,5 @@ class PlotCanvas(FigureCanvas):
 
     def Reset(self):
         """Remove all plots"""
+        self.RemoveScatterRenderer()
         self.axes.clear()
@@ -0,0 +1,363 @@
+# This Python file uses the following encoding: utf-8
+"""
+contact: software@cbica.upenn.edu
+Copyright (c) 2018 University of Pennsylvania. All rights reserved.
+Use of this source code is governed by license located in license file: https://github.com/CBICA/BrainChart/blob/main/LICENSE
+"""
+
+import numpy as np
+import pandas as pd
+from matplotlib.lines import Line2D
+
+
+class ScatterRenderer:
+    """Scatter plot with hue on an axes whose artists are kept between
+    updates.
+
+    The points are one `PathCollection` per hue level whose offsets are
+    replaced by `Update`, so the axes are never cleared and no seaborn
+    mapping runs. Collections of one color are drawn with the fast marker
+    path of the renderer. The points and curves are animated artists: they
+    are drawn after the rest of the figure on every draw (also when saving
+    the figure), and updates that do not change limits, labels or legend are
+    blitted onto the cached background.
+
+    With more than `density_threshold` points a level of detail rendering is
+    used: 2-D histograms of the number of points and of the sum of their
+    colors are computed once at `max_bins` x `max_bins` and at halved
+    resolutions, so memory does not depend on the number of hue levels.
+    Every draw shows the resolution with about `bins` bins across the
+    visible range, colored by the mean color of the points and shaded by
+    their number, or
+    the points themselves if at most `density_threshold` points are visible.
+    So zoom and pan stay interactive with millions of points."""
+
+    def __init__(self, axes, size=5, density_threshold=200000, bins=256, max_bins=1024,
+                 palette=None, edgecolor='w', linewidth=None, max_legend=30):
+        """The constructor. `palette` replaces the colors of the color cycle
+        and `edgecolor` and `linewidth` the marker edges of seaborn. The
+        legend shows at most `max_legend` hue levels."""
+        self.axes = axes
+        self.size = size
+        self.density_threshold = density_threshold
+        self.bins = bins
+        self.max_bins = max_bins
+        self.palette = palette
+        self.edgecolor = edgecolor
+        self.linewidth = .08 * np.sqrt(size) if linewidth is None else linewidth
+        self.max_legend = max_legend
+        self.collections = []
+        self.image = axes.imshow(np.zeros((1, 1, 4)), origin='lower', aspect='auto',
+                                 interpolation='nearest', animated=True, visible=False)
+        self.curves = []
+        self.background = None
+        self.state = None
+        self.points = np.empty((0, 2))
+        self.codes = np.empty((0,), dtype=np.intp)
+        self.colors = np.empty((0, 4))
+        # Points of each hue level
+        self.levels = []
+        # Histograms from `max_bins` to the coarsest resolution and their extent
+        self.pyramid = None
+        self.extent = None
+        self.view = None
+        self.canvas = None
+        self.cid = None
+        self.Connect()
+
+
+    def Connect(self):
+        """Connects to the draw events of the canvas of the figure, again if
+        the figure was moved to another canvas."""
+        canvas = self.axes.figure.canvas
+        if canvas is self.canvas:
+            return
+        if self.canvas is not None:
+            self.canvas.mpl_disconnect(self.cid)
+        self.canvas = canvas
+        self.background = None
+        self.cid = canvas.mpl_connect('draw_event', self.OnDraw)
+
+
+    def Update(self, x, y, hue=None, xlabel=None, ylabel=None, hue_label=None, curves=()):
+        """Shows the points (`x`, `y`) colored by the levels of `hue` and
+        the `curves`, a list of (x, y, line properties). Rows with missing
+        values are not shown."""
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        valid = np.isfinite(x) & np.isfinite(y)
+        if hue is None:
+            codes, levels = np.zeros(x.shape, dtype=np.intp), []
+        else:
+            codes, levels = self.GetLevels(hue)
+            valid &= codes >= 0
+        self.points = np.column_stack((x[valid], y[valid]))
+        self.codes = codes[valid]
+        self.colors = self.GetPalette(max(len(levels), 1))
+        self.SplitLevels()
+
+        for line in self.curves:
+            line.remove()
+        self.curves = [self.axes.plot(cx, cy, animated=True, **props)[0]
+                       for cx, cy, props in curves]
+
+        limits = self.GetLimits()
+        self.axes.set_xlim(limits[0])
+        self.axes.set_ylim(limits[1])
+        self.BuildPyramid(limits)
+        self.SetView(limits)
+
+        state = (limits, xlabel, ylabel, hue_label, tuple(levels))
+        if state != self.state:
+            self.axes.set_xlabel(xlabel or '')
+            self.axes.set_ylabel(ylabel or '')
+            self.SetLegend(levels, hue_label, self.GetLegendLocation(limits))
+            self.state = state
+            self.Redraw(full=True)
+        else:
+            self.Redraw()
+
+
+    def GetCollection(self, i):
+        """Returns the collection of hue level `i`, created on first use."""
+        while len(self.collections) <= i:
+            # Same marker style as seaborn's scatterplot
+            self.collections.append(
+                self.axes.scatter(np.empty(0), np.empty(0), s=self.size, edgecolors=self.edgecolor,
+                                  linewidths=self.linewidth, animated=True))
+        return self.collections[i]
+
+
+    def GetLevels(self, hue):
+        """Returns the level of each row (-1 if missing) and the levels of
+        `hue` in the order seaborn uses: categories, sorted numbers or the
+        order of appearance."""
+        hue = pd.Series(hue)
+        if hue.dtype.name == 'category':
+            levels = list(hue.cat.categories)
+            codes = hue.cat.codes.to_numpy().astype(np.intp)
+        else:
+            codes, levels = pd.factorize(hue, sort=pd.api.types.is_numeric_dtype(hue))
+            levels = list(levels)
+        return codes, levels
+
+
+    def GetPalette(self, n):
+        """Returns `n` colors (RGBA) of the palette or the current color
+        cycle."""
+        import matplotlib.colors as mcolors
+        import matplotlib as mpl
+        cycle = self.palette
+        if cycle is None:
+            cycle = mpl.rcParams['axes.prop_cycle'].by_key().get('color', ['C0'])
+        return mcolors.to_rgba_array([cycle[i % len(cycle)] for i in range(n)])
+
+
+    def SplitLevels(self):
+        """Splits the points by hue level, keeping the order of the rows."""
+        if self.colors.shape[0] == 1:
+            self.levels = [self.points]
+            return
+        order = np.argsort(self.codes, kind='stable')
+        bounds = np.searchsorted(self.codes[order], np.arange(self.colors.shape[0] + 1))
+        self.levels = [self.points[order[a:b]] for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+    def GetLimits(self):
+        """Returns the x and y limits of the points and curves with the
+        default margins of matplotlib. Missing and infinite values are
+        ignored; an axis without any finite value keeps its current limits."""
+        xy = [(self.points[:, 0], self.points[:, 1])] + [line.get_data() for line in self.curves]
+        xy = [(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)) for x, y in xy]
+        if sum(x.shape[0] for x, _ in xy) == 0:
+            return ((0., 1.), (0., 1.))
+        current = (self.axes.get_xlim(), self.axes.get_ylim())
+        limits = []
+        for i in (0, 1):
+            values = [a[i][np.isfinite(a[i])] for a in xy]
+            values = [v for v in values if v.shape[0]]
+            if not values:
+                limits.append(tuple(current[i]))
+                continue
+            lo = min(v.min() for v in values)
+            hi = max(v.max() for v in values)
+            pad = (hi - lo) * 0.05 if hi > lo else 0.5
+            limits.append((lo - pad, hi + pad))
+        return tuple(limits)
+
+
+    def BuildPyramid(self, limits):
+        """Computes the histograms of the sums of the red, green and blue of
+        the points and of their number (4 x bins x bins) over `limits` if
+        there are more points than the density threshold."""
+        self.view = None
+        if self.density_threshold is None or self.points.shape[0] <= self.density_threshold:
+            self.pyramid = None
+            return
+        (x0, x1), (y0, y1) = limits
+        bins = self.max_bins
+        ix = np.floor((self.points[:, 0] - x0) / (x1 - x0) * bins).astype(np.intp)
+        iy = np.floor((self.points[:, 1] - y0) / (y1 - y0) * bins).astype(np.intp)
+        np.clip(ix, 0, bins - 1, out=ix)
+        np.clip(iy, 0, bins - 1, out=iy)
+        flat = iy * bins + ix
+        # float32 counts are exact up to 2**24 points per bin
+        counts = np.empty((4, bins, bins), dtype=np.float32)
+        counts[3] = np.bincount(flat, minlength=bins * bins).reshape(bins, bins)
+        for c in range(3):
+            counts[c] = np.bincount(flat, weights=self.colors[self.codes, c],
+                                    minlength=bins * bins).reshape(bins, bins)
+
+        self.pyramid = [counts]
+        while bins > 16 and bins % 2 == 0:
+            bins //= 2
+            counts = counts.reshape(4, bins, 2, bins, 2).sum(axis=(2, 4))
+            self.pyramid.append(counts)
+        self.extent = limits
+
+
+    def SetView(self, view):
+        """Shows the points within the view limits ((x0, x1), (y0, y1)) as
+        markers or as histogram of a suitable resolution."""
+        view = tuple(tuple(float(v) for v in sorted(lim)) for lim in view)
+        if view == self.view:
+            return
+        self.view = view
+
+        if self.pyramid is None:
+            levels = self.levels
+            self.image.set_visible(False)
+        else:
+            (x0, x1), (y0, y1) = view
+            inside = [(p[:, 0] >= x0) & (p[:, 0] <= x1) & (p[:, 1] >= y0) & (p[:, 1] <= y1)
+                      for p in self.levels]
+            if sum(np.count_nonzero(m) for m in inside) > self.density_threshold:
+                # Only the image is drawn, the collections are hidden
+                levels = []
+                self.SetImage(view)
+            else:
+                # Few points in view, only these are drawn
+                levels = [p[m] for p, m in zip(self.levels, inside)]
+                self.image.set_visible(False)
+
+        for collection in self.collections[len(levels):]:
+            collection.set_visible(False)
+        for i, points in enumerate(levels):
+            collection = self.GetCollection(i)
+            collection.set_visible(points.shape[0] > 0)
+            collection.set_offsets(points)
+            collection.set_facecolor(self.colors[i])
+
+
+    def SetImage(self, view):
+        """Shows the histogram with about `bins` bins across `view`."""
+        (X0, X1), (Y0, Y1) = self.extent
+        (x0, x1), (y0, y1) = view
+        # Coarsest resolution with enough bins across the view
+        for counts in self.pyramid[::-1]:
+            bins = counts.shape[1]
+            if min((x1 - x0) / (X1 - X0), (y1 - y0) / (Y1 - Y0)) * bins >= self.bins:
+                break
+        else:
+            counts = self.pyramid[0]
+            bins = counts.shape[1]
+
+        dx, dy = (X1 - X0) / bins, (Y1 - Y0) / bins
+        ix0, ix1 = np.clip([np.floor((x0 - X0) / dx), np.ceil((x1 - X0) / dx)], 0, bins).astype(int)
+        iy0, iy1 = np.clip([np.floor((y0 - Y0) / dy), np.ceil((y1 - Y0) / dy)], 0, bins).astype(int)
+        if ix1 <= ix0 or iy1 <= iy0:
+            self.image.set_visible(False)
+            return
+        self.image.set_data(self.GetDensity(counts[:, iy0:iy1, ix0:ix1]))
+        self.image.set_extent((X0 + ix0 * dx, X0 + ix1 * dx, Y0 + iy0 * dy, Y0 + iy1 * dy))
+        self.image.set_visible(True)
+
+
+    def GetDensity(self, counts):
+        """Returns the histogram `counts` (color sums and number of points x
+        rows x columns, see `BuildPyramid`) as RGBA image: the mean color of
+        the points in each bin with opacity increasing with the logarithm of
+        their number."""
+        counts = counts.astype(np.float64)
+        total = counts[3]
+
+        image = np.zeros(total.shape + (4,))
+        filled = total > 0
+        if filled.any():
+            image[filled, :3] = counts[:3, filled].T / total[filled, np.newaxis]
+            image[filled, 3] = 0.2 + 0.8 * np.log1p(total[filled]) / np.log1p(total.max())
+        return image
+
+
+    def GetLegendLocation(self, limits):
+        """Returns the corner of the axes with the fewest points. matplotlib's
+        `best` location tests every point on every draw."""
+        (x0, x1), (y0, y1) = limits
+        u = (self.points[:, 0] - x0) / (x1 - x0)
+        v = (self.points[:, 1] - y0) / (y1 - y0)
+        counts = {'upper right': np.count_nonzero((u > 0.6) & (v > 0.6)),
+                  'upper left': np.count_nonzero((u < 0.4) & (v > 0.6)),
+                  'lower left': np.count_nonzero((u < 0.4) & (v < 0.4)),
+                  'lower right': np.count_nonzero((u > 0.6) & (v < 0.4))}
+        return min(counts, key=counts.get)
+
+
+    def SetLegend(self, levels, title, loc='best'):
+        """Shows a legend of the hue levels, like seaborn's. With more than
+        `max_legend` levels only the first ones are listed, e.g. for a hue
+        like participant_id."""
+        legend = self.axes.get_legend()
+        if legend is not None:
+            legend.remove()
+        if len(levels) == 0:
+            return
+        handles = [Line2D([], [], linestyle='', marker='o', markersize=np.sqrt(self.size),
+                          markerfacecolor=color, markeredgecolor=self.edgecolor,
+                          markeredgewidth=self.linewidth)
+                   for color in self.colors[:self.max_legend]]
+        labels = [str(level) for level in levels[:self.max_legend]]
+        if len(levels) > self.max_legend:
+            handles.append(Line2D([], [], linestyle=''))
+            labels.append('... %d more' % (len(levels) - self.max_legend))
+        self.axes.legend(handles, labels, title=title, loc=loc)
+
+
+    def GetAnimated(self):
+        """Returns the animated artists in drawing order."""
+        return [a for a in [self.image] + self.collections + self.curves if a.get_visible()]
+
+
+    def OnDraw(self, event):
+        """Caches the background of a full draw and draws the animated
+        artists on top of it, at the level of detail of the current view."""
+        canvas = self.axes.figure.canvas
+        if event.canvas is canvas and hasattr(canvas, 'copy_from_bbox'):
+            self.background = canvas.copy_from_bbox(self.axes.bbox)
+        self.SetView((self.axes.get_xlim(), self.axes.get_ylim()))
+        for artist in self.GetAnimated():
+            artist.draw(event.renderer)
+
+
+    def Redraw(self, full=False):
+        """Redraws the figure, only the animated artists if the background
+        is still valid."""
+        canvas = self.axes.figure.canvas
+        if full or self.background is None or not hasattr(canvas, 'restore_region'):
+            canvas.draw_idle()
+            return
+        canvas.restore_region(self.background)
+        for artist in self.GetAnimated():
+            self.axes.draw_artist(artist)
+        canvas.blit(self.axes.bbox)
+
+
+    def Remove(self):
+        """Removes the artists, also after the axes were cleared, and
+        disconnects from the canvas."""
+        self.canvas.mpl_disconnect(self.cid)
+        children = self.axes.get_children()
+        for artist in [self.image] + self.collections + self.curves:
+            if artist in children:
+                artist.remove()
+        self.collections = []
+        self.curves = []
@@ -0,0 +1,475 @@
+# This Python file uses the following encoding: utf-8
+"""
+contact: software@cbica.upenn.edu
+Copyright (c) 2018 University of Pennsylvania. All rights reserved.
+Use of this source code is governed by license located in license file: https://github.com/CBICA/BrainChart/blob/main/LICENSE
+"""
+
+import pandas as pd
+import numpy as np
+import os
+import multiprocessing as mp
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+from sklearn.base import BaseEstimator, ClassifierMixin, RegressorMixin, is_regressor
+from sklearn.metrics.pairwise import pairwise_kernels
+from sklearn.preprocessing import StandardScaler
+
+
+class SPAREEnsemble:
+    """Fold ensemble of a SPARE-* model prepared for scoring.
+
+    The model is the dictionary stored in the SPARE-* model file with the
+    fields `predictors`, `scaler`, `svm`, `train` and `validation` (and
+    `bias_ints`/`bias_slopes` for SPARE-BA). `kind` is either 'BrainAge' or
+    'AD'.
+
+    If all folds are linear SVMs on standardized predictors, scaler, SVM and
+    bias correction are folded into one weight matrix (predictors x folds)
+    so all folds are scored with one matrix product. Other models are
+    scored fold by fold."""
+
+    def __init__(self, model, kind, compile_linear=True):
+        """The constructor."""
+        self.model = model
+        self.kind = kind
+        self.predictors = list(model['predictors'])
+        self.n_folds = len(model['scaler'])
+        # Participants used for training of any fold, hashed once
+        self.train = pd.Index(np.concatenate(model['train'])).unique()
+        self.validation = [pd.Index(v).unique() for v in model['validation']]
+        self.weights = None
+        self.intercepts = None
+        if compile_linear:
+            self.CompileLinear()
+
+
+    def __getstate__(self):
+        """Models read from a bundle are not copied to worker processes,
+        the workers map the bundle themselves."""
+        state = self.__dict__.copy()
+        if 'bundle' in self.model:
+            state['model'] = {'bundle': self.model['bundle']}
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if list(self.model) == ['bundle']:
+            models = ReadSPAREBundle(self.model['bundle'], verify=False)
+            self.model = models[0] if self.kind == 'BrainAge' else models[1]
+
+
+    def IsLinear(self):
+        """Checks if the linear fast path is available."""
+        return self.weights is not None
+
+
+    def CompileLinear(self):
+        """Folds scaler, linear SVM and bias correction of every fold into
+        `weights` and `intercepts`. Leaves both as None if any fold is not
+        linear."""
+        weights = np.empty((len(self.predictors), self.n_folds))
+        intercepts = np.empty((self.n_folds,))
+
+        for i in range(self.n_folds):
+            scaler = self.model['scaler'][i]
+            svm = self.model['svm'][i]
+            if not isinstance(scaler, StandardScaler):
+                return
+            if getattr(svm, 'kernel', 'linear') != 'linear' or not hasattr(svm, 'coef_'):
+                return
+            if self.kind == 'BrainAge' and not is_regressor(svm):
+                return
+            if self.kind == 'AD' and not hasattr(svm, 'decision_function'):
+                return
+            coef = np.atleast_2d(np.asarray(svm.coef_, dtype=np.float64))
+            if coef.shape[0] != 1:
+                # Multi-class decision functions are not a single projection
+                return
+
+            w = coef[0]
+            b = float(np.ravel(svm.intercept_)[0])
+
+            # Undo standardization: (x - mean) / scale
+            if scaler.scale_ is not None:
+                w = w / scaler.scale_
+            if scaler.mean_ is not None and scaler.with_mean:
+                b -= np.dot(scaler.mean_, w)
+
+            # Bias correction of SPARE-BA
+            if self.kind == 'BrainAge':
+                w = w / self.model['bias_slopes'][i]
+                b = (b - self.model['bias_ints'][i]) / self.model['bias_slopes'][i]
+
+            weights[:, i] = w
+            intercepts[i] = b
+
+        self.weights = weights
+        self.intercepts = intercepts
+
+
+    def GetPredictorMask(self, data):
+        """Returns the rows that have predictors available."""
+        return ~data[self.predictors[0]].isnull().values
+
+
+    def GetPredictors(self, data, idx):
+        """Returns the predictor block of the selected rows as contiguous
+        float64 array."""
+        X = data.loc[idx, self.predictors].to_numpy(dtype=np.float64)
+        return np.ascontiguousarray(X)
+
+
+    def GetFoldMembership(self, participant_id):
+        """Returns a boolean matrix (rows x folds) that is true where a row
+        is scored by a fold, i.e. the participant was not used for training
+        at all or belongs to the validation set of that fold."""
+        codes, uniques = pd.factorize(np.asarray(participant_id))
+
+        # Membership is evaluated on unique participants only. The extra row
+        # at the end is picked by the code -1 of missing participant IDs.
+        uniques = pd.Index(uniques).append(pd.Index([np.nan]))
+        test = np.empty((len(uniques), self.n_folds), dtype=bool)
+        not_train = ~uniques.isin(self.train)
+        for i, validation in enumerate(self.validation):
+            test[:, i] = not_train | uniques.isin(validation)
+
+        return test[codes]
+
+
+    def PredictFold(self, i, X):
+        """Returns the contribution of fold `i` for the predictors `X`."""
+        X = self.model['scaler'][i].transform(X)
+        if self.kind == 'BrainAge':
+            return ((self.model['svm'][i].predict(X) - self.model['bias_ints'][i])
+                    / self.model['bias_slopes'][i])
+        else:
+            return self.model['svm'][i].decision_function(X)
+
+
+    def Predict(self, data, progress=None, n_jobs=1, cancel=None):
+        """Returns the ensemble score for every row of `data`. Rows without
+        predictors are NaN. `progress` is called with the fold index after
+        each fold. With `n_jobs` other than 1 the folds of non-linear models
+        are evaluated in a process pool (-1 uses all CPUs). `cancel` is an
+        optional `threading.Event`; once it is set, no further folds are
+        evaluated and None is returned."""
+        idx = self.GetPredictorMask(data)
+        X = self.GetPredictors(data, idx)
+        test = self.GetFoldMembership(data['participant_id'].values[idx])
+
+        if self.IsLinear():
+            y_hat_test = self.PredictLinear(X, test)
+            if progress is not None:
+                for i in range(self.n_folds):
+                    progress(i)
+        elif n_jobs != 1:
+            y_hat_test = self.PredictFoldsParallel(X, test, n_jobs, progress, cancel)
+        else:
+            y_hat_test = self.PredictFolds(X, test, progress, cancel)
+
+        if y_hat_test is None:
+            return None
+
+        y_hat = np.full((data.shape[0],), np.nan)
+        y_hat[idx] = y_hat_test
+
+        return y_hat
+
+
+    def PredictLinear(self, X, test):
+        """Returns the ensemble score of all folds with one matrix product.
+        The folded weights round differently than scaler and SVM, so scores
+        differ from `PredictFolds` by about 1e-12; construct the ensemble
+        with `compile_linear=False` for identical scores."""
+        y = np.dot(X, self.weights)
+        y += self.intercepts
+        y[~test] = 0.
+        return y.sum(axis=1) / test.sum(axis=1)
+
+
+    def PredictFolds(self, X, test, progress=None, cancel=None):
+        """Returns the ensemble score by evaluating the folds one by one."""
+        y_hat_test = np.zeros((X.shape[0],))
+        n_ensembles = np.zeros((X.shape[0],))
+
+        for i in range(self.n_folds):
+            if cancel is not None and cancel.is_set():
+                return None
+            # Predict validation (fold) and test
+            rows = test[:, i]
+            if rows.any():
+                y_hat_test[rows] += self.PredictFold(i, X[rows])
+                n_ensembles[rows] += 1.
+            if progress is not None:
+                progress(i)
+
+        y_hat_test /= n_ensembles
+        return y_hat_test
+
+
+    def PredictFoldsParallel(self, X, test, n_jobs=-1, progress=None, cancel=None):
+        """Returns the ensemble score by evaluating the folds in a pool of
+        `n_jobs` processes. `X` is shared with the workers through shared
+        memory. Folds are split into row blocks if there are more workers
+        than folds. Contributions are summed in fold order, so the result is
+        identical to `PredictFolds`."""
+        if n_jobs is None or n_jobs < 1:
+            n_jobs = os.cpu_count()
+
+        # Tasks are (fold, row indices) with at least one task per worker
+        n_blocks = max(1, -(-n_jobs // self.n_folds))
+        tasks = []
+        for i in range(self.n_folds):
+            rows = np.flatnonzero(test[:, i])
+            if rows.size == 0:
+                continue
+            for block in np.array_split(rows, min(n_blocks, rows.size)):
+                tasks.append((i, block))
+
+        remaining = dict.fromkeys(range(self.n_folds), 0)
+        for i, _ in tasks:
+            remaining[i] += 1
+
+        X_shm = _ToSharedMemory(X)
+        results = [None] * len(tasks)
+        pool = ProcessPoolExecutor(max_workers=n_jobs,
+                                   mp_context=mp.get_context('spawn'),
+                                   initializer=_InitWorker,
+                                   initargs=(self, X_shm.name, X.shape, X.dtype.str))
+        cancelled = False
+        try:
+            futures = {}
+            for k, (i, block) in enumerate(tasks):
+                # Starting a worker process blocks, so check in between
+                if cancel is not None and cancel.is_set():
+                    cancelled = True
+                    return None
+                futures[pool.submit(_PredictBlock, i, block)] = k
+            pending = set(futures)
+            while pending:
+                finished, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                if cancel is not None and cancel.is_set():
+                    for future in pending:
+                        future.cancel()
+                    cancelled = True
+                    return None
+                for future in finished:
+                    k = futures[future]
+                    results[k] = future.result()
+                    i = tasks[k][0]
+                    remaining[i] -= 1
+                    if remaining[i] == 0 and progress is not None:
+                        progress(i)
+        finally:
+            # Do not wait for blocks that are still running after cancelling
+            pool.shutdown(wait=not cancelled)
+            X_shm.close()
+            X_shm.unlink()
+
+        # Merge deterministically in fold and block order
+        y_hat_test = np.zeros((X.shape[0],))
+        n_ensembles = np.zeros((X.shape[0],))
+        for (i, block), y in zip(tasks, results):
+            y_hat_test[block] += y
+        for i in range(self.n_folds):
+            n_ensembles[test[:, i]] += 1.
+
+        y_hat_test /= n_ensembles
+        return y_hat_test
+
+
+class _BundledSVM(BaseEstimator):
+    """SVM of a SPARE-* model bundle, evaluated from memory-mapped support
+    vectors and dual coefficients (kernel SVMs) or from the weights (linear
+    SVMs)."""
+
+    def __init__(self, kernel='linear', gamma=None, coef0=0., degree=3):
+        self.kernel = kernel
+        self.gamma = gamma
+        self.coef0 = coef0
+        self.degree = degree
+
+
+    @property
+    def coef_(self):
+        """Weights of linear SVMs."""
+        if hasattr(self, 'weights_'):
+            return self.weights_
+        if self.kernel == 'linear':
+            return np.dot(self.dual_coef_, self.support_vectors_)
+        raise AttributeError('coef_ is only available for linear kernels')
+
+
+    def _decision_function(self, X, chunksize=4096):
+        """Returns the value of the decision function for the rows of `X`.
+        Kernels are computed in chunks of `chunksize` rows."""
+        if hasattr(self, 'weights_'):
+            return np.dot(X, self.weights_[0]) + self.intercept_[0]
+
+        params = {'rbf': ('gamma',), 'poly': ('gamma', 'coef0', 'degree'),
+                  'sigmoid': ('gamma', 'coef0'), 'linear': ()}[self.kernel]
+        params = {p: getattr(self, p) for p in params}
+        y = np.empty((X.shape[0],))
+        for start in range(0, X.shape[0], chunksize):
+            K = pairwise_kernels(X[start:start + chunksize], self.support_vectors_,
+                                 metric=self.kernel, **params)
+            y[start:start + chunksize] = np.dot(K, self.dual_coef_[0]) + self.intercept_[0]
+        return y
+
+
+class BundledSVR(RegressorMixin, _BundledSVM):
+    """Support vector regression of a SPARE-* model bundle."""
+
+    def predict(self, X):
+        return self._decision_function(X)
+
+
+class BundledSVC(ClassifierMixin, _BundledSVM):
+    """Binary support vector classifier of a SPARE-* model bundle."""
+
+    def decision_function(self, X):
+        return self._decision_function(X)
+
+
+    def predict(self, X):
+        return np.asarray(self.classes_)[(self.decision_function(X) > 0).astype(int)]
+
+
+def SaveSPAREBundle(BrainAgeModel, ADModel, dirname, source=None):
+    """Saves SPARE-BA and SPARE-AD models as array bundle (see
+    `DataIO.SaveArrayBundle`, also for `source`). Scalers must be
+    `StandardScaler` and SVMs binary or regression SVMs with a linear, RBF,
+    polynomial or sigmoid kernel or linear models with `coef_`; other models
+    raise ValueError."""
+    from BrainChart.dataio import DataIO
+    arrays = {}
+    metadata = {}
+    for kind, model in (('BrainAge', BrainAgeModel), ('AD', ADModel)):
+        folds = []
+        for i, (scaler, svm) in enumerate(zip(model['scaler'], model['svm'])):
+            prefix = '%s_%d_' % (kind, i)
+            if not isinstance(scaler, StandardScaler):
+                raise ValueError('Fold %d of %s has no StandardScaler.' % (i, kind))
+            for a in ('mean_', 'scale_', 'var_'):
+                if getattr(scaler, a, None) is not None:
+                    arrays[prefix + 'scaler_' + a[:-1]] = np.asarray(getattr(scaler, a), dtype=np.float64)
+            fold = {'scaler': {'with_mean': scaler.with_mean, 'with_std': scaler.with_std,
+                               'n_features_in': int(scaler.n_features_in_)},
+                    'svm': {'estimator': 'regressor' if is_regressor(svm) else 'classifier'}}
+
+            if (hasattr(svm, 'support_vectors_') and
+                getattr(svm, 'kernel', None) in ('linear', 'rbf', 'poly', 'sigmoid')):
+                if np.shape(svm.dual_coef_)[0] != 1:
+                    raise ValueError('Fold %d of %s is not a binary or regression SVM.' % (i, kind))
+                arrays[prefix + 'support_vectors'] = np.asarray(svm.support_vectors_, dtype=np.float64)
+                arrays[prefix + 'dual_coef'] = np.asarray(svm.dual_coef_, dtype=np.float64)
+                fold['svm'].update({'kernel': svm.kernel, 'gamma': float(svm._gamma),
+                                    'coef0': float(svm.coef0), 'degree': int(svm.degree)})
+            elif hasattr(svm, 'coef_'):
+                if np.atleast_2d(svm.coef_).shape[0] != 1:
+                    raise ValueError('Fold %d of %s is not a binary or regression model.' % (i, kind))
+                arrays[prefix + 'weights'] = np.atleast_2d(np.asarray(svm.coef_, dtype=np.float64))
+                fold['svm'].update({'kernel': 'linear'})
+            else:
+                raise ValueError('Fold %d of %s (%s) can not be stored as bundle.'
+                                 % (i, kind, type(svm).__name__))
+            arrays[prefix + 'intercept'] = np.atleast_1d(np.asarray(svm.intercept_, dtype=np.float64))
+            if hasattr(svm, 'classes_'):
+                fold['svm']['classes'] = np.asarray(svm.classes_).tolist()
+            folds.append(fold)
+
+        # Participants of all folds in one array each, split by offsets
+        for field in ('train', 'validation'):
+            ids = [np.asarray(p) for p in model[field]]
+            ids_all = np.concatenate(ids) if ids else np.empty((0,))
+            if ids_all.dtype.hasobject:
+                # Strings or numbers as fixed size array that can be mapped
+                ids_all = np.array(ids_all.tolist())
+            arrays[kind + '_' + field] = ids_all
+            arrays[kind + '_' + field + '_offsets'] = np.cumsum([len(p) for p in ids])[:-1]
+        if kind == 'BrainAge':
+            arrays[kind + '_bias_ints'] = np.asarray(model['bias_ints'], dtype=np.float64)
+            arrays[kind + '_bias_slopes'] = np.asarray(model['bias_slopes'], dtype=np.float64)
+        metadata[kind] = {'predictors': list(model['predictors']), 'folds': folds}
+
+    DataIO().SaveArrayBundle(dirname, arrays, metadata, 'SPARE', source)
+
+
+def ReadSPAREBundle(dirname, verify=True):
+    """Returns the SPARE-BA and SPARE-AD models of an array bundle. All
+    arrays are memory-mapped, so the bundle loads without copying support
+    vectors and processes reading the same bundle share its pages. The
+    models hold the bundle name in the field `bundle`."""
+    from BrainChart.dataio import DataIO
+    if os.path.basename(dirname) == 'manifest.json':
+        dirname = os.path.dirname(dirname)
+    arrays, metadata = DataIO().ReadArrayBundle(dirname, 'SPARE', verify=verify)
+
+    models = []
+    for kind in ('BrainAge', 'AD'):
+        model = {'predictors': metadata[kind]['predictors'], 'scaler': [], 'svm': [],
+                 'bundle': dirname}
+        for i, fold in enumerate(metadata[kind]['folds']):
+            prefix = '%s_%d_' % (kind, i)
+            scaler = StandardScaler(with_mean=fold['scaler']['with_mean'],
+                                    with_std=fold['scaler']['with_std'])
+            for a in ('mean_', 'scale_', 'var_'):
+                setattr(scaler, a, arrays.get(prefix + 'scaler_' + a[:-1]))
+            scaler.n_features_in_ = fold['scaler']['n_features_in']
+            model['scaler'].append(scaler)
+
+            params = fold['svm']
+            if params['estimator'] == 'regressor':
+                svm = BundledSVR(params['kernel'], params.get('gamma'),
+                                 params.get('coef0', 0.), params.get('degree', 3))
+            else:
+                svm = BundledSVC(params['kernel'], params.get('gamma'),
+                                 params.get('coef0', 0.), params.get('degree', 3))
+            if prefix + 'weights' in arrays:
+                svm.weights_ = arrays[prefix + 'weights']
+            else:
+                svm.support_vectors_ = arrays[prefix + 'support_vectors']
+                svm.dual_coef_ = arrays[prefix + 'dual_coef']
+            svm.intercept_ = arrays[prefix + 'intercept']
+            if 'classes' in params:
+                svm.classes_ = np.asarray(params['classes'])
+            model['svm'].append(svm)
+
+        for field in ('train', 'validation'):
+            model[field] = np.split(arrays[kind + '_' + field], arrays[kind + '_' + field + '_offsets'])
+        if kind == 'BrainAge':
+            model['bias_ints'] = arrays[kind + '_bias_ints']
+            model['bias_slopes'] = arrays[kind + '_bias_slopes']
+        models.append(model)
+
+    return models[0], models[1]
+
+
+def _ToSharedMemory(a):
+    """Returns a shared memory block holding a copy of array `a`."""
+    shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+    np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+    return shm
+
+
+# State of a worker process of `PredictFoldsParallel`
+_worker = {}
+
+
+def _InitWorker(ensemble, X_name, X_shape, X_dtype):
+    """Attaches a worker process to the shared predictors."""
+    try:
+        shm = shared_memory.SharedMemory(name=X_name)
+    except FileNotFoundError:
+        # The computation was cancelled before this worker started
+        return
+    _worker['X_shm'] = shm
+    _worker['X'] = np.ndarray(X_shape, dtype=X_dtype, buffer=shm.buf)
+    _worker['ensemble'] = ensemble
+
+
+def _PredictBlock(i, rows):
+    """Returns the contribution of fold `i` for the given rows."""
+    return _worker['ensemble'].PredictFold(i, _worker['X'][rows])
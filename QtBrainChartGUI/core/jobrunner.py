@@ -0,0 +1,238 @@
+# This Python file uses the following encoding: utf-8
+"""
+contact: software@cbica.upenn.edu
+Copyright (c) 2018 University of Pennsylvania. All rights reserved.
+Use of this source code is governed by license located in license file: https://github.com/CBICA/BrainChart/blob/main/LICENSE
+"""
+
+from PyQt5 import QtCore, QtWidgets
+import threading
+import traceback
+import os
+
+
+class Job(QtCore.QObject):
+    """A callable that runs on the thread pool of a `JobRunner`.
+
+    The callable is invoked as `fn(job, *args, **kwargs)` so it can report
+    progress with `job.Progress`, poll `job.IsCancelled` and store partial
+    results in `job.checkpoint`. The checkpoint survives `JobRunner.Resume`,
+    so a resumed job can skip the work it has already done. Connect to the
+    signals before submitting the job."""
+
+    progress = QtCore.pyqtSignal(str, int)
+    done = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(str)
+    cancelled = QtCore.pyqtSignal()
+    state_changed = QtCore.pyqtSignal(str)
+
+    def __init__(self, name, fn, args=(), kwargs=None, maximum=0):
+        """The constructor."""
+        super(Job, self).__init__()
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs if kwargs is not None else {}
+        # Range of the progress values, 0 if unknown
+        self.maximum = maximum
+        self.value = 0
+        self.text = ''
+        self.state = 'queued'
+        self.checkpoint = {}
+        self.cancel = threading.Event()
+        self.lock = threading.Lock()
+        # Incremented on resume so stale runnables in the queue do nothing
+        self.generation = 0
+
+
+    def Progress(self, txt, value):
+        """Reports progress, may be called from the worker thread."""
+        self.text = txt
+        self.value = value
+        self.progress.emit(txt, value)
+
+
+    def Cancel(self):
+        """Requests the job to stop, the callable has to poll `IsCancelled`."""
+        with self.lock:
+            self.cancel.set()
+            queued = self.state == 'queued'
+            if queued:
+                self.state = 'cancelled'
+        if queued:
+            self.state_changed.emit('cancelled')
+            self.cancelled.emit()
+
+
+    def IsCancelled(self):
+        """Checks if cancellation was requested."""
+        return self.cancel.is_set()
+
+
+    def SetState(self, state):
+        """Setter for the job state"""
+        self.state = state
+        self.state_changed.emit(state)
+
+
+    def Run(self, generation):
+        """Runs the callable and emits the outcome. Called by the pool."""
+        with self.lock:
+            if self.IsCancelled() or generation != self.generation:
+                return
+            self.state = 'running'
+        self.state_changed.emit('running')
+        try:
+            result = self.fn(self, *self.args, **self.kwargs)
+        except Exception as e:
+            traceback.print_exc()
+            self.SetState('failed')
+            self.failed.emit(str(e))
+            return
+
+        if self.IsCancelled():
+            self.SetState('cancelled')
+            self.cancelled.emit()
+        else:
+            self.SetState('done')
+            self.done.emit(result)
+
+
+class JobRunnable(QtCore.QRunnable):
+    """Adapter that runs a `Job` on a `QThreadPool`."""
+
+    def __init__(self, job):
+        super(JobRunnable, self).__init__()
+        self.job = job
+        self.generation = job.generation
+
+    def run(self):
+        self.job.Run(self.generation)
+
+
+class JobRunner(QtCore.QObject):
+    """Runs jobs on a bounded thread pool so the event loop never blocks.
+
+    Jobs doing heavy numerical work should release the GIL or use process
+    pools themselves (e.g. `SPAREEnsemble.Predict` with `n_jobs`)."""
+
+    job_added = QtCore.pyqtSignal(object)
+
+    def __init__(self, max_workers=None):
+        """The constructor."""
+        super(JobRunner, self).__init__()
+        self.pool = QtCore.QThreadPool()
+        if max_workers is None:
+            max_workers = max(2, os.cpu_count() // 2)
+        self.pool.setMaxThreadCount(max_workers)
+        self.jobs = []
+
+
+    def Submit(self, job):
+        """Queues `job` and returns it."""
+        self.jobs.append(job)
+        self.job_added.emit(job)
+        self.pool.start(JobRunnable(job))
+        return job
+
+
+    def Resume(self, job):
+        """Queues a cancelled or failed job again, keeping its checkpoint."""
+        with job.lock:
+            if job.state not in ('cancelled', 'failed'):
+                return
+            job.cancel.clear()
+            job.generation += 1
+            job.state = 'queued'
+        job.state_changed.emit('queued')
+        self.pool.start(JobRunnable(job))
+
+
+    def CancelAll(self):
+        """Requests all unfinished jobs to stop."""
+        for job in self.jobs:
+            if job.state in ('queued', 'running'):
+                job.Cancel()
+
+
+    def ClearFinished(self):
+        """Forgets jobs that are done."""
+        self.jobs = [job for job in self.jobs if job.state != 'done']
+
+
+class JobQueuePanel(QtWidgets.QWidget):
+    """Lists the jobs of a `JobRunner` with progress and cancel/resume
+    buttons."""
+
+    def __init__(self, jobrunner, parent=None):
+        super(JobQueuePanel, self).__init__(parent)
+        self.jobrunner = jobrunner
+        self.rows = {}
+
+        self.table = QtWidgets.QTableWidget(0, 4, self)
+        self.table.setHorizontalHeaderLabels(['Job', 'Status', 'Progress', ''])
+        self.table.horizontalHeader().setSectionResizeMode(0, QtWidgets.QHeaderView.Stretch)
+        self.table.verticalHeader().hide()
+        self.clearBtn = QtWidgets.QPushButton('Clear finished', self)
+
+        self.setLayout(QtWidgets.QVBoxLayout())
+        self.layout().addWidget(self.table)
+        self.layout().addWidget(self.clearBtn)
+
+        self.jobrunner.job_added.connect(self.OnJobAdded)
+        self.clearBtn.clicked.connect(lambda: self.OnClearFinished())
+
+
+    def OnJobAdded(self, job):
+        row = self.table.rowCount()
+        self.table.insertRow(row)
+        self.table.setItem(row, 0, QtWidgets.QTableWidgetItem(job.name))
+        self.table.setItem(row, 1, QtWidgets.QTableWidgetItem(job.state))
+        progressBar = QtWidgets.QProgressBar()
+        progressBar.setRange(0, job.maximum)
+        self.table.setCellWidget(row, 2, progressBar)
+        button = QtWidgets.QPushButton('Cancel')
+        button.clicked.connect(lambda: self.OnButtonClicked(job))
+        self.table.setCellWidget(row, 3, button)
+        self.rows[job] = (self.table.item(row, 1), progressBar, button)
+
+        job.progress.connect(lambda txt, vl: self.OnJobProgress(job, txt, vl))
+        job.state_changed.connect(lambda state: self.OnJobStateChanged(job, state))
+
+
+    def OnJobProgress(self, job, txt, vl):
+        if job not in self.rows:
+            return
+        _, progressBar, _ = self.rows[job]
+        progressBar.setValue(vl)
+        progressBar.setToolTip(txt)
+
+
+    def OnJobStateChanged(self, job, state):
+        if job not in self.rows:
+            return
+        status, progressBar, button = self.rows[job]
+        status.setText(state)
+        if state == 'done':
+            progressBar.setRange(0, max(job.maximum, 1))
+            progressBar.setValue(progressBar.maximum())
+            button.setEnabled(False)
+        elif state in ('cancelled', 'failed'):
+            button.setText('Resume')
+        else:
+            button.setText('Cancel')
+            button.setEnabled(True)
+
+
+    def OnButtonClicked(self, job):
+        if job.state in ('cancelled', 'failed'):
+            self.jobrunner.Resume(job)
+        else:
+            job.Cancel()
+
+
+    def OnClearFinished(self):
+        self.jobrunner.ClearFinished()
+        for job in [job for job in self.rows if job.state == 'done']:
+            status, _, _ = self.rows.pop(job)
+            self.table.removeRow(status.row())
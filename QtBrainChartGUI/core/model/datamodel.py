@@ -8,7 +8,7 @@ Use of this source code is governed by license located in license file: https://
 import pandas as pd
 import numpy as np
 from BrainChart.dataio import DataIO
-import neuroHarmonize as nh
+from BrainChart.normative import NormativeModel
 import importlib.resources as pkg_resources
 import sys
 import joblib
@@ -18,11 +18,20 @@ from PyQt5 import QtCore
 class DataModel(QObject):
     """This class holds the data model."""
 
-    data_changed = QtCore.Signal()
+    data_changed = pyqtSignal()
+    # Status text, e.g. while all columns of a data store are loaded
+    status = pyqtSignal(str)
 
     def __init__(self):
         QObject.__init__(self)
         """The constructor."""
+        # Lazily loaded columns of the data, see `SetDataStore`
+        self.store = None
+        # Bytes of lazily loaded columns kept in memory
+        self.memory_budget = 1 << 30
+        # Absolute tolerance of float32 columns at ingestion, None keeps the
+        # data types, see `DataIO.OptimizeDataTypes`
+        self.dtype_tolerance = None
         self.data = None
         self.harmonization_model = None
         self.MUSEDictNAMEtoID = None
@@ -32,6 +41,23 @@ class DataModel(QObject):
         self.SPAREModel = None
         self.BrainAgeModel = None
         self.ADModel = None
+        # Normative curves of all ROIs by (model, age grid, Sex, ICV)
+        self.normative_cache = {}
+        self.normative_model = None
+        # Incremented on every change of the data, see `GetDataVersion`
+        self.data_version = 0
+        self.data_changed.connect(self.OnDataChanged)
+
+
+    def OnDataChanged(self):
+        """Counts the changes of the data."""
+        self.data_version += 1
+
+
+    def GetDataVersion(self):
+        """Returns the number of changes of the data, e.g. to key cached
+        plots."""
+        return self.data_version
 
 
     def SetMUSEDictionaries(self, MUSEDictNAMEtoID, MUSEDictIDtoNAME):
@@ -71,9 +97,87 @@ class DataModel(QObject):
         self.data_changed.emit()
 
 
+    def SetDataStore(self,store):
+        """Setter for data whose columns are loaded on first access from a
+        `BrainChart.columnstore.ColumnStore`"""
+        self.data = None
+        self.store = store
+        self.data_changed.emit()
+
+
+    @property
+    def data(self):
+        """The data frame. With a data store all columns are loaded on first
+        access, use `GetColumns` to load only some of them."""
+        if self._data is None and self.store is not None:
+            self.status.emit('Loading all columns of %s' % (self.store.filename))
+            self._data = self.store.Materialize()
+            self.store = None
+        return self._data
+
+
+    @data.setter
+    def data(self,d):
+        self._data = d
+        self.store = None
+
+
+    def GetDataLoader(self):
+        """Returns a function that returns the data frame and may run on a
+        worker thread. With a data store it loads all columns without
+        changing the data model, see `SetLoadedData`."""
+        if self._data is None and self.store is not None:
+            return self.store.Materialize
+        data = self._data
+        return lambda: data
+
+
+    def SetLoadedData(self,store,d):
+        """Keeps the data frame `d` that a function of `GetDataLoader` loaded
+        from `store`, unless the data was replaced meanwhile."""
+        if self._data is None and self.store is store:
+            self.data = d
+
+
+    def SetMemoryBudget(self,nbytes):
+        """Setter for the bytes of lazily loaded columns kept in memory"""
+        self.memory_budget = nbytes
+        if self.store is not None:
+            self.store.memory_budget = nbytes
+            self.store.Evict()
+
+
+    def IsLazy(self):
+        """Checks if the columns of the data are loaded on first access."""
+        return self.store is not None
+
+
+    def GetColumns(self,columns):
+        """Returns the selected columns of the data."""
+        if self.IsLazy():
+            return self.store.GetColumns(columns)
+        return self.data[list(columns)]
+
+
+    def GetDataIndex(self):
+        """Returns the row index of the data."""
+        if self.IsLazy():
+            return self.store.index
+        return self.data.index
+
+
+    def GetDataShape(self):
+        """Returns the number of rows and columns of the data."""
+        if self.IsLazy():
+            return self.store.GetShape()
+        return self.data.shape
+
+
     def SetHarmonizationModel(self,m):
         """Setter for neuroHarmonize model"""
         self.harmonization_model = m
+        self.normative_cache.clear()
+        self.normative_model = None
 
 
     def SetSPAREModel(self,BrainAgeModel, ADModel):
@@ -93,32 +197,46 @@ class DataModel(QObject):
         return self.harmonization_model
 
 
-    def GetNormativeRange(self,roi):
+    def GetNormativeRange(self,roi,sex=0,icv=1450000,age=(25,95,200)):
         """Return normative range"""
-        
-        # Constructig the visualization of the normative range based on GAM
-        # model
-        covariates = pd.DataFrame(np.linspace(25, 95, 200), columns=['Age'])
-        # Fix ICV roughly to population average
-        covariates['ICV'] = 1450000 # mean ICV
-        # Fix Sex variable
-        covariates['Sex'] = 0
-        # No need to specify site, but column with name `SITE` must exist
-        covariates['SITE'] = 'None'
-        # Set the ROI to be predicted
         ROIs = self.harmonization_model['ROIs']
-        # Compute predicted mean for specific ROI
-        # TODO: This is inefficient because the mean values are predicted for
-        #       all ROIs every time. Computation is only necessary if the
-        #       covariates change (e.g. for different `Sex`).
-        _, stand_mean = nh.harmonizationApply(np.full((covariates.shape[0], len(ROIs)), np.nan),
-                                              covariates[['SITE','Age','Sex','ICV']],
-                                              self.harmonization_model, True)
+        age, stand_mean, sd = self.GetNormativeCurves(sex, icv, age)
+        # Column lookup of the specific ROI
         y = stand_mean[:,ROIs.index(roi)]
         # Get the normative range based on pooled variance
-        z = 2.*np.sqrt(self.harmonization_model['var_pooled'][ROIs.index(roi)])
+        z = 2.*sd[ROIs.index(roi)]
         # Return age and associated mean value as well as normative range
-        return covariates['Age'], y, z
+        return age, y, z
+
+
+    def GetNormativeCurves(self,sex=0,icv=1450000,age=(25,95,200)):
+        """Returns the age grid, the predicted mean of all ROIs (grid x ROIs)
+        and the pooled standard deviation of all ROIs. The curves are
+        computed once per model, age grid (start, stop, num), `sex` and
+        `icv`."""
+        model = self.harmonization_model
+        key = (id(model), tuple(age), sex, icv)
+        # The model is stored with the curves, so a new model that reuses
+        # the id of a released one does not hit the cache
+        if key in self.normative_cache and self.normative_cache[key][0] is model:
+            return self.normative_cache[key][1:]
+
+        # Predicted mean of all ROIs along the age grid for fixed covariates
+        normative = self.GetNormativeModel()
+        age = pd.Series(np.linspace(*age), name='Age')
+        stand_mean = normative.Predict(Age=age.values, Sex=sex, ICV=icv)
+        sd = normative.GetSD()
+
+        self.normative_cache[key] = (model, age, stand_mean, sd)
+        return age, stand_mean, sd
+
+
+    def GetNormativeModel(self):
+        """Returns the normative curve evaluator of the harmonization model"""
+        if (self.normative_model is None or
+            self.normative_model.model is not self.harmonization_model):
+            self.normative_model = NormativeModel(self.harmonization_model)
+        return self.normative_model
 
 
     def GetData(self,roi,hue):
@@ -128,19 +246,20 @@ class DataModel(QObject):
         if not isinstance(roi, list):
             roi = [roi]
         
-        d = self.data[roi + ["Age",hue]]
+        d = self.GetColumns(roi + ["Age",hue])
         return d
 
 
     def IsValidData(self):
         """Checks if the data is valid or not."""
-        if not isinstance(self.data, pd.DataFrame):
+        if not self.IsLazy() and not isinstance(self.data, pd.DataFrame):
             return False
-        if 'participant_id' not in self.data.columns:
+        columns = self.GetColumnHeaderNames()
+        if 'participant_id' not in columns:
             return False
-        elif 'Age' not in self.data.columns:
+        elif 'Age' not in columns:
             return False
-        elif 'Sex' not in self.data.columns:
+        elif 'Sex' not in columns:
             return False
         else:
             return True
@@ -160,7 +279,9 @@ class DataModel(QObject):
 
     def GetColumnHeaderNames(self):
         """Returns all header names for all columns in the dataset."""
-        if self.data is not None:
+        if self.IsLazy():
+            k = self.store.columns
+        elif self.data is not None:
             k = self.data.keys()
         else:
             k = []
@@ -170,6 +291,8 @@ class DataModel(QObject):
 
     def GetColumnDataTypes(self):
         """Returns all header names for all columns in the dataset."""
+        if self.IsLazy():
+            return self.store.dtypes
         d = self.data.dtypes
         return d
     
@@ -178,10 +301,12 @@ class DataModel(QObject):
         #clear all contents of data/model and release memory etc.
         #TODO: this needs to be done correctly,
         #is there a better way to clear data?
-        del self.data
         del self.harmonization_model
         self.harmonization_model = None
+        self.normative_cache.clear()
+        self.normative_model = None
         self.data = None
+        self.store = None
 
     def GetDataStatistics(self):
         """Returns a dictionary of data statistics.
@@ -195,13 +320,14 @@ class DataModel(QObject):
         stats = dict()
 
         #fill dictionary with data stats
-        stats['minAge'] = self.data['Age'].min()
-        stats['maxAge'] = self.data['Age'].max()
-        stats['meanAge'] = self.data['Age'].mean()
-        stats['numParticipants'] = len(self.data['participant_id'].unique())
-        stats['numObservations'] = self.data.shape[0]
-
-        sex = self.data[['participant_id','Sex']].drop_duplicates()
+        data = self.GetColumns(['participant_id','Age','Sex'])
+        stats['minAge'] = data['Age'].min()
+        stats['maxAge'] = data['Age'].max()
+        stats['meanAge'] = data['Age'].mean()
+        stats['numParticipants'] = len(data['participant_id'].unique())
+        stats['numObservations'] = data.shape[0]
+
+        sex = data[['participant_id','Sex']].drop_duplicates()
         stats['countsPerSex'] = sex['Sex'].value_counts()
 
         return stats
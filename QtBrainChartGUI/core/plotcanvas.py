@@ -7,23 +7,52 @@ Use of this source code is governed by license located in license file: https://
 from PyQt5 import QtCore, QtWidgets
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
+from matplotlib.backends.backend_agg import RendererAgg
 import matplotlib as mpl
 mpl.use('QT5Agg')
+from collections import OrderedDict
+from QtBrainChartGUI.core.renderworker import RenderWorker
+
+
+class ImageCanvas(FigureCanvas):
+    """A Qt canvas that draws into the renderer in `image`, so an image
+    rendered off-screen is shown without drawing the figure again, see
+    `PlotCanvas.SetFigure`."""
+
+    def __init__(self, figure):
+        """The constructor."""
+        super(ImageCanvas,self).__init__(figure)
+        # Agg renderer holding the image of the figure or None
+        self.image = None
+
+    def get_renderer(self, cleared=False):
+        """Returns the renderer of the image, a new one if the image does
+        not fit the figure."""
+        w, h = self.figure.bbox.size
+        if (self.image is None or
+            (self.image.width, self.image.height, self.image.dpi) != (int(w), int(h), self.figure.dpi)):
+            self.image = RendererAgg(int(w), int(h), self.figure.dpi)
+        elif cleared:
+            self.image.clear()
+        self.renderer = self.image
+        return self.image
 
 
 class PlotCanvas(QtWidgets.QWidget):
     """ A generic Plotting class that derives from FigureCanvasQTAgg
     and plots data as per different options"""
 
-    def __init__(self, parent=None, width=5, height=4, dpi=100):
+    def __init__(self, parent=None, width=5, height=4, dpi=100, cache_size=16):
         super(PlotCanvas,self).__init__()
         """The constructor."""
 
-        # a figure instance to plot on
+        # a figure instance to plot on, `dpi` is scaled for high resolution
+        # screens by the canvas
+        self.dpi = dpi
         self.fig = mpl.figure.Figure(figsize=(width, height), dpi=dpi)
 
         #FigureCanvas
-        self.canvas = FigureCanvas(self.fig)
+        self.canvas = ImageCanvas(self.fig)
         self.setParent(parent)
 
         #toolbar
@@ -34,8 +63,112 @@ class PlotCanvas(QtWidgets.QWidget):
         self.layout().addWidget(self.toolbar)
         self.layout().addWidget(self.canvas)
 
+        # Scatter renderer of the shown figure, see `Render`
+        self.scatter = None
+
+        # Figures rendered off-screen (figure, scatter, Agg renderer) by key
+        # and the key of the shown one, see `Render`
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.key = None
+        RenderWorker.Instance().rendered.connect(self.OnRendered)
+
     def getFigure(self):
         return self.fig
 
     def draw(self):
         self.canvas.draw()
+
+    def GetView(self):
+        """Returns the size in pixels and the dpi of the figure."""
+        w, h = self.fig.bbox.size
+        return (int(w), int(h), self.fig.dpi)
+
+    def Render(self, key, plot, style=None):
+        """Shows the figure drawn by `plot(fig)` on a new figure. `key`
+        identifies the figure (e.g. data version, ROI and hue), the view is
+        added to it. The figure is drawn off-screen by the render worker and
+        swapped into the canvas when done; the figures of the latest keys are
+        kept with their image, so showing them again is instant, see
+        `ShowCached`. `plot` runs on the worker thread, so it must not touch
+        widgets or the data model. It may return the `ScatterRenderer` of the
+        figure. `style` are rc parameters used while the figure is drawn,
+        e.g. `sns.axes_style('white')`, see `RenderWorker.Submit`."""
+        if self.ShowCached(key):
+            return
+        self.key = tuple(key) + self.GetView()
+        RenderWorker.Instance().Submit(self, self.key, plot, self.fig.get_size_inches(),
+                                       self.fig.dpi, self.dpi, style)
+
+    def ShowCached(self, key):
+        """Shows the cached figure of `key` and returns True if there is
+        one, see `Render`."""
+        key = tuple(key) + self.GetView()
+        if key not in self.cache:
+            return False
+        self.key = key
+        self.cache.move_to_end(key)
+        self.SetFigure(key)
+        return True
+
+    def ClearCache(self):
+        """Drops the cached figures, e.g. when the plotted data is replaced."""
+        self.cache.clear()
+        self.key = None
+
+    def OnRendered(self, canvas, key, result):
+        """Caches a figure of the render worker and shows it if its key is
+        still the latest one."""
+        if canvas is not self or result is None:
+            return
+        fig, scatter = result
+        self.cache[key] = [fig, scatter, fig.canvas.get_renderer()]
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        if key == self.key:
+            self.SetFigure(key)
+
+    def SetFigure(self, key):
+        """Swaps the cached figure of `key` into the canvas. Its Agg image is
+        shown as is if the figure did not change since it was drawn."""
+        fig, scatter, renderer = self.cache[key]
+        if fig is self.fig:
+            return
+        # Keep the image of the current figure for when it is shown again
+        for entry in self.cache.values():
+            if entry[0] is self.fig:
+                entry[2] = None if self.fig.stale else self.canvas.image
+
+        size, dpi = self.fig.get_size_inches(), self.fig.dpi
+        callbacks = self.canvas.callbacks
+        fig.set_canvas(self.canvas)
+        self.canvas.figure = fig
+        self.fig = fig
+        if fig.dpi != dpi:
+            fig.dpi = dpi
+        if tuple(fig.get_size_inches()) != tuple(size):
+            fig.set_size_inches(size, forward=False)
+
+        if self.canvas.callbacks is not callbacks:
+            # Newer matplotlib keeps the event connections in the figure,
+            # so the toolbar has to connect to the new one
+            toolbar = NavigationToolbar(self.canvas, self)
+            self.layout().replaceWidget(self.toolbar, toolbar)
+            self.toolbar.deleteLater()
+            self.toolbar = toolbar
+        else:
+            self.toolbar.update()
+
+        self.scatter = scatter
+        if scatter is not None:
+            scatter.Connect()
+
+        # The off-screen image is shown as is if it fits the canvas,
+        # otherwise the figure is drawn into a new one
+        self.canvas.image = None if fig.stale else renderer
+        if self.canvas.image is not None:
+            self.canvas.get_renderer()
+        if self.canvas.image is renderer and renderer is not None:
+            self.canvas.update()
+        else:
+            self.canvas.draw_idle()
@@ -0,0 +1,91 @@
+# This Python file uses the following encoding: utf-8
+"""
+contact: software@cbica.upenn.edu
+Copyright (c) 2018 University of Pennsylvania. All rights reserved.
+Use of this source code is governed by license located in license file: https://github.com/CBICA/BrainChart/blob/main/LICENSE
+"""
+
+from PyQt5 import QtCore
+from collections import OrderedDict
+import threading
+import traceback
+
+
+class RenderWorker(QtCore.QObject):
+    """Draws figures off-screen on a background thread.
+
+    A request builds a new figure with `plot(fig)` and rasterizes it with
+    Agg, so the GUI thread only swaps the finished figure into its canvas.
+    Only the latest request of each canvas is kept, so flipping quickly
+    through ROIs renders just the one shown at the end. Styles are applied
+    per request on the worker thread, so drawing never depends on styles
+    set globally. All canvases share one worker, see `Instance`."""
+
+    rendered = QtCore.pyqtSignal(object, object, object)
+
+    instance = None
+
+    def __init__(self):
+        """The constructor."""
+        super(RenderWorker, self).__init__()
+        self.condition = threading.Condition()
+        # Latest request (key, plot, size, dpi, base dpi, style) of each canvas
+        self.pending = OrderedDict()
+        self.thread = threading.Thread(target=self.Run, name='RenderWorker', daemon=True)
+        self.thread.start()
+
+
+    @classmethod
+    def Instance(cls):
+        """Returns the worker shared by all canvases, created on first use."""
+        if cls.instance is None:
+            cls.instance = RenderWorker()
+        return cls.instance
+
+
+    def Submit(self, canvas, key, plot, size, dpi, base_dpi=None, style=None):
+        """Requests the figure drawn by `plot(fig)` for `key` of `canvas`, at
+        `size` (inches) and `dpi`, replacing a request of `canvas` that has
+        not started yet. `base_dpi` and `style` are passed to
+        `RenderFigure`. Emits `rendered(canvas, key, result)` on the GUI
+        thread when done, `result` is the figure and the return value of
+        `plot`, or None if `plot` failed."""
+        with self.condition:
+            self.pending.pop(canvas, None)
+            self.pending[canvas] = (key, plot, size, dpi, base_dpi, style)
+            self.condition.notify()
+
+
+    def Run(self):
+        """Renders the requests in order, runs on the worker thread."""
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                canvas, (key, plot, size, dpi, base_dpi, style) = self.pending.popitem(last=False)
+            try:
+                result = RenderFigure(plot, size, dpi, base_dpi, style)
+            except Exception:
+                traceback.print_exc()
+                result = None
+            self.rendered.emit(canvas, key, result)
+
+
+def RenderFigure(plot, size, dpi, base_dpi=None, style=None):
+    """Returns a new figure of `size` (inches) and `dpi` drawn by
+    `plot(fig)` and rasterized with Agg, and the return value of `plot`.
+    `base_dpi` is the dpi before scaling for high resolution screens.
+    `style` are rc parameters (e.g. `sns.axes_style('white')`) used while
+    the figure is built and drawn."""
+    import matplotlib as mpl
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    with mpl.rc_context(style):
+        fig = Figure(figsize=size, dpi=dpi if base_dpi is None else base_dpi)
+        FigureCanvasAgg(fig)
+        fig.dpi = dpi
+        result = plot(fig)
+        # `plot` may already have drawn the figure
+        if fig.stale:
+            fig.canvas.draw()
+    return fig, result
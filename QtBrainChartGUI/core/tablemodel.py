@@ -0,0 +1,238 @@
+# This Python file uses the following encoding: utf-8
+"""
+contact: software@cbica.upenn.edu
+Copyright (c) 2018 University of Pennsylvania. All rights reserved.
+Use of this source code is governed by license located in license file: https://github.com/CBICA/BrainChart/blob/main/LICENSE
+"""
+
+from PyQt5 import QtCore
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import re
+
+
+# Clause of a filter, e.g. `Age >= 60` or `SITE == ADNI`
+FILTER_CLAUSE = re.compile(r'^\s*(.+?)\s*(==|!=|<=|>=|<|>|~)\s*(.*?)\s*$')
+
+
+class DataTableModel(QtCore.QAbstractTableModel):
+    """Table model of a data frame that only touches the cells in view.
+
+    Columns are fetched with `fetch(columns)` (e.g. `DataModel.GetColumns`)
+    when a cell of them is first painted, together with their uncached
+    neighbours, and kept as NumPy arrays. Cells are formatted in blocks of
+    `block_size` rows of one column, so scrolling formats each visible block
+    once. Both caches are limited, so the table works on lazily loaded data
+    with many rows and columns.
+
+    Sorting and filtering never copy the data: the shown rows are a
+    permutation of the row positions, composed of a cached argsort per
+    column and the masks of the filter clauses (see `SetFilterText`)."""
+
+    def __init__(self, fetch, columns, index, parent=None, block_size=256,
+                 max_columns=256, max_blocks=4096, prefetch=16):
+        """The constructor."""
+        QtCore.QAbstractTableModel.__init__(self, parent)
+        self.fetch = fetch
+        self.columns = list(columns)
+        self.row_index = index
+        self.block_size = block_size
+        self.max_columns = max_columns
+        self.max_blocks = max_blocks
+        # Number of neighbouring columns fetched with a column
+        self.prefetch = prefetch
+        self.arrays = OrderedDict()
+        self.blocks = OrderedDict()
+        self.row_labels = OrderedDict()
+        # Ascending order of the rows per column, missing values last
+        self.argsorts = OrderedDict()
+        # Mask of each filter clause
+        self.masks = OrderedDict()
+        self.sort_column = None
+        self.sort_order = QtCore.Qt.AscendingOrder
+        self.filter_mask = None
+        # Positions of the shown rows, None for all rows in order
+        self.rows = None
+
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        if self.rows is not None:
+            return len(self.rows)
+        return len(self.row_index)
+
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.columns)
+
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole:
+            if orientation == QtCore.Qt.Horizontal:
+                return str(self.columns[section])
+            return self.GetRowLabels(section // self.block_size)[section % self.block_size]
+        return QtCore.QAbstractTableModel.headerData(self, section, orientation, role)
+
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if index.isValid() and role == QtCore.Qt.DisplayRole:
+            row = index.row()
+            block = self.GetBlock(index.column(), row // self.block_size)
+            return block[row % self.block_size]
+        return QtCore.QVariant()
+
+
+    def GetArray(self, column):
+        """Returns the values of column number `column`, fetching it and its
+        uncached neighbours if needed."""
+        name = self.columns[column]
+        if name not in self.arrays:
+            names = [c for c in self.columns[column:column + self.prefetch]
+                     if c not in self.arrays]
+            d = self.fetch(names)
+            for c in names:
+                self.arrays[c] = d[c].to_numpy()
+            while len(self.arrays) > max(self.max_columns, len(names)):
+                self.arrays.popitem(last=False)
+        self.arrays.move_to_end(name)
+        return self.arrays[name]
+
+
+    def GetBlock(self, column, block):
+        """Returns the formatted cells of block number `block` of column
+        number `column`."""
+        key = (column, block)
+        if key not in self.blocks:
+            rows = self.GetRows(block)
+            self.blocks[key] = self.Format(self.GetArray(column)[rows])
+            if len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+        else:
+            self.blocks.move_to_end(key)
+        return self.blocks[key]
+
+
+    def GetRows(self, block):
+        """Returns the row positions of block number `block`."""
+        rows = slice(block * self.block_size, (block + 1) * self.block_size)
+        if self.rows is not None:
+            return self.rows[rows]
+        return rows
+
+
+    def GetRowLabels(self, block):
+        """Returns the formatted index labels of block number `block`."""
+        if block not in self.row_labels:
+            self.row_labels[block] = self.Format(self.row_index[self.GetRows(block)])
+            if len(self.row_labels) > self.max_blocks:
+                self.row_labels.popitem(last=False)
+        return self.row_labels[block]
+
+
+    def Format(self, values):
+        """Returns `values` as list of strings. NumPy scalars are formatted
+        with their own precision, so float32 columns are not padded."""
+        return [str(v) for v in values]
+
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        """Sorts the shown rows by column number `column`, missing values
+        last. Called by the view on header clicks."""
+        self.layoutAboutToBeChanged.emit()
+        self.sort_column = None if column < 0 else self.columns[column]
+        self.sort_order = order
+        self.UpdateRows()
+        self.layoutChanged.emit()
+
+
+    def GetArgsort(self, name):
+        """Returns the ascending order of the rows by column `name` and the
+        number of rows with values."""
+        if name not in self.argsorts:
+            values = self.GetArray(self.columns.index(name))
+            if values.dtype.kind in 'biuf':
+                key = values
+                n_valid = len(values)
+                if values.dtype.kind == 'f':
+                    n_valid -= np.count_nonzero(np.isnan(values))
+            else:
+                # Categories and strings are sorted by their codes
+                key, _ = pd.factorize(values, sort=True)
+                n_valid = np.count_nonzero(key >= 0)
+                key = np.where(key >= 0, key, np.iinfo(key.dtype).max)
+            self.argsorts[name] = (np.argsort(key, kind='stable'), n_valid)
+            if len(self.argsorts) > self.max_columns:
+                self.argsorts.popitem(last=False)
+        self.argsorts.move_to_end(name)
+        return self.argsorts[name]
+
+
+    def SetFilterText(self, text):
+        """Shows the rows that match all clauses of `text`, e.g. `Age >= 60
+        & SITE == ADNI & participant_id ~ 002`. Clauses are `column op
+        value` with op one of ==, !=, <, <=, >, >= and ~ (contains), joined
+        by `&`. Masks of clauses that did not change are reused. Raises
+        ValueError for invalid clauses."""
+        clauses = [c.strip() for c in text.split('&') if c.strip()]
+        masks = OrderedDict()
+        for clause in clauses:
+            masks[clause] = (self.masks[clause] if clause in self.masks
+                             else self.GetFilterMask(clause))
+
+        self.beginResetModel()
+        self.masks = masks
+        self.filter_mask = None
+        for mask in masks.values():
+            self.filter_mask = mask if self.filter_mask is None else self.filter_mask & mask
+        self.UpdateRows()
+        self.endResetModel()
+        return self.rowCount()
+
+
+    def GetFilterMask(self, clause):
+        """Returns the mask of the rows that match the filter `clause`."""
+        match = FILTER_CLAUSE.match(clause)
+        if match is None or match.group(1) not in self.columns:
+            raise ValueError('Invalid filter `' + clause + '`.')
+        name, op, value = match.groups()
+        values = self.GetArray(self.columns.index(name))
+
+        if op == '~':
+            return pd.Series(values).astype(str).str.contains(value, regex=False).to_numpy()
+        if values.dtype.kind in 'iuf':
+            try:
+                value = float(value)
+            except ValueError:
+                raise ValueError('Filter `' + clause + '` needs a number.')
+        else:
+            # Categories and strings are compared as strings
+            values = pd.Series(values).astype(str).where(pd.notnull(values)).to_numpy()
+        if op in ('==', '!='):
+            mask = values == value
+            return ~mask if op == '!=' else mask
+        valid = pd.notnull(values)
+        mask = np.zeros((len(values),), dtype=bool)
+        compare = {'<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal}[op]
+        mask[valid] = compare(values[valid], value)
+        return mask
+
+
+    def UpdateRows(self):
+        """Composes the shown rows of the sort order and the filter mask."""
+        rows = None
+        if self.sort_column is not None:
+            rows, n_valid = self.GetArgsort(self.sort_column)
+            if self.sort_order == QtCore.Qt.DescendingOrder:
+                rows = np.concatenate((rows[:n_valid][::-1], rows[n_valid:]))
+        if self.filter_mask is not None:
+            if rows is None:
+                rows = np.flatnonzero(self.filter_mask)
+            else:
+                rows = rows[self.filter_mask[rows]]
+        self.rows = rows
+        self.blocks.clear()
+        self.row_labels.clear()
@@ -11,6 +11,7 @@ from yapsy.IPlugin import IPlugin
 import os, sys
 #from BrainChart.dataio import DataIO
 from QtBrainChartGUI.core.model.datamodel import DataModel
+from QtBrainChartGUI.core.jobrunner import JobRunner, JobQueuePanel
 from .aboutdialog import AboutDialog
 from QtBrainChartGUI.resources import resources
 from PyQt5.QtWidgets import QAction
@@ -24,6 +25,14 @@ class MainWindow(QtWidgets.QMainWindow):
 
         #instantiate data model
         self.datamodel = DataModel()
+        self.datamodel.status.connect(self.ui.statusbar.showMessage)
+
+        #background jobs shared by all plugins
+        self.jobrunner = JobRunner()
+        self.jobQueuePanel = JobQueuePanel(self.jobrunner)
+        self.jobQueueDock = QtWidgets.QDockWidget('Jobs', self)
+        self.jobQueueDock.setWidget(self.jobQueuePanel)
+        self.addDockWidget(QtCore.Qt.BottomDockWidgetArea, self.jobQueueDock)
 
         # Create plugin manager
         self.manager = PluginManager(categories_filter={ "UI": IPlugin})
@@ -40,6 +49,7 @@ class MainWindow(QtWidgets.QMainWindow):
             # plugin.plugin_object is an instance of the plugin
             po = plugin.plugin_object
             po.datamodel = self.datamodel
+            po.jobrunner = self.jobrunner
             po.SetupConnections()
             self.Plugins[plugin.name] = po
             print("plugins: ", plugin.name)
@@ -51,13 +61,11 @@ class MainWindow(QtWidgets.QMainWindow):
             self.Plugins['data'].ReadData(dataFile)
 
         if harmonizationModelFile is not None:
-            pass
             #if harmonization model file provided on cmd line, load it
-            #self.OnHarmonizationModelFileOpenClicked(harmonizationModelFile)
+            self.Plugins['harmonization'].LoadHarmonizationModel(harmonizationModelFile)
         if SPAREModelFile is not None:
-            pass
             #if SPARE model file provided on cmd line, load it
-            #self.OnSPAREModelFileOpenClicked(SPAREModelFile)
+            self.Plugins['SPARE-*'].LoadSPAREModel(SPAREModelFile)
         
         # Include Mac menu bar
         self.ui.actionHelp.setMenuRole(QAction.NoRole)
@@ -83,6 +91,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def OnCloseClicked(self):
         #close currently loaded data and model
+        self.jobrunner.CancelAll()
         QtWidgets.QApplication.quit()
 
     def ResetUI(self):
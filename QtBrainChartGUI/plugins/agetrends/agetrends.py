@@ -2,13 +2,13 @@ from PyQt5.QtGui import *
 from yapsy.IPlugin import IPlugin
 from PyQt5 import QtGui, QtCore, QtWidgets, uic
 import sys, os
-import neuroHarmonize as nh
 
 import seaborn as sns
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from QtBrainChartGUI.core.plotcanvas import PlotCanvas
+from BrainChart.scatterrenderer import ScatterRenderer
 
 
 class ExtendedComboBox(QtWidgets.QComboBox):
@@ -70,7 +70,6 @@ class AgeTrends(QtWidgets.QWidget,IPlugin):
         self.ui.horizontalLayout.addWidget(self.comboBoxROI)
         self.ui.horizontalLayout.addWidget(self.comboBoxHue)
         self.ui.verticalLayout.addWidget(self.plotCanvas)
-        self.plotCanvas.axes = self.plotCanvas.fig.add_subplot(111)
 
     def getUI(self):
         return self.ui
@@ -125,7 +124,7 @@ class AgeTrends(QtWidgets.QWidget,IPlugin):
         #add the list items to comboBoxHue
         datakeys = self.datamodel.GetColumnHeaderNames()
         datatypes = self.datamodel.GetColumnDataTypes()
-        categoryList = ['Sex','Study','A','T','N','PIB_Status'] + [k for k,d in zip(datakeys, datatypes) if d.name=='category']
+        categoryList = ['Sex','Study','A','T','N','PIB_Status'] + [k for k,d in zip(datakeys, datatypes) if d.name=='category' and k!='participant_id']
         categoryList = list(set(categoryList).intersection(set(datakeys)))
         self.ui.comboBoxROI.blockSignals(True)
         self.ui.comboBoxHue.clear()
@@ -174,25 +173,24 @@ class AgeTrends(QtWidgets.QWidget,IPlugin):
         if not currentHue:
             currentHue = 'Sex'
 
-        # clear plot
-        self.plotCanvas.axes.clear()
+        # Plots are drawn off-screen and kept per data version, harmonization
+        # model (normative curves), ROI and hue
+        key = (self.datamodel.GetDataVersion(), id(self.datamodel.GetModel()),
+               currentROI, currentHue)
+        if self.plotCanvas.ShowCached(key):
+            return
 
-        # seaborn plot on axis
-        a = sns.scatterplot(x='Age', y=currentROI,  hue=currentHue,ax=self.plotCanvas.axes, s=5,
-            data=self.datamodel.GetData(currentROI,currentHue))
-        self.plotCanvas.axes.yaxis.set_ticks_position('left')
-        self.plotCanvas.axes.xaxis.set_ticks_position('bottom')
-        sns.despine(fig=self.plotCanvas.axes.get_figure(), trim=True)
-        self.plotCanvas.axes.get_figure().set_tight_layout(True)
+        data = self.datamodel.GetData(currentROI,currentHue)
 
         # Plot normative range if according GAM model is available
+        curves = []
         if (self.datamodel.harmonization_model is not None) and (currentROI in ['H_' + x for x in self.datamodel.harmonization_model['ROIs']]):
             x,y,z = self.datamodel.GetNormativeRange(currentROI[2:])
             #print('Pooled variance: %f' % (z))
             # Plot three lines as expected mean and +/- 2 times standard deviation
-            sns.lineplot(x=x, y=y, ax=self.plotCanvas.axes, linestyle='-', markers=False, color='k')
-            sns.lineplot(x=x, y=y+z, ax=self.plotCanvas.axes, linestyle=':', markers=False, color='k')
-            sns.lineplot(x=x, y=y-z, ax=self.plotCanvas.axes, linestyle=':', markers=False, color='k')
+            curves = [(x, y, {'linestyle': '-', 'color': 'k'}),
+                      (x, y+z, {'linestyle': ':', 'color': 'k'}),
+                      (x, y-z, {'linestyle': ':', 'color': 'k'})]
 
         # Set ROI name as y-label if applicable
         _, MUSEDictIDtoNAME = self.datamodel.GetMUSEDictionaries()
@@ -210,7 +208,18 @@ class AgeTrends(QtWidgets.QWidget,IPlugin):
         if ylabel.startswith('RES_MUSE_'):
             ylabel = '(Residuals MUSE) ' + list(map(MUSEDictIDtoNAME.get, [currentROI.replace('RES_', '')]))[0]
 
-        self.plotCanvas.axes.set(ylabel=ylabel)
-
-        # refresh canvas
-        self.plotCanvas.draw()
+        x, y, hue = data['Age'].to_numpy(), data[currentROI].to_numpy(), data[currentHue].copy()
+        self.plotCanvas.Render(key, lambda fig: PlotAgeTrend(fig, x, y, hue, ylabel, currentHue, curves))
+
+
+def PlotAgeTrend(fig, x, y, hue, ylabel, hue_label, curves):
+    """Draws `y` over age `x` colored by `hue` and the normative `curves` on
+    `fig`. Runs on the render worker."""
+    axes = fig.add_subplot(111)
+    axes.yaxis.set_ticks_position('left')
+    axes.xaxis.set_ticks_position('bottom')
+    sns.despine(fig=fig)
+    fig.set_tight_layout(True)
+    scatter = ScatterRenderer(axes)
+    scatter.Update(x, y, hue, 'Age', ylabel, hue_label, curves)
+    return scatter
@@ -3,25 +3,35 @@ from matplotlib.backends.backend_qt5 import FigureCanvasQT
 from yapsy.IPlugin import IPlugin
 from PyQt5 import QtGui, QtCore, QtWidgets, uic
 import joblib
+import threading
 import sys, os, time
+from concurrent.futures import ThreadPoolExecutor
 
 import seaborn as sns
 import numpy as np
 import pandas as pd
 from QtBrainChartGUI.core.plotcanvas import PlotCanvas
+from QtBrainChartGUI.core.jobrunner import Job
+from QtBrainChartGUI.plugins.data.dataio import DataIO
+from BrainChart.spare import SPAREEnsemble
+from BrainChart.scatterrenderer import ScatterRenderer
 
 class computeSPAREs(QtWidgets.QWidget,IPlugin):
 
     #constructor
     def __init__(self):
         super(computeSPAREs,self).__init__()
+        self.datamodel = None
+        self.jobrunner = None
+        self.job = None
         self.model = {'BrainAge': None, 'AD': None}
         root = os.path.dirname(__file__)
         self.ui = uic.loadUi(os.path.join(root, 'computeSPAREs.ui'),self)
         self.plotCanvas = PlotCanvas(self.ui.page_2)
         self.ui.verticalLayout.addWidget(self.plotCanvas)
-        self.plotCanvas.axes = self.plotCanvas.fig.add_subplot(111)
         self.SPAREs = None
+        # Number of processes used to evaluate the folds of SPARE-* models
+        self.n_jobs = os.cpu_count()
         self.ui.stackedWidget.setCurrentIndex(0)
         self.ui.factorial_progressBar.setValue(0)
 
@@ -37,6 +47,7 @@ class computeSPAREs(QtWidgets.QWidget,IPlugin):
         self.ui.add_to_dataframe_Btn.clicked.connect(lambda: self.OnAddToDataFrame())
         self.ui.compute_SPARE_scores_Btn.clicked.connect(lambda: self.OnComputeSPAREs())
         self.ui.show_SPARE_scores_from_data_Btn.clicked.connect(lambda: self.OnShowSPAREs())
+        self.ui.cancel_SPARE_computation_Btn.clicked.connect(lambda: self.OnCancelComputation())
         self.datamodel.data_changed.connect(lambda: self.OnDataChanged())
 
         self.ui.add_to_dataframe_Btn.setStyleSheet("background-color: green; color: white")
@@ -64,13 +75,21 @@ class computeSPAREs(QtWidgets.QWidget,IPlugin):
         fileName, _ = QtWidgets.QFileDialog.getOpenFileName(None,
             'Open SPARE-* model file',
             QtCore.QDir().homePath(),
-            "Pickle files (*.pkl.gz *.pkl)")
+            "SPARE-* models (*.pkl.gz *.pkl manifest.json)")
         if fileName != "":
-            self.model['BrainAge'], self.model['AD'] = joblib.load(fileName)
-            self.ui.compute_SPARE_scores_Btn.setEnabled(True)
-            self.ui.SPARE_model_info.setText('File: %s' % (fileName))
-        else:
-            return
+            self.LoadSPAREModel(fileName)
+
+
+    def LoadSPAREModel(self, fileName):
+        job = Job('Load ' + os.path.basename(fileName), ReadSPAREModelFile, (fileName,))
+        job.done.connect(lambda model: self.OnSPAREModelRead(fileName, model))
+        self.jobrunner.Submit(job)
+
+
+    def OnSPAREModelRead(self, fileName, model):
+        self.model['BrainAge'], self.model['AD'] = model
+        self.ui.compute_SPARE_scores_Btn.setEnabled(True)
+        self.ui.SPARE_model_info.setText('File: %s' % (fileName))
         
         self.ui.stackedWidget.setCurrentIndex(0)
 
@@ -89,6 +108,7 @@ class computeSPAREs(QtWidgets.QWidget,IPlugin):
 
 
     def OnComputationDone(self, y_hat):
+        self.ui.cancel_SPARE_computation_Btn.setEnabled(False)
         self.SPAREs = y_hat
         self.plotSPAREs()
         self.ui.stackedWidget.setCurrentIndex(1)
@@ -96,30 +116,37 @@ class computeSPAREs(QtWidgets.QWidget,IPlugin):
 
 
     def OnComputeSPAREs(self):
-        # Setup tasks for long running jobs
-        # Using this example: https://realpython.com/python-pyqt-qthread/
-        self.thread = QtCore.QThread()
-        self.worker = BrainAgeWorker(self.datamodel.data, self.model)
-        self.worker.moveToThread(self.thread)
-        self.thread.started.connect(self.worker.run)
-        self.worker.done.connect(self.thread.quit)
-        self.worker.done.connect(self.worker.deleteLater)
-        self.thread.finished.connect(self.thread.deleteLater)
-        self.worker.progress.connect(self.updateProgress)
-        self.worker.done.connect(lambda y_hat: self.OnComputationDone(y_hat))
-        self.ui.factorial_progressBar.setRange(0, len(self.model['BrainAge']['scaler'])-1)
-        self.thread.start()
+        # Progress covers the folds of both models
+        n_folds = len(self.model['BrainAge']['scaler']) + len(self.model['AD']['scaler'])
+        self.job = Job('Compute SPARE-*', PredictSPAREs,
+                       (self.datamodel.data, self.model, self.n_jobs), maximum=n_folds)
+        self.job.progress.connect(self.updateProgress)
+        self.job.done.connect(lambda y_hat: self.OnComputationDone(y_hat))
+        self.job.cancelled.connect(lambda: self.OnComputationCancelled())
+        self.job.failed.connect(lambda msg: self.OnComputationCancelled())
+        self.ui.factorial_progressBar.setRange(0, n_folds)
+        self.ui.factorial_progressBar.setValue(0)
+        self.jobrunner.Submit(self.job)
         self.ui.compute_SPARE_scores_Btn.setEnabled(False)
+        self.ui.cancel_SPARE_computation_Btn.setEnabled(True)
+
+
+    def OnCancelComputation(self):
+        self.ui.cancel_SPARE_computation_Btn.setEnabled(False)
+        self.job.Cancel()
+
+
+    def OnComputationCancelled(self):
+        self.ui.cancel_SPARE_computation_Btn.setEnabled(False)
+        self.ui.compute_SPARE_scores_Btn.setEnabled(True)
 
 
     def plotSPAREs(self):
-        # Plot data
-        sns.scatterplot(x='SPARE_AD', y='SPARE_BA', data=self.SPAREs,
-                        ax=self.plotCanvas.axes, linewidth=0,
-                        facecolor=(0.5, 0.5, 0.5, 0.5), size=1, legend=None)
-        sns.despine(ax=self.plotCanvas.axes, trim=True)
-        self.plotCanvas.axes.set(ylabel='SPARE-BA', xlabel='SPARE-AD')
-        self.plotCanvas.axes.get_figure().set_tight_layout(True)
+        # New scores, the plot is drawn off-screen
+        self.plotCanvas.ClearCache()
+        x = self.SPAREs['SPARE_AD'].to_numpy()
+        y = self.SPAREs['SPARE_BA'].to_numpy()
+        self.plotCanvas.Render(('SPARE-AD', 'SPARE-BA'), lambda fig: PlotSPAREs(fig, x, y))
 
 
     def OnAddToDataFrame(self):
@@ -127,9 +154,10 @@ class computeSPAREs(QtWidgets.QWidget,IPlugin):
 
 
     def OnShowSPAREs(self):
+        d = self.datamodel.GetColumns(['SPARE_BA', 'SPARE_AD'])
         self.SPAREs = pd.DataFrame.from_dict({
-            'SPARE_BA': self.datamodel.data['SPARE_BA'].values,
-            'SPARE_AD': self.datamodel.data['SPARE_AD'].values})
+            'SPARE_BA': d['SPARE_BA'].values,
+            'SPARE_AD': d['SPARE_AD'].values})
         self.plotSPAREs()
         self.ui.stackedWidget.setCurrentIndex(1)
 
@@ -145,58 +173,67 @@ class computeSPAREs(QtWidgets.QWidget,IPlugin):
             self.ui.show_SPARE_scores_from_data_Btn.setEnabled(False)
 
 
-class BrainAgeWorker(QtCore.QObject):
-
-    done = QtCore.pyqtSignal(pd.DataFrame)
-    progress = QtCore.pyqtSignal(str, int)
-
-    #constructor
-    def __init__(self, data, model):
-        super(BrainAgeWorker, self).__init__()
-        self.data = data
-        self.model = model
-
-    def run(self):
-        y_hat = pd.DataFrame.from_dict({'SPARE_BA': np.full((self.data.shape[0],),np.nan),
-                                       'SPARE_AD': np.full((self.data.shape[0],),np.nan)})
-
-        # SPARE-BA
-        idx = ~self.data[self.model['BrainAge']['predictors'][0]].isnull()
-
-        y_hat_test = np.zeros((np.sum(idx),))
-        n_ensembles = np.zeros((np.sum(idx),))
-
-        for i,_ in enumerate(self.model['BrainAge']['scaler']):
-            # Predict validation (fold) and test
-            self.progress.emit('Computing SPARE-BA | Task 1 of 2', i)
-            test = np.logical_not(self.data[idx]['participant_id'].isin(np.concatenate(self.model['BrainAge']['train']))) | self.data[idx]['participant_id'].isin(self.model['BrainAge']['validation'][i])
-            X = self.data[idx].loc[test, self.model['BrainAge']['predictors']].values
-            X = self.model['BrainAge']['scaler'][i].transform(X)
-            y_hat_test[test] += (self.model['BrainAge']['svm'][i].predict(X) - self.model['BrainAge']['bias_ints'][i]) / self.model['BrainAge']['bias_slopes'][i]
-            n_ensembles[test] += 1.
-
-        y_hat_test /= n_ensembles
-        y_hat.loc[idx, 'SPARE_BA'] = y_hat_test
-
-        idx = ~self.data[self.model['BrainAge']['predictors'][0]].isnull()
-
-        y_hat_test = np.zeros((np.sum(idx),))
-        n_ensembles = np.zeros((np.sum(idx),))
-
-        for i,_ in enumerate(self.model['AD']['scaler']):
-            # Predict validation (fold) and test
-            self.progress.emit('Computing SPARE-AD | Task 2 of 2', i)
-
-            test = np.logical_not(self.data[idx]['participant_id'].isin(np.concatenate(self.model['AD']['train']))) | self.data[idx]['participant_id'].isin(self.model['AD']['validation'][i])
-            X = self.data[idx].loc[test, self.model['AD']['predictors']].values
-            X = self.model['AD']['scaler'][i].transform(X)
-            y_hat_test[test] += self.model['AD']['svm'][i].decision_function(X)
-            n_ensembles[test] += 1. 
-
-        y_hat_test /= n_ensembles
-        y_hat.loc[idx, 'SPARE_AD'] = y_hat_test
-
-        self.progress.emit('All done.', i)
-
-        # Emit the result
-        self.done.emit(y_hat)
+def PlotSPAREs(fig, x, y):
+    """Draws SPARE-BA `y` over SPARE-AD `x` on `fig`, as density if there
+    are many points. Runs on the render worker."""
+    axes = fig.add_subplot(111)
+    sns.despine(ax=axes)
+    fig.set_tight_layout(True)
+    scatter = ScatterRenderer(axes, size=20, palette=[(0.5, 0.5, 0.5, 0.5)], linewidth=0)
+    scatter.Update(x, y, xlabel='SPARE-AD', ylabel='SPARE-BA')
+    return scatter
+
+
+def ReadSPAREModelFile(job, fileName):
+    """Job reading SPARE-* models. A model file gets a memory-mapped bundle,
+    so it loads without unpickling next time."""
+    dio = DataIO()
+    job.Progress('Reading ' + fileName, 0)
+    source = None if dio.IsArrayBundle(fileName) else dio.GetFileStamp(fileName)
+    model = dio.ReadSPAREModel(fileName)
+    if not dio.IsArrayBundle(fileName) and not dio.HasSPAREBundle(fileName):
+        job.Progress('Converting ' + fileName, 0)
+        dio.ConvertSPAREModel(fileName, model, source)
+    return model
+
+
+def PredictSPAREs(job, data, model, n_jobs=1):
+    """Job computing SPARE-BA and SPARE-AD as two concurrent tasks. Scores of
+    finished tasks are kept in the checkpoint of the job, so a resumed job
+    only computes the missing scores."""
+    tasks = {'SPARE_BA': (SPAREEnsemble(model['BrainAge'], 'BrainAge'),
+                          'Computing SPARE-BA | Task 1 of 2'),
+             'SPARE_AD': (SPAREEnsemble(model['AD'], 'AD'),
+                          'Computing SPARE-AD | Task 2 of 2')}
+    todo = [k for k in tasks if k not in job.checkpoint]
+
+    # Report the number of folds done over both tasks
+    lock = threading.Lock()
+    n_done = [sum(tasks[k][0].n_folds for k in tasks if k in job.checkpoint)]
+    def Progress(txt):
+        def progress(i):
+            with lock:
+                n_done[0] += 1
+                job.Progress(txt, n_done[0])
+        return progress
+
+    # The tasks are independent, each gets its share of the processes for
+    # its folds
+    if todo:
+        n_jobs = max(1, n_jobs // len(todo))
+        with ThreadPoolExecutor(max_workers=len(todo)) as pool:
+            futures = {k: pool.submit(tasks[k][0].Predict, data,
+                                      Progress(tasks[k][1]), n_jobs, job.cancel)
+                       for k in todo}
+            for k, future in futures.items():
+                y = future.result()
+                if y is not None:
+                    job.checkpoint[k] = y
+
+    if job.IsCancelled():
+        job.Progress('Computation cancelled.', n_done[0])
+        return None
+
+    job.Progress('All done.', n_done[0])
+    return pd.DataFrame.from_dict({'SPARE_BA': job.checkpoint['SPARE_BA'],
+                                   'SPARE_AD': job.checkpoint['SPARE_AD']})
@@ -4,42 +4,36 @@ from PyQt5 import QtGui, QtCore, QtWidgets, uic
 import sys, os
 import pandas as pd
 from QtBrainChartGUI.plugins.data.dataio import DataIO
+from QtBrainChartGUI.core.jobrunner import Job
+from QtBrainChartGUI.core.tablemodel import DataTableModel
+from BrainChart.columnstore import ColumnStore
+from BrainChart.dataio import PICKLE_EXTENSIONS
 import dtale
 
-class PandasModel(QtCore.QAbstractTableModel):
-    def __init__(self, data, parent=None):
-        QtCore.QAbstractTableModel.__init__(self, parent)
-        self._data = data
-        self.header_labels = None
-
-    def rowCount(self, parent=None):
-        return len(self._data.values)
-
-    def columnCount(self, parent=None):
-        return self._data.columns.size
-
-    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
-        self.header_labels = self._data.keys()
-        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
-            return self.header_labels[section]
-        return QtCore.QAbstractTableModel.headerData(self, section, orientation, role)
-
-    def data(self, index, role=QtCore.Qt.DisplayRole):
-        if index.isValid():
-            if role == QtCore.Qt.DisplayRole:
-                return QtCore.QVariant(str(
-                    self._data.iloc[index.row()][index.column()]))
-        return QtCore.QVariant()
-
-
 class Data(QtWidgets.QWidget,IPlugin):
 
     def __init__(self):
         super(Data,self).__init__()
         self.datamodel = None
+        self.jobrunner = None
         root = os.path.dirname(__file__)
         self.ui = uic.loadUi(os.path.join(root, 'data.ui'),self)
+        self.filterEdit = QtWidgets.QLineEdit()
+        self.filterEdit.setPlaceholderText('Filter, e.g. Age >= 60 & SITE == ADNI & participant_id ~ 002')
+        self.filterEdit.setClearButtonEnabled(True)
+        self.rowCountLabel = QtWidgets.QLabel()
+        filterLayout = QtWidgets.QHBoxLayout()
+        filterLayout.addWidget(QtWidgets.QLabel('Filter'))
+        filterLayout.addWidget(self.filterEdit)
+        filterLayout.addWidget(self.rowCountLabel)
+        self.ui.verticalLayout_2.addLayout(filterLayout)
         self.dataView = QtWidgets.QTableView()
+        # Fixed section sizes, so the view never measures all rows
+        for header in (self.dataView.horizontalHeader(), self.dataView.verticalHeader()):
+            header.setSectionResizeMode(QtWidgets.QHeaderView.Fixed)
+        # Header clicks sort the rows in the model
+        self.dataView.horizontalHeader().setSortIndicator(-1, QtCore.Qt.AscendingOrder)
+        self.dataView.setSortingEnabled(True)
         self.ui.verticalLayout_2.addWidget(self.dataView)
 
 
@@ -48,6 +42,7 @@ class Data(QtWidgets.QWidget,IPlugin):
         self.datamodel.data_changed.connect(lambda: self.OnDataChanged())
         self.ui.save_data_Btn.clicked.connect(lambda: self.OnSaveDataBtClicked())
         self.ui.dtale_Btn.clicked.connect(lambda: self.OnDtaleBtnClicked())
+        self.filterEdit.editingFinished.connect(lambda: self.OnFilterChanged())
 
 
     def OnDtaleBtnClicked(self):
@@ -57,38 +52,63 @@ class Data(QtWidgets.QWidget,IPlugin):
         d.open_browser()
 
 
+    def OnFilterChanged(self):
+        model = self.dataView.model()
+        if model is None:
+            return
+        try:
+            model.SetFilterText(self.filterEdit.text())
+            self.filterEdit.setStyleSheet('')
+            self.filterEdit.setToolTip('')
+        except ValueError as e:
+            print(str(e))
+            self.filterEdit.setStyleSheet('color: red')
+            self.filterEdit.setToolTip(str(e))
+        self.UpdateRowCount()
+
+
+    def UpdateRowCount(self):
+        model = self.dataView.model()
+        self.rowCountLabel.setText('%d of %d rows' % (model.rowCount(), len(model.row_index)))
+
+
     def OnSaveDataBtClicked(self):
         filename = QtWidgets.QFileDialog.getSaveFileName(None,
             'Save data frame to file',
             QtCore.QDir().homePath(),
-            "Pickle files (*.pkl.gz *.pkl)")
+            "Pickle files (*.pkl.gz *.pkl *.pkl.zst);;Parquet files (*.parquet);;Feather files (*.feather)")
 
         if filename[0] == "":
             print("No file was selected")
         else:
-            pd.to_pickle(self.datamodel.data, filename[0])
+            dio = DataIO()
+            data = self.datamodel.data
+            if self.datamodel.dtype_tolerance is not None:
+                # Compact data types are for memory only
+                data = dio.RestoreDataTypes(data)
+            dio.SaveDataFile(data, filename[0])
 
 
     def OnOpenDataFileBtnClicked(self):
         filename = QtWidgets.QFileDialog.getOpenFileName(None,
         'Open data file',
         QtCore.QDir().homePath(),
-        "Pickle files (*.pkl.gz *.pkl)")
+        "Data files (*.pkl.gz *.pkl *.pkl.zst *.parquet *.feather)")
 
         if filename[0] == "":
             print("No data was selected")
         else:
-            file = pd.read_pickle(filename[0])
-            if not (isinstance(file,pd.DataFrame)):
-                print('Selected file must be a dataframe.')
-            else:
-                self.ReadData(filename[0])
+            self.ReadData(filename[0])
 
 
     def PopulateTable(self):
-        model = PandasModel(self.datamodel.data.head(20))
+        model = DataTableModel(self.datamodel.GetColumns,
+                               self.datamodel.GetColumnHeaderNames(),
+                               self.datamodel.GetDataIndex(),
+                               self.dataView)
+        self.dataView.horizontalHeader().setSortIndicator(-1, QtCore.Qt.AscendingOrder)
         self.dataView.setModel(model)
-
+        self.OnFilterChanged()
 
 
     def OnDataChanged(self):
@@ -96,15 +116,53 @@ class Data(QtWidgets.QWidget,IPlugin):
 
 
     def ReadData(self,filename):
-        #read input data
-        dio = DataIO()
-        d = dio.ReadPickleFile(filename)
+        #read input data in the background, the file is read only once
+        job = Job('Load ' + os.path.basename(filename), ReadDataFile,
+                  (filename, self.datamodel.memory_budget, self.datamodel.dtype_tolerance))
+        job.done.connect(lambda result: self.OnDataRead(filename, result))
+        self.jobrunner.Submit(job)
+
 
-        #also read MUSE dictionary
-        MUSEDictNAMEtoID, MUSEDictIDtoNAME = dio.ReadMUSEDictionary()
+    def OnDataRead(self, filename, result):
+        d, MUSEDictNAMEtoID, MUSEDictIDtoNAME = result
+        if not (isinstance(d,(pd.DataFrame,ColumnStore))):
+            print('Selected file must be a dataframe.')
+            return
+
+        #also set MUSE dictionary
         self.datamodel.SetMUSEDictionaries(MUSEDictNAMEtoID, MUSEDictIDtoNAME)
 
         #set data in model
         self.datamodel.SetDataFilePath(filename)
-        self.datamodel.SetData(d)
-
+        if isinstance(d, ColumnStore):
+            self.datamodel.SetDataStore(d)
+        else:
+            self.datamodel.SetData(d)
+
+
+def ReadDataFile(job, filename, memory_budget=1 << 30, dtype_tolerance=None):
+    """Job reading a data file and the MUSE dictionary. Columnar files, also
+    the columnar copies of pickle files, are opened as `ColumnStore` so only
+    the key columns are read now. With `dtype_tolerance` the data gets
+    compact data types."""
+    dio = DataIO()
+    job.Progress('Reading ' + filename, 0)
+    if filename.endswith(('.parquet', '.feather')):
+        d = ColumnStore(filename, memory_budget, dtype_tolerance=dtype_tolerance)
+    elif dio.HasColumnarCopy(filename):
+        d = ColumnStore(dio.GetColumnarFileName(filename), memory_budget,
+                        dtype_tolerance=dtype_tolerance)
+    else:
+        source = dio.GetFileStamp(filename)
+        d = dio.ReadDataFile(filename)
+        # Keep a columnar copy of pickle files for faster reading next time,
+        # with the data types of the file as other readers use it too
+        if filename.endswith(PICKLE_EXTENSIONS) and isinstance(d, pd.DataFrame):
+            job.Progress('Converting ' + filename, 0)
+            dio.ConvertToColumnar(filename, d, source)
+        if dtype_tolerance is not None and isinstance(d, pd.DataFrame):
+            job.Progress('Optimizing data types of ' + filename, 0)
+            d = dio.OptimizeDataTypes(d, dtype_tolerance)
+
+    MUSEDictNAMEtoID, MUSEDictIDtoNAME = dio.ReadMUSEDictionary()
+    return d, MUSEDictNAMEtoID, MUSEDictIDtoNAME
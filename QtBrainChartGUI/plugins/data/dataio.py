@@ -8,20 +8,16 @@ Use of this source code is governed by license located in license file: https://
 import pandas as pd
 import joblib
 import os, sys
+from BrainChart.dataio import DataIO as BrainChartDataIO
+
+class DataIO(BrainChartDataIO):
+    """Data input/output of the GUI. Reading and writing of data files
+    (pickle, CSV, Parquet, Feather) and SPARE-* models is shared with
+    `BrainChart.dataio`."""
 
-class DataIO:
     def __init__(self):
         pass
 
-
-    def ReadPickleFile(self,filename):
-        data = pd.read_pickle(filename)
-        return data
-
-
-    def SavePickleFile(self,data,filename):
-        data.to_pickle(filename)
-
     def ReadMUSEDictionary(self):
         # Load MUSE dictionary file
         MUSEDict = os.path.join(os.path.dirname(__file__), 'MUSE_ROI_Dictionary.csv')
@@ -34,10 +30,3 @@ class DataIO:
         MUSEDictIDtoNAME = dict(zip(MUSEDict['ROI_COL'], MUSEDict['ROI_NAME']))
 
         return MUSEDictNAMEtoID, MUSEDictIDtoNAME
-
-        
-    def ReadSPAREModel(self, filename):
-        with open(filename, "rb") as file:
-            BrainAgeModel, ADModel = joblib.load(filename)
-        
-        return BrainAgeModel, ADModel
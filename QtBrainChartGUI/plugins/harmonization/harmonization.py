@@ -1,14 +1,16 @@
 from PyQt5.QtGui import *
 from yapsy.IPlugin import IPlugin
 from PyQt5 import QtGui, QtCore, QtWidgets, uic
-import sys, os
-import neuroHarmonize as nh
+import sys, os, copy
 
 import seaborn as sns
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from QtBrainChartGUI.core.plotcanvas import PlotCanvas
+from QtBrainChartGUI.core.jobrunner import Job
+from BrainChart.harmonization import HarmonizeNewSites, HarmonizeData, HashHarmonizationInputs, GetRowsToHarmonize, GetHarmonizationColumns, GetHarmonizationCovariates, ApplyHarmonization, SummarizeResiduals
+from BrainChart.dataio import DataIO
 
 class ExtendedComboBox(QtWidgets.QComboBox):
     def __init__(self, parent=None):
@@ -60,16 +62,20 @@ class Harmonization(QtWidgets.QWidget,IPlugin):
     def __init__(self):
         super(Harmonization,self).__init__()
         self.datamodel = None
+        self.jobrunner = None
         root = os.path.dirname(__file__)
         self.ui = uic.loadUi(os.path.join(root, 'harmonization.ui'),self)
         self.ui.Harmonization_Model_Loaded_Lbl.setHidden(True)
         self.ui.comboBoxROI = ExtendedComboBox(self.ui)
         self.plotCanvas = PlotCanvas(self.ui.page_2)
-        self.plotCanvas.axes1 = self.plotCanvas.fig.add_subplot(121)
-        self.plotCanvas.axes2 = self.plotCanvas.fig.add_subplot(122)
         self.ui.verticalLayout.addWidget(self.plotCanvas) 
         self.ui.horizontalLayout_3.insertWidget(0,self.comboBoxROI)
         self.MUSE = None
+        # Input hashes of the harmonized rows in the data and of `MUSE`
+        self.harmonized_inputs = None
+        self.MUSE_inputs = None
+        # Per site residual statistics of `MUSE`, see `SummarizeMUSE`
+        self.summary = None
 
         self.ui.stackedWidget.setCurrentIndex(0) 
 
@@ -83,6 +89,7 @@ class Harmonization(QtWidgets.QWidget,IPlugin):
         self.ui.show_data_Btn.clicked.connect(lambda: self.OnShowDataBtnClicked())
         self.ui.apply_model_to_dataset_Btn.clicked.connect(lambda: self.OnApplyModelToDatasetBtnClicked())
         self.ui.add_to_dataframe_Btn.clicked.connect(lambda: self.OnAddToDataFrame())
+        self.ui.save_harmonization_model_Btn.clicked.connect(lambda: self.OnSaveHarmonizationModelBtnClicked())
         self.ui.comboBoxROI.currentIndexChanged.connect(self.UpdatePlot)
         self.ui.add_to_dataframe_Btn.setStyleSheet("background-color: green; color: white")
         self.datamodel.data_changed.connect(lambda: self.OnDataChanged())
@@ -99,7 +106,7 @@ class Harmonization(QtWidgets.QWidget,IPlugin):
         filename, _ = QtWidgets.QFileDialog.getOpenFileName(None,
         'Open harmonization model file',
         QtCore.QDir().homePath(),
-        "Pickle files (*.pkl.gz *.pkl)")
+        "Harmonization models (*.pkl.gz *.pkl manifest.json)")
 
         if filename == "":
             text_1=('Harmonization model not selected')
@@ -107,30 +114,40 @@ class Harmonization(QtWidgets.QWidget,IPlugin):
             self.ui.Harmonized_Data_Information_Lbl.setObjectName('Missing_label')
             self.ui.Harmonized_Data_Information_Lbl.setStyleSheet('QLabel#Missing_label {color: red}')
         else:
-            self.datamodel.harmonization_model = pd.read_pickle(filename)
-            if not (isinstance(self.datamodel.harmonization_model,dict) and 'SITE_labels' in self.datamodel.harmonization_model):
-                text_2=('Selected file is not a viable harmonization model')
-                self.ui.Harmonized_Data_Information_Lbl.setText(text_2)
-                self.ui.Harmonized_Data_Information_Lbl.setObjectName('Error_label')
-                self.ui.Harmonized_Data_Information_Lbl.setStyleSheet('QLabel#Error_label {color: red}')
-            else:
-                self.ui.Harmonization_Model_Loaded_Lbl.setHidden(False)
-                self.ui.Harmonization_Model_Loaded_Lbl.setObjectName('correct_label')
-                self.ui.Harmonization_Model_Loaded_Lbl.setStyleSheet('QLabel#correct_label {color: green}')
-                self.ui.Harmonization_Model_Loaded_Lbl.setText('Harmonization model compatible')
-                self.ui.Harmonized_Data_Information_Lbl.setObjectName('correct_label')
-                self.ui.Harmonized_Data_Information_Lbl.setStyleSheet('QLabel#correct_label {color: black}')
-                model_text1 = (os.path.basename(filename) +' loaded')
-                model_text2 = ('SITES in training set: '+ ' '.join([str(elem) for elem in list(self.datamodel.harmonization_model['SITE_labels'])]))
-                model_text2 = wrap_by_word(model_text2,4)
-                model_text1 += '\n\n'+model_text2
-                age_max = self.datamodel.harmonization_model['smooth_model']['bsplines_constructor'].knot_kwds[0]['upper_bound']
-                age_min = self.datamodel.harmonization_model['smooth_model']['bsplines_constructor'].knot_kwds[0]['lower_bound']
-                model_text3 = ('Valid Age Range: [' + str(age_min) + ', ' + str(age_max) + ']')
-                model_text1 += '\n'+model_text3
-                self.ui.Harmonized_Data_Information_Lbl.setText(model_text1)
-                self.ui.apply_model_to_dataset_Btn.setEnabled(True)
-                self.ui.apply_model_to_dataset_Btn.setStyleSheet("background-color: lightGreen; color: white")
+            self.LoadHarmonizationModel(filename)
+            return
+        self.ui.stackedWidget.setCurrentIndex(0) 
+
+    def LoadHarmonizationModel(self, filename):
+        job = Job('Load ' + os.path.basename(filename), ReadHarmonizationModelFile, (filename,))
+        job.done.connect(lambda model: self.OnHarmonizationModelRead(filename, model))
+        self.jobrunner.Submit(job)
+
+    def OnHarmonizationModelRead(self, filename, model):
+        self.datamodel.SetHarmonizationModel(model)
+        self.datamodel.SetHarmonizationModelFilePath(filename)
+        if not (isinstance(self.datamodel.harmonization_model,dict) and 'SITE_labels' in self.datamodel.harmonization_model):
+            text_2=('Selected file is not a viable harmonization model')
+            self.ui.Harmonized_Data_Information_Lbl.setText(text_2)
+            self.ui.Harmonized_Data_Information_Lbl.setObjectName('Error_label')
+            self.ui.Harmonized_Data_Information_Lbl.setStyleSheet('QLabel#Error_label {color: red}')
+        else:
+            self.ui.Harmonization_Model_Loaded_Lbl.setHidden(False)
+            self.ui.Harmonization_Model_Loaded_Lbl.setObjectName('correct_label')
+            self.ui.Harmonization_Model_Loaded_Lbl.setStyleSheet('QLabel#correct_label {color: green}')
+            self.ui.Harmonization_Model_Loaded_Lbl.setText('Harmonization model compatible')
+            self.ui.Harmonized_Data_Information_Lbl.setObjectName('correct_label')
+            self.ui.Harmonized_Data_Information_Lbl.setStyleSheet('QLabel#correct_label {color: black}')
+            model_text1 = (os.path.basename(filename) +' loaded')
+            model_text2 = ('SITES in training set: '+ ' '.join([str(elem) for elem in list(self.datamodel.harmonization_model['SITE_labels'])]))
+            model_text2 = wrap_by_word(model_text2,4)
+            model_text1 += '\n\n'+model_text2
+            age_min, age_max = self.datamodel.GetNormativeModel().GetBounds()
+            model_text3 = ('Valid Age Range: [' + str(age_min) + ', ' + str(age_max) + ']')
+            model_text1 += '\n'+model_text3
+            self.ui.Harmonized_Data_Information_Lbl.setText(model_text1)
+            self.ui.apply_model_to_dataset_Btn.setEnabled(True)
+            self.ui.apply_model_to_dataset_Btn.setStyleSheet("background-color: lightGreen; color: white")
         self.ui.stackedWidget.setCurrentIndex(0) 
 
     def PopulateROI(self):
@@ -151,15 +168,79 @@ class Harmonization(QtWidgets.QWidget,IPlugin):
         self.ui.comboBoxROI.addItems(roiList)
 
     def OnShowDataBtnClicked(self):
-        self.MUSE = self.datamodel.data
-        self.PopulateROI()
-        self.UpdatePlot()
+        store = self.datamodel.store
+        job = Job('Summarize residuals', self.RunSummary, (self.datamodel.GetDataLoader(),))
+        job.done.connect(lambda result: self.OnSummaryDone(store, *result))
+        self.jobrunner.Submit(job)
     
+    def RunSummary(self, job, load):
+        """Job loading the data with `load` and summarizing its residuals."""
+        job.Progress('Loading data', 0)
+        MUSE = load()
+        job.Progress('Summarizing residuals', 0)
+        return MUSE, self.SummarizeMUSE(MUSE)
+
+    def OnSummaryDone(self, store, MUSE, summary):
+        self.datamodel.SetLoadedData(store, MUSE)
+        self.ShowResiduals(MUSE, summary)
+
     def OnApplyModelToDatasetBtnClicked(self):
-        self.MUSE= self.DoHarmonization()
+        self.ui.apply_model_to_dataset_Btn.setEnabled(False)
+        if self.ui.incremental_harmonization_Chk.isChecked():
+            harmonize = self.DoIncrementalHarmonization
+        else:
+            harmonize = self.DoHarmonization
+        # The job loads the data and harmonizes with a copy of the model, the
+        # data model is only changed on the GUI thread when it is done
+        store = self.datamodel.store
+        model = self.datamodel.harmonization_model
+        job = Job('Apply harmonization model', self.RunHarmonization,
+                  (harmonize, self.datamodel.GetDataLoader(), model, self.harmonized_inputs))
+        job.done.connect(lambda result: self.OnHarmonizationDone(store, model, *result))
+        job.failed.connect(lambda msg: self.ui.apply_model_to_dataset_Btn.setEnabled(True))
+        self.jobrunner.Submit(job)
+
+    def RunHarmonization(self, job, harmonize, load, model, harmonized_inputs):
+        """Job loading the data with `load`, harmonizing it with `harmonize`
+        and a copy of `model` and summarizing the residuals of the result.
+        Returns the data, the updated copy of the model, the results and the
+        input hashes."""
+        job.Progress('Loading data', 0)
+        data = load()
+        model = copy.deepcopy(model)
+        job.Progress('Harmonizing', 0)
+        MUSE, inputs = harmonize(data, model, harmonized_inputs)
+        job.Progress('Summarizing residuals', 0)
+        return data, model, MUSE, self.SummarizeMUSE(MUSE), inputs
+
+    def OnHarmonizationDone(self, store, model, data, harmonized_model, MUSE, summary, inputs):
+        """Shows the results and keeps the loaded data and the parameters of
+        new sites, unless the data or the model were replaced meanwhile."""
+        self.ui.apply_model_to_dataset_Btn.setEnabled(True)
+        self.datamodel.SetLoadedData(store, data)
+        if self.datamodel.harmonization_model is model:
+            self.datamodel.SetHarmonizationModel(harmonized_model)
+        self.MUSE_inputs = inputs
+        self.ShowResiduals(MUSE, summary)
+
+    def ShowResiduals(self, MUSE, summary):
+        self.MUSE = MUSE
+        self.summary = summary
+        self.plotCanvas.ClearCache()
         self.PopulateROI()
         self.UpdatePlot()
 
+    def SummarizeMUSE(self, MUSE):
+        """Returns the per site statistics of the raw and harmonized
+        residuals in `MUSE` that are plotted, of the controls only if they
+        are marked. Computed once per harmonization, so switching the ROI
+        only draws."""
+        if 'isTrainMUSEHarmonization' in MUSE:
+            MUSE = MUSE[MUSE['isTrainMUSEHarmonization']==1]
+        raw = [x for x in MUSE.columns if x.startswith('RAW_RES_')]
+        columns = raw + [x[4:] for x in raw if x[4:] in MUSE.columns]
+        return SummarizeResiduals(MUSE, columns, by='SITE')
+
     def UpdatePlot(self):
 
         #get current selected combobox item
@@ -186,17 +267,26 @@ class Harmonization(QtWidgets.QWidget,IPlugin):
     def plotMUSE(self,plotOptions):
         self.ui.stackedWidget.setCurrentIndex(1)
 
-        self.plotCanvas.axes1.clear()
-        self.plotCanvas.axes2.clear()
-
         # select roi
         currentROI = plotOptions['ROI']
         h_res = 'RES_'+currentROI
         raw_res = 'RAW_RES_'+currentROI
-        
+
+        # Plots are drawn off-screen and kept per data version and ROI until
+        # new residuals are shown
+        key = (self.datamodel.GetDataVersion(), currentROI)
+        if self.plotCanvas.ShowCached(key):
+            return
+
+        stats, sd = self.summary
+        if raw_res not in sd.index or h_res not in sd.index:
+            print('No residuals of ' + currentROI + ' to plot.')
+            return
+        # sites without residuals of the ROI are not shown
+        stats = stats[stats[('n', raw_res)] > 0]
+
         if 'isTrainMUSEHarmonization' in self.MUSE: 
             print('Plotting controls only')
-            data = self.MUSE[self.MUSE['isTrainMUSEHarmonization']==1]
             cSite = sns.color_palette("Paired", n_colors=22)
             c = cSite.copy()
             cSite[1:] = c[0:-1]
@@ -217,68 +307,20 @@ class Harmonization(QtWidgets.QWidget,IPlugin):
             cSite[20] = (0.5, 0.2, 0.2)
             cSite[21] = (0.2, 0.2, 0.5)
         else:
-            data = self.MUSE
-            self.MUSE.dropna(subset=[raw_res],inplace=True)
-            cSite=sns.color_palette("hls", len(list(self.MUSE.SITE.unique())))
-
-        data.loc[:,'SITE'] = pd.Categorical(data['SITE'])
-        data.loc[:,'SITE'] = data.SITE.cat.remove_unused_categories()
-
-        sd_raw = data[raw_res].std()
-        sd_h = data[h_res].std()
-
-        ci_plus_raw = 0.65*sd_raw
-        ci_minus_raw = -0.65*sd_raw
-
-        ci_plus_h = 0.65*sd_h
-        ci_minus_h = -0.65*sd_h
-
-        PROPS = {
-            'boxprops':{'edgecolor':'none'},
-            'medianprops':{'color':'black'},
-            'whiskerprops':{'color':'black'},
-            'capprops':{'color':'black'}
-        }
-
-        self.plotCanvas.axes1.get_figure().set_tight_layout(True)
-        self.plotCanvas.axes1.set_xlim(-4*sd_raw, 4*sd_raw)
-        sns.set(style='white')
-        a = sns.boxplot(x=raw_res, y="SITE", data=data, palette=cSite,linewidth=.25,showfliers = False,ax=self.plotCanvas.axes1,**PROPS)
-        nobs1 = data['SITE'].value_counts().sort_index(ascending=True).values
-        nobs1 = [str(x) for x in nobs1.tolist()]
-        nobs1 = [i for i in nobs1]
-        labels = [x + ' (N=' for x in self.datamodel.harmonization_model['SITE_labels']]
-        labels = [''.join(i) for i in zip(labels, nobs1)]
-        labels = [x + ')' for x in labels]
-        self.plotCanvas.axes1.axvline(ci_plus_raw,color='grey',ls='--')
-        self.plotCanvas.axes1.axvline(ci_minus_raw,color='grey',ls='--')
-        self.plotCanvas.axes1.yaxis.set_ticks_position('left')
-        self.plotCanvas.axes1.xaxis.set_ticks_position('bottom')
-        a.tick_params(axis='both', which='major', length=4)
-        a.set_xlabel('Residuals before harmonization')
-        
-        self.plotCanvas.axes2.get_figure().set_tight_layout(True)
-        self.plotCanvas.axes2.set_xlim(-4*sd_raw, 4*sd_raw)
-        sns.set(style='white')
-        b = sns.boxplot(x=h_res, y="SITE", data=data, palette=cSite,linewidth=0.25,showfliers = False,ax=self.plotCanvas.axes2,**PROPS)
-        nobs2 = data['SITE'].value_counts().sort_index(ascending=True).values
-        nobs2 = [str(x) for x in nobs2.tolist()]
-        nobs2 = [i for i in nobs2]
-        if nobs1 != nobs2:
+            cSite=sns.color_palette("hls", stats.shape[0])
+
+        nobs = stats[('n', raw_res)].astype(int)
+        if not nobs.equals(stats[('n', h_res)].astype(int)):
             print('not equal sample sizes')
-        a.set_yticklabels(labels)
-        self.plotCanvas.axes2.axvline(ci_plus_h,color='grey',ls='--')
-        self.plotCanvas.axes2.axvline(ci_minus_h,color='grey',ls='--')
-        self.plotCanvas.axes2.yaxis.set_ticks_position('left')
-        self.plotCanvas.axes2.xaxis.set_ticks_position('bottom')
-        b.set(yticklabels=[])
-        b.tick_params(axis='both', which='major', length=4)
-        b.set_xlabel('Residuals after harmonization')
-        b.set_ylabel('')
-        sns.despine(fig=self.plotCanvas.axes1.get_figure(), trim=True)
-        sns.despine(fig=self.plotCanvas.axes2.get_figure(), trim=True)
-
-        self.plotCanvas.draw()
+        labels = [str(x) + ' (N=' + str(n) + ')' for x, n in nobs.items()]
+
+        raw = stats.xs(raw_res, axis=1, level=1)
+        harmonized = stats.xs(h_res, axis=1, level=1)
+        sd_raw, sd_h = sd[raw_res], sd[h_res]
+        # Style of `sns.set(style='white')`, only for this plot
+        style = dict(sns.plotting_context('notebook'), **sns.axes_style('white'))
+        self.plotCanvas.Render(key, lambda fig: PlotMUSE(fig, raw, harmonized, sd_raw, sd_h, labels, cSite),
+                               style)
 
     def OnAddToDataFrame(self):
         print('Saving modified data to pickle file...')
@@ -286,18 +328,31 @@ class Harmonization(QtWidgets.QWidget,IPlugin):
         ROIs_ICV_Sex_Residuals = ['RES_ICV_Sex_' + x for x in self.datamodel.harmonization_model['ROIs']]
         ROIs_Residuals = ['RES_' + x for x in self.datamodel.harmonization_model['ROIs']]
         RAW_Residuals = ['RAW_RES_' + x for x in self.datamodel.harmonization_model['ROIs']]
-        if ('H_MUSE_Volume_47' not in self.datamodel.data.keys()):
-            self.datamodel.data.loc[:,H_ROIs] = self.MUSE[H_ROIs]
+        self.datamodel.data.loc[:,H_ROIs] = self.MUSE[H_ROIs]
         self.datamodel.data.loc[:,ROIs_ICV_Sex_Residuals] = self.MUSE[ROIs_ICV_Sex_Residuals]
         self.datamodel.data.loc[:,ROIs_Residuals] = self.MUSE[ROIs_Residuals]
         self.datamodel.data.loc[:,RAW_Residuals] = self.MUSE[RAW_Residuals]
+        self.harmonized_inputs = self.MUSE_inputs
         self.datamodel.data_changed.emit()
 
+    def OnSaveHarmonizationModelBtnClicked(self):
+        filename, _ = QtWidgets.QFileDialog.getSaveFileName(None,
+        'Save harmonization model file',
+        QtCore.QDir().homePath(),
+        "Pickle files (*.pkl.gz *.pkl);;Model bundles (*.harmonization)")
+
+        if filename == "":
+            print("No file was selected")
+        else:
+            sites = self.datamodel.harmonization_model.get('new_SITE_params', {})
+            print('Saving harmonization model with parameters of %d new sites.' % len(sites))
+            DataIO().SaveHarmonizationModel(self.datamodel.harmonization_model, filename)
+
     def OnDataChanged(self):
         self.ui.stackedWidget.setCurrentIndex(0)
-        self.plotCanvas.axes1.clear()
-        self.plotCanvas.axes2.clear()
+        self.plotCanvas.ClearCache()
         self.MUSE=None
+        self.summary=None
         if ('RES_MUSE_Volume_47' in self.datamodel.GetColumnHeaderNames() and
             'RAW_RES_MUSE_Volume_47' in self.datamodel.GetColumnHeaderNames()):
             self.ui.show_data_Btn.setEnabled(True)
@@ -306,60 +361,143 @@ class Harmonization(QtWidgets.QWidget,IPlugin):
             self.ui.show_data_Btn.setEnabled(False)
 
 
-    def DoHarmonization(self):
+    def DoHarmonization(self, data, model, harmonized_inputs=None):
+        """Harmonizes all rows of `data` with `model`. Returns the harmonized
+        values and residuals and the input hashes of the rows."""
         print('Running harmonization.')
 
-        covars = self.datamodel.data[['SITE','Age','Sex','DLICV_baseline']].copy()
-        covars.loc[:,'Sex'] = covars['Sex'].map({'M':1,'F':0})
-        covars.loc[covars.Age>100, 'Age']=100
-        bayes_data, stand_mean = nh.harmonizationApply(self.datamodel.data[[x for x in self.datamodel.harmonization_model['ROIs']]].values,
-                                                covars,
-                                                self.datamodel.harmonization_model,True)
-
-        Raw_ROIs_Residuals = self.datamodel.data[self.datamodel.harmonization_model['ROIs']].values - stand_mean
-
-        # create list of new SITEs to loop through
-        new_sites = set(self.datamodel.data['SITE'].value_counts().index.tolist())^set(self.datamodel.harmonization_model['SITE_labels'])
+        inputs = HashHarmonizationInputs(data, model)
+        covars = GetHarmonizationCovariates(data)
+        Y = data[model['ROIs']].to_numpy(dtype=np.float64)
+        bayes_data, stand_mean = ApplyHarmonization(Y, covars, model)
 
-        var_pooled = self.datamodel.harmonization_model['var_pooled']
+        Raw_ROIs_Residuals = Y - stand_mean
 
-        if 'UseForComBatGAMHarmonization' in self.datamodel.data.columns:
-            for site in new_sites:
-                missing = np.array(self.datamodel.data['SITE']==site,dtype=bool)
-                training = np.array(self.datamodel.data['UseForComBatGAMHarmonization'],dtype=bool)
-                new_site_is_train = np.logical_and(missing, training)
-
-                if np.count_nonzero(new_site_is_train)<25:
-                    print('New site `'+site+'` has less than 25 reference data points. Skipping harmonization.')
-                    continue
-
-                gamma_hat_site = np.mean(((Raw_ROIs_Residuals[new_site_is_train,:])/np.dot(np.sqrt(var_pooled),np.ones((1,Raw_ROIs_Residuals[new_site_is_train,:].shape[0]))).T),0)
-                gamma_hat_site = gamma_hat_site[:,np.newaxis]
-                delta_hat_site = pow(np.std(((Raw_ROIs_Residuals[new_site_is_train,:])/np.dot(np.sqrt(var_pooled),np.ones((1,Raw_ROIs_Residuals[new_site_is_train,:].shape[0]))).T),0),2)
-                delta_hat_site = delta_hat_site[:,np.newaxis]
-
-                bayes_data[missing,:] = ((Raw_ROIs_Residuals[missing,:]/np.dot(np.sqrt(var_pooled),np.ones((1,Raw_ROIs_Residuals[missing,:].shape[0]))).T) - np.dot(gamma_hat_site,np.ones((1,Raw_ROIs_Residuals[missing,:].shape[0]))).T)*np.dot(np.sqrt(var_pooled),np.ones((1,Raw_ROIs_Residuals[missing,:].shape[0]))).T/np.dot(np.sqrt(delta_hat_site),np.ones((1,Raw_ROIs_Residuals[missing,:].shape[0]))).T + stand_mean[missing,:]
+        if 'UseForComBatGAMHarmonization' in data.columns:
+            # adapt all new SITEs at once, their parameters are kept in the model
+            HarmonizeNewSites(bayes_data, Raw_ROIs_Residuals, stand_mean,
+                              model,
+                              data['SITE'].to_numpy(),
+                              data['UseForComBatGAMHarmonization'].values,
+                              ids=inputs.values)
         else:
             print('Skipping out-of-sample harmonization because `UseForComBatGAMHarmonization` does not exist.')
 
-        if 'isTrainMUSEHarmonization' in self.datamodel.data.columns:
-            muse = pd.concat([self.datamodel.data['isTrainMUSEHarmonization'].copy(), covars, pd.DataFrame(bayes_data, columns=['H_' + s for s in self.datamodel.harmonization_model['ROIs']])],axis=1)
+        # Actual ages as in the batch output, see `MAX_HARMONIZATION_AGE`
+        covars['Age'] = data['Age'].values
+        if 'isTrainMUSEHarmonization' in data.columns:
+            muse = pd.concat([data['isTrainMUSEHarmonization'].copy(), covars, pd.DataFrame(bayes_data, columns=['H_' + s for s in model['ROIs']])],axis=1)
         else:
-            muse = pd.concat([covars,pd.DataFrame(bayes_data, columns=['H_' + s for s in self.datamodel.harmonization_model['ROIs']])],axis=1)
+            muse = pd.concat([covars,pd.DataFrame(bayes_data, columns=['H_' + s for s in model['ROIs']])],axis=1)
 
-        start_index = len(self.datamodel.harmonization_model['SITE_labels'])
-        sex_icv_effect = np.dot(muse[['Sex','DLICV_baseline']].copy(), self.datamodel.harmonization_model['B_hat'][start_index:(start_index+2),:])
-        ROIs_ICV_Sex_Residuals = ['RES_ICV_Sex_' + x for x in self.datamodel.harmonization_model['ROIs']]
-        muse.loc[:,ROIs_ICV_Sex_Residuals] = muse[['H_' + x for x in self.datamodel.harmonization_model['ROIs']]].values - sex_icv_effect
+        start_index = len(model['SITE_labels'])
+        sex_icv_effect = np.dot(muse[['Sex','DLICV_baseline']].copy(), model['B_hat'][start_index:(start_index+2),:])
+        ROIs_ICV_Sex_Residuals = ['RES_ICV_Sex_' + x for x in model['ROIs']]
+        muse.loc[:,ROIs_ICV_Sex_Residuals] = muse[['H_' + x for x in model['ROIs']]].values - sex_icv_effect
 
-        muse.loc[:,'Sex'] = muse['Sex'].map({1:'M',0:'F'})
-        ROIs_Residuals = ['RES_' + x for x in self.datamodel.harmonization_model['ROIs']]
-        RAW_Residuals = ['RAW_RES_' + x for x in self.datamodel.harmonization_model['ROIs']]
+        muse['Sex'] = muse['Sex'].map({1:'M',0:'F'})
+        ROIs_Residuals = ['RES_' + x for x in model['ROIs']]
+        RAW_Residuals = ['RAW_RES_' + x for x in model['ROIs']]
         muse.loc[:,ROIs_Residuals] = bayes_data-stand_mean
         muse.loc[:,RAW_Residuals] = Raw_ROIs_Residuals
         print('Harmonization done.')
 
-        return muse
+        return muse, inputs
+
+
+    def DoIncrementalHarmonization(self, data, model, harmonized_inputs=None):
+        """Harmonizes only rows without harmonized values or whose inputs
+        changed since the harmonization with `harmonized_inputs` and merges
+        them with the harmonized values already in the data. Returns them
+        and the input hashes of the rows."""
+        inputs = HashHarmonizationInputs(data, model)
+        lacking, changed = GetRowsToHarmonize(data, model, inputs, harmonized_inputs)
+        rows = lacking | changed
+        print('Running harmonization on %d of %d rows (%d new, %d changed).'
+              % (rows.sum(), data.shape[0], lacking.sum(), changed.sum()))
+
+        # Reference rows of changed rows were used before, so only the new
+        # ones update the parameters of known sites
+        harmonized = HarmonizeData(data, model, rows, update=lacking)
+
+        columns = GetHarmonizationColumns(model)
+        if set(columns).issubset(data.columns):
+            muse = data[columns].copy()
+        else:
+            muse = pd.DataFrame(np.nan, index=data.index, columns=columns)
+        muse.iloc[np.flatnonzero(rows), :] = harmonized.values
+
+        # Actual ages as in the batch output, see `MAX_HARMONIZATION_AGE`
+        covars = data[['SITE','Age','Sex','DLICV_baseline']].copy()
+        if 'isTrainMUSEHarmonization' in data.columns:
+            muse = pd.concat([data['isTrainMUSEHarmonization'].copy(), covars, muse], axis=1)
+        else:
+            muse = pd.concat([covars, muse], axis=1)
+        print('Harmonization done.')
+
+        return muse, inputs
+
+def ReadHarmonizationModelFile(job, filename):
+    """Job reading a harmonization model. A pickle file gets a compiled model
+    bundle, so it loads without statsmodels objects next time."""
+    dio = DataIO()
+    job.Progress('Reading ' + filename, 0)
+    source = None if dio.IsArrayBundle(filename) else dio.GetFileStamp(filename)
+    model = dio.ReadHarmonizationModel(filename)
+    if (isinstance(model, dict) and 'SITE_labels' in model and
+        not dio.IsArrayBundle(filename) and not dio.HasBundle(filename, '.harmonization')):
+        job.Progress('Converting ' + filename, 0)
+        dio.ConvertHarmonizationModel(filename, model, source)
+    return model
+
+def PlotMUSE(fig, raw, harmonized, sd_raw, sd_h, labels, palette):
+    """Draws the box plots of the raw and harmonized residuals of an ROI
+    per site on `fig`, from their statistics and SDs. Runs on the render
+    worker."""
+    fig.set_tight_layout(True)
+
+    ci_plus_raw = 0.65*sd_raw
+    ci_minus_raw = -0.65*sd_raw
+
+    ci_plus_h = 0.65*sd_h
+    ci_minus_h = -0.65*sd_h
+
+    a = fig.add_subplot(121)
+    plotResiduals(a, raw, palette)
+    a.set_xlim(-4*sd_raw, 4*sd_raw)
+    a.axvline(ci_plus_raw,color='grey',ls='--')
+    a.axvline(ci_minus_raw,color='grey',ls='--')
+    a.set_yticklabels(labels)
+    a.set_xlabel('Residuals before harmonization')
+    a.set_ylabel('SITE')
+
+    b = fig.add_subplot(122)
+    plotResiduals(b, harmonized, palette)
+    b.set_xlim(-4*sd_raw, 4*sd_raw)
+    b.axvline(ci_plus_h,color='grey',ls='--')
+    b.axvline(ci_minus_h,color='grey',ls='--')
+    b.set(yticklabels=[])
+    b.set_xlabel('Residuals after harmonization')
+    b.set_ylabel('')
+    sns.despine(fig=fig, trim=True)
+
+def plotResiduals(axes, stats, palette):
+    """Draws horizontal box plots from `stats` of a residual, see
+    `SummarizeResiduals`, one per site from top to bottom, in the style of
+    `sns.boxplot` without outliers."""
+    boxes = stats[['q1', 'med', 'q3', 'whislo', 'whishi']].to_dict('records')
+    lines = {'color': 'black', 'linewidth': .25}
+    artists = axes.bxp(boxes, positions=np.arange(len(boxes)), widths=.8, vert=False,
+                       patch_artist=True, showfliers=False, manage_ticks=False,
+                       boxprops={'edgecolor': 'none', 'linewidth': .25},
+                       medianprops=lines, whiskerprops=lines, capprops=lines)
+    for box, color in zip(artists['boxes'], palette):
+        box.set_facecolor(sns.desaturate(color, .75))
+    axes.set_yticks(np.arange(len(boxes)))
+    axes.set_ylim(len(boxes) - .5, -.5)
+    axes.yaxis.set_ticks_position('left')
+    axes.xaxis.set_ticks_position('bottom')
+    axes.tick_params(axis='both', which='major', length=4)
 
 def wrap_by_word(s, n):
     a = s.split()
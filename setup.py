@@ -29,5 +29,6 @@ if __name__ == "__main__":
                         'plugin2=plugins:ScatterPlotSPAREs',
                         'plugin3=plugins:P2'],
                         'console_scripts': ['BrainChart=BrainChart:main',
-                                            'QtBrainChart=QtBrainChartGUI:main']}
+                                            'QtBrainChart=QtBrainChartGUI:main',
+                                            'nibax-batch=BrainChart.batch:main']}
                   )
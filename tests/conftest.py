@@ -0,0 +1,145 @@
+# This Python file uses the following encoding: utf-8
+"""
+contact: software@cbica.upenn.edu
+Copyright (c) 2018 University of Pennsylvania. All rights reserved.
+Use of this source code is governed by license located in license file: https://github.com/CBICA/BrainChart/blob/main/LICENSE
+"""
+
+import copy
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.preprocessing import StandardScaler
+from sklearn.svm import SVC, SVR
+
+
+def MakeHarmonizationData(n=1200, n_rois=4, sites=('A', 'B', 'C'), seed=1):
+    """Returns synthetic MUSE volumes with site, age, Sex and ICV effects
+    in the columns BrainChart uses."""
+    rng = np.random.default_rng(seed)
+    ROIs = ['MUSE_Volume_%d' % (47 + i) for i in range(n_rois)]
+    data = pd.DataFrame({'participant_id': ['P%05d' % (i) for i in range(n)],
+                         'SITE': rng.choice(list(sites), n),
+                         'Age': rng.uniform(25, 95, n),
+                         'Sex': rng.choice(['M', 'F'], n),
+                         'DLICV_baseline': rng.normal(1450000, 100000, n)})
+    shift = data['SITE'].map(lambda s: 10. * (sum(map(ord, s)) % 7 - 3)).values
+    sex = (data['Sex'] == 'M').values
+    for i, roi in enumerate(ROIs):
+        data[roi] = (1000 + 10 * i - 3 * (data['Age'] - 20) ** 1.2 / 5 + 20 * sex +
+                     data['DLICV_baseline'] / 10000 + shift + rng.normal(0, 20 + i, n))
+    return data, ROIs
+
+
+@pytest.fixture
+def make_harmonization_data():
+    """Returns `MakeHarmonizationData` for tests that need other sites."""
+    return MakeHarmonizationData
+
+
+@pytest.fixture
+def harmonization_data():
+    """Returns a copy of the synthetic harmonization data and the ROIs."""
+    return MakeHarmonizationData()
+
+
+@pytest.fixture(scope='session')
+def harmonization():
+    """Returns a neuroHarmonize GAM model trained on synthetic data with the
+    covariates SITE, Age, Sex (1 for M) and DLICV_baseline, the data and
+    the covariates as passed to `harmonizationLearn`. Shared by all tests,
+    use `harmonization_model` to change the model."""
+    nh = pytest.importorskip('neuroHarmonize')
+    data, ROIs = MakeHarmonizationData()
+    covars = pd.DataFrame({'SITE': data['SITE'], 'Age': data['Age'],
+                           'Sex': (data['Sex'] == 'M').astype(float),
+                           'DLICV_baseline': data['DLICV_baseline']})
+    model, _ = nh.harmonizationLearn(data[ROIs].values, covars, smooth_terms=['Age'],
+                                     smooth_term_bounds=(20, 100))
+    model['ROIs'] = ROIs
+    return model, data, covars
+
+
+@pytest.fixture
+def harmonization_model(harmonization):
+    """Returns a copy of the harmonization model that a test can change."""
+    return copy.deepcopy(harmonization[0])
+
+
+@pytest.fixture
+def harmonization_apply(monkeypatch):
+    """Returns a function that applies a model to data (rows x ROIs) with
+    `harmonizationApply` and returns the harmonized data and the
+    standardized mean including the covariate effects that it subtracts."""
+    nh = pytest.importorskip('neuroHarmonize')
+    module = sys.modules['neuroHarmonize.harmonizationApply']
+    standardize = module.applyStandardizationAcrossFeatures
+    means = []
+
+    def Standardize(*args):
+        result = standardize(*args)
+        means.append(result[1] + result[3])
+        return result
+
+    def Apply(data, covars, model):
+        del means[:]
+        bayes_data, _ = nh.harmonizationApply(data, covars, model, True)
+        return bayes_data, means[0].T
+
+    monkeypatch.setattr(module, 'applyStandardizationAcrossFeatures', Standardize)
+    return Apply
+
+
+def MakeSPAREData(n=400, p=8, seed=0):
+    """Returns synthetic data with repeated participants and missing
+    predictors."""
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame(rng.normal(1000, 100, (n, p)),
+                        columns=['RES_ICV_Sex_MUSE_Volume_%d' % (i) for i in range(p)])
+    data.insert(0, 'participant_id', ['P%04d' % (i) for i in rng.integers(0, n // 2, n)])
+    data['Age'] = rng.uniform(30, 90, n)
+    data.iloc[::17, 1] = np.nan
+    return data
+
+
+def MakeSPAREModel(data, kind, kernel, folds=4, seed=1):
+    """Returns a SPARE-* model dictionary with `folds` small SVMs trained on
+    half of the participants of `data`."""
+    rng = np.random.default_rng(seed)
+    predictors = [c for c in data.columns if c.startswith('RES_')]
+    ids = pd.unique(data['participant_id'])
+    parts = np.array_split(rng.choice(ids, len(ids) // 2, replace=False), folds)
+    model = {'predictors': predictors, 'scaler': [], 'svm': [], 'train': [],
+             'validation': [], 'bias_ints': [], 'bias_slopes': []}
+    complete = data.dropna(subset=predictors)
+    for i in range(folds):
+        train = np.concatenate([parts[j] for j in range(folds) if j != i])
+        rows = complete[complete['participant_id'].isin(train)]
+        scaler = StandardScaler().fit(rows[predictors].values)
+        X = scaler.transform(rows[predictors].values)
+        if kind == 'BrainAge':
+            svm = SVR(kernel=kernel).fit(X, rows['Age'].values)
+        else:
+            svm = SVC(kernel=kernel).fit(X, (rows['Age'].values > 60).astype(int))
+        model['scaler'].append(scaler)
+        model['svm'].append(svm)
+        model['train'].append(train)
+        model['validation'].append(parts[i])
+        model['bias_ints'].append(rng.normal())
+        model['bias_slopes'].append(1 + 0.1 * rng.normal())
+    if kind == 'AD':
+        del model['bias_ints'], model['bias_slopes']
+    return model
+
+
+@pytest.fixture
+def spare_data():
+    """Returns synthetic data for SPARE-* models."""
+    return MakeSPAREData()
+
+
+@pytest.fixture
+def make_spare_model():
+    """Returns `MakeSPAREModel`."""
+    return MakeSPAREModel
@@ -0,0 +1,143 @@
+# This Python file uses the following encoding: utf-8
+"""
+contact: software@cbica.upenn.edu
+Copyright (c) 2018 University of Pennsylvania. All rights reserved.
+Use of this source code is governed by license located in license file: https://github.com/CBICA/BrainChart/blob/main/LICENSE
+"""
+
+import gzip
+import io
+import os
+import threading
+import zlib
+import numpy as np
+import pandas as pd
+import pytest
+
+from BrainChart.columnstore import ColumnStore
+from BrainChart.dataio import BlockedGzipReader, BlockedGzipWriter, DataIO
+
+
+def test_optimize_data_types(harmonization_data):
+    data, ROIs = harmonization_data
+    dio = DataIO()
+    compact = dio.OptimizeDataTypes(data, report=False)
+    # Volumes and ages fit into float32, ICVs of about 1.5e6 do not
+    assert (compact[ROIs + ['Age']].dtypes == np.float32).all()
+    assert compact['DLICV_baseline'].dtype == np.float64
+    assert compact['SITE'].dtype.name == 'category'
+    assert compact['participant_id'].dtype == object
+
+    restored = dio.RestoreDataTypes(compact)
+    assert (restored.dtypes == data.dtypes).all()
+    assert np.abs(restored[ROIs].values - data[ROIs].values).max() <= 1e-3
+
+
+def test_column_store_dtypes(harmonization_data, tmp_path):
+    data, ROIs = harmonization_data
+    filename = str(tmp_path / 'data.feather')
+    DataIO().SaveColumnarFile(data, filename)
+    store = ColumnStore(filename, dtype_tolerance=1e-3)
+    columns = store.GetColumns(ROIs + ['DLICV_baseline'])
+    for c in ['SITE', 'Age'] + ROIs + ['DLICV_baseline']:
+        loaded = store.keys[c] if c in store.key_columns else columns[c]
+        assert store.dtypes[c] == loaded.dtype
+
+
+def test_columnar_copy(harmonization_data, tmp_path):
+    data, ROIs = harmonization_data
+    data.index = data.index + 10
+    filename = str(tmp_path / 'data.pkl')
+    dio = DataIO()
+    dio.SavePickleFile(data, filename)
+    assert not dio.HasColumnarCopy(filename)
+
+    columnar = dio.ConvertToColumnar(filename)
+    assert columnar == str(tmp_path / 'data.feather')
+    assert dio.HasColumnarCopy(filename)
+    pd.testing.assert_frame_equal(dio.ReadDataFile(filename), data)
+    pd.testing.assert_frame_equal(dio.ReadDataFile(filename, ['SITE'] + ROIs),
+                                  data[['SITE'] + ROIs])
+
+    # Any change of the source makes the copy stale, also an older time
+    stamp = dio.GetFileStamp(filename)
+    os.utime(filename, ns=(stamp['mtime_ns'] - 10**9, stamp['mtime_ns'] - 10**9))
+    assert not dio.HasColumnarCopy(filename)
+    changed = data.iloc[:-1]
+    dio.SavePickleFile(changed, filename)
+    assert not dio.HasColumnarCopy(filename)
+    pd.testing.assert_frame_equal(dio.ReadDataFile(filename), changed)
+
+
+def test_columnar_copy_source(harmonization_data, tmp_path):
+    data, ROIs = harmonization_data
+    filename = str(tmp_path / 'data.pkl')
+    dio = DataIO()
+    dio.SavePickleFile(data, filename)
+    # The copy records the stamp taken before the data was read, so a file
+    # changed while reading is converted again
+    source = dio.GetFileStamp(filename)
+    dio.SavePickleFile(data.iloc[:-1], filename)
+    dio.ConvertToColumnar(filename, data, source)
+    assert not dio.HasColumnarCopy(filename)
+    dio.ConvertToColumnar(filename)
+    assert dio.HasColumnarCopy(filename)
+
+
+def GetPoolThreads():
+    """Returns the threads of thread pools that are alive."""
+    return [t for t in threading.enumerate() if t.name.startswith('ThreadPoolExecutor')]
+
+
+@pytest.mark.parametrize('extension', ['.pkl', '.pkl.gz', '.pkl.zst'])
+def test_pickle_file(harmonization_data, tmp_path, extension):
+    if extension == '.pkl.zst':
+        pytest.importorskip('zstandard')
+    data, ROIs = harmonization_data
+    filename = str(tmp_path / ('data' + extension))
+    threads = GetPoolThreads()
+    dio = DataIO()
+    dio.SavePickleFile(data, filename)
+    pd.testing.assert_frame_equal(dio.ReadPickleFile(filename), data)
+    # Compression threads are stopped when the streams are closed
+    assert GetPoolThreads() == threads
+    if extension == '.pkl.gz':
+        # Blocked gzip files are plain gzip files
+        with open(filename, 'rb') as f:
+            assert BlockedGzipReader.IsBlocked(f)
+        pd.testing.assert_frame_equal(pd.read_pickle(filename, compression='gzip'), data)
+
+
+def test_single_stream_gzip(harmonization_data, tmp_path):
+    data, ROIs = harmonization_data
+    filename = str(tmp_path / 'data.pkl.gz')
+    data.to_pickle(filename, compression='gzip')
+    with open(filename, 'rb') as f:
+        assert not BlockedGzipReader.IsBlocked(f)
+    pd.testing.assert_frame_equal(DataIO().ReadPickleFile(filename), data)
+
+
+def test_blocked_gzip(tmp_path):
+    payload = np.random.default_rng(0).integers(0, 16, 100003, dtype=np.uint8).tobytes()
+    filename = str(tmp_path / 'data.gz')
+    threads = GetPoolThreads()
+    with open(filename, 'wb') as f:
+        with BlockedGzipWriter(f, blocksize=4096, threads=3) as writer:
+            writer.write(payload[:5000])
+            writer.write(payload[5000:])
+    with gzip.open(filename, 'rb') as f:
+        assert f.read() == payload
+    with open(filename, 'rb') as f:
+        with io.BufferedReader(BlockedGzipReader(f, threads=3), buffer_size=1000) as reader:
+            assert reader.read() == payload
+    assert GetPoolThreads() == threads
+
+    # Decompression threads are stopped if reading fails
+    with open(filename, 'r+b') as f:
+        f.seek(4096)
+        f.write(b'\x00' * 64)
+    with open(filename, 'rb') as f:
+        with pytest.raises((IOError, zlib.error)):
+            with io.BufferedReader(BlockedGzipReader(f, threads=3)) as reader:
+                reader.read()
+    assert GetPoolThreads() == threads
@@ -0,0 +1,169 @@
+# This Python file uses the following encoding: utf-8
+"""
+contact: software@cbica.upenn.edu
+Copyright (c) 2018 University of Pennsylvania. All rights reserved.
+Use of this source code is governed by license located in license file: https://github.com/CBICA/BrainChart/blob/main/LICENSE
+"""
+
+import copy
+import numpy as np
+import pandas as pd
+import pytest
+
+from BrainChart.dataio import DataIO
+from BrainChart.processes import Processes
+from BrainChart.harmonization import (ApplyHarmonization, CompileHarmonizationModel,
+                                       HarmonizeData, HarmonizeNewSites, SiteRegistry,
+                                       MAX_HARMONIZATION_AGE)
+
+
+@pytest.fixture
+def residuals():
+    """Returns raw residuals, standardized means, sites, reference rows and
+    a model that only knows the sites A and B."""
+    rng = np.random.default_rng(0)
+    n, p = 3000, 5
+    sites = np.array(['A', 'B', 'N1', 'N2', 'N3', 'small'], dtype=object)
+    site = rng.choice(sites[:-1], n)
+    site[:10] = 'small'
+    shift = pd.Series(site).map(lambda s: sum(map(ord, s)) % 5 - 2.).values[:, None]
+    R = rng.normal(0, 2, (n, p)) + shift
+    stand_mean = rng.normal(100, 10, (n, p))
+    reference = rng.random(n) < .5
+    model = {'SITE_labels': ['A', 'B'], 'var_pooled': rng.uniform(1, 4, (p, 1))}
+    return R, stand_mean, site, reference, model
+
+
+def HarmonizeNewSitesBaseline(bayes_data, R, stand_mean, model, site, reference):
+    """Original per-site loop of the harmonization plugin."""
+    new_sites = set(pd.Series(site).value_counts().index.tolist()) ^ set(model['SITE_labels'])
+    var_pooled = model['var_pooled']
+    for s in new_sites:
+        missing = np.array(site == s, dtype=bool)
+        new_site_is_train = np.logical_and(missing, np.array(reference, dtype=bool))
+        if np.count_nonzero(new_site_is_train) < 25:
+            continue
+        sd = np.dot(np.sqrt(var_pooled), np.ones((1, np.count_nonzero(new_site_is_train)))).T
+        gamma = np.mean(R[new_site_is_train, :] / sd, 0)[:, None]
+        delta = pow(np.std(R[new_site_is_train, :] / sd, 0), 2)[:, None]
+        n = np.count_nonzero(missing)
+        sd = np.dot(np.sqrt(var_pooled), np.ones((1, n))).T
+        bayes_data[missing, :] = ((R[missing, :] / sd - np.dot(gamma, np.ones((1, n))).T) * sd /
+                                  np.dot(np.sqrt(delta), np.ones((1, n))).T + stand_mean[missing, :])
+
+
+def test_harmonize_new_sites(residuals):
+    R, stand_mean, site, reference, model = residuals
+    expected = np.full(R.shape, np.nan)
+    HarmonizeNewSitesBaseline(expected, R, stand_mean, model, site, reference)
+
+    y = np.full(R.shape, np.nan)
+    registry = HarmonizeNewSites(y, R, stand_mean, model, site, reference)
+    assert np.array_equal(np.isnan(y), np.isnan(expected))
+    np.testing.assert_allclose(y, expected, rtol=1e-12)
+    # Sites with too few reference rows are neither harmonized nor stored
+    assert np.isnan(y[site == 'small']).all()
+    assert sorted(registry.ToFrame().index.unique(0)) == ['N1', 'N2', 'N3']
+
+    # Stored sites are looked up and not refitted from other reference rows
+    z = np.full(R.shape, np.nan)
+    HarmonizeNewSites(z, R, stand_mean, model, site, ~reference)
+    assert np.array_equal(z, y, equal_nan=True)
+
+
+def test_site_registry_update(residuals):
+    R, stand_mean, site, reference, model = residuals
+    Z = np.array(R)
+    Z[::7, 1] = np.nan
+    ids = np.arange(Z.shape[0], dtype=np.uint64)
+    full = SiteRegistry(dict(model))
+    full.Fit(Z, site, reference, ids=ids)
+
+    # Merging the reference rows in two parts gives the parameters of one fit
+    half = np.arange(Z.shape[0]) < Z.shape[0] // 2
+    registry = SiteRegistry(dict(model))
+    registry.Fit(Z, site, reference & half, ids=ids)
+    registry.Fit(Z, site, reference, update=True, ids=ids)
+    assert sorted(registry.params) == sorted(full.params)
+    for s in full.params:
+        for expected, y in zip(full.GetParameters(s), registry.GetParameters(s)):
+            np.testing.assert_allclose(y, expected, rtol=1e-10)
+        assert registry.params[s]['n'] == full.params[s]['n']
+        assert np.array_equal(registry.GetIds(s), full.GetIds(s))
+
+    # Rows that were merged before are skipped
+    registry.Fit(Z, site, reference, update=True, ids=ids)
+    for s in full.params:
+        np.testing.assert_allclose(registry.GetParameters(s)[1], full.GetParameters(s)[1], rtol=1e-10)
+
+
+def test_harmonize_data_rows(harmonization_model, make_harmonization_data):
+    data, ROIs = make_harmonization_data(n=600, sites=('A', 'B', 'C', 'D', 'E'), seed=2)
+    data['UseForComBatGAMHarmonization'] = np.arange(data.shape[0]) % 3 > 0
+    expected = HarmonizeData(data, copy.deepcopy(harmonization_model))
+
+    # Only the selected rows are returned, new sites are fitted from all
+    # their reference rows, and the rest are harmonized with the stored sites
+    rows = np.arange(data.shape[0]) < 200
+    model = copy.deepcopy(harmonization_model)
+    y = pd.concat([HarmonizeData(data, model, rows), HarmonizeData(data, model, ~rows)])
+    pd.testing.assert_frame_equal(y, expected, rtol=1e-10)
+    assert sorted(model['new_SITE_params']) == ['D', 'E']
+
+
+def test_apply_harmonization(harmonization, harmonization_apply):
+    model, data, covars = harmonization
+    Y = data[model['ROIs']].values
+    expected = harmonization_apply(Y, covars, model)
+    for m in (model, CompileHarmonizationModel(model)):
+        for y, x in zip(ApplyHarmonization(Y, covars, m), expected):
+            np.testing.assert_allclose(y, x, rtol=1e-10)
+
+    # Rows of sites that are not part of the model are NaN
+    covars = covars.assign(SITE=np.where(np.arange(covars.shape[0]) % 5 == 0, 'N', covars['SITE']))
+    bayes_data, stand_mean = ApplyHarmonization(Y, covars, model)
+    new = (covars['SITE'] == 'N').values
+    assert np.isnan(bayes_data[new]).all() and not np.isnan(bayes_data[~new]).any()
+    np.testing.assert_allclose(stand_mean, expected[1], rtol=1e-10)
+
+
+def test_harmonization_bundle(harmonization_model, make_harmonization_data, tmp_path):
+    data, ROIs = make_harmonization_data(n=600, sites=('A', 'B', 'C', 'D'), seed=2)
+    data['UseForComBatGAMHarmonization'] = True
+    expected = HarmonizeData(data, harmonization_model)
+    filename = str(tmp_path / 'model.pkl.gz')
+    dio = DataIO()
+    dio.SavePickleFile(harmonization_model, filename)
+    assert dio.ConvertHarmonizationModel(filename) == str(tmp_path / 'model.harmonization')
+    assert dio.HasBundle(filename, '.harmonization')
+
+    # The bundle holds the parameters of new sites and gives the same results
+    model = dio.ReadHarmonizationModel(filename)
+    assert 'bsplines_constructor' not in model['smooth_model']
+    assert list(model['new_SITE_params']) == ['D']
+    for name, x in harmonization_model['new_SITE_params']['D'].items():
+        assert np.array_equal(model['new_SITE_params']['D'][name], x)
+    pd.testing.assert_frame_equal(HarmonizeData(data, model), expected, rtol=1e-10)
+
+    # Changed arrays are rejected
+    path = str(tmp_path / 'model.harmonization' / 'B_hat.npy')
+    a = np.load(path)
+    a[0, 0] += 1.
+    np.save(path, a)
+    with pytest.raises(ValueError):
+        dio.ReadHarmonizationModel(filename)
+
+
+def test_harmonize_data_age(harmonization_model, harmonization_data):
+    data, ROIs = harmonization_data
+    old = data.index[:100]
+    data.loc[old, 'Age'] = np.linspace(MAX_HARMONIZATION_AGE, 120, 100)
+    capped = data.assign(Age=np.minimum(data['Age'], MAX_HARMONIZATION_AGE))
+
+    # Older ages are harmonized as the oldest age of the splines, the batch
+    # processing keeps the actual ages
+    expected = HarmonizeData(capped, harmonization_model)
+    pd.testing.assert_frame_equal(HarmonizeData(data, harmonization_model), expected)
+    processed = Processes().DoHarmonization(data.copy(), harmonization_model)
+    pd.testing.assert_series_equal(processed['Age'], data['Age'])
+    pd.testing.assert_frame_equal(processed[expected.columns], expected)
@@ -0,0 +1,41 @@
+# This Python file uses the following encoding: utf-8
+"""
+contact: software@cbica.upenn.edu
+Copyright (c) 2018 University of Pennsylvania. All rights reserved.
+Use of this source code is governed by license located in license file: https://github.com/CBICA/BrainChart/blob/main/LICENSE
+"""
+
+import numpy as np
+import pytest
+
+from BrainChart.datamodel import DataModel
+from BrainChart.normative import NormativeModel
+
+
+def test_predict(harmonization, harmonization_apply):
+    model, data, covars = harmonization
+    assert list(model['Covariates']) == ['SITE', 'Age', 'Sex', 'DLICV_baseline']
+    _, expected = harmonization_apply(data[model['ROIs']].values, covars, model)
+
+    normative = NormativeModel(model)
+    # Names of the model and of the GUI, Sex as letters and as numbers
+    for y in (normative.Predict(Age=covars['Age'].values, Sex=covars['Sex'].values,
+                                DLICV_baseline=covars['DLICV_baseline'].values),
+              normative.Predict(Age=data['Age'].values, Sex=data['Sex'].values,
+                                ICV=data['DLICV_baseline'].values)):
+        np.testing.assert_allclose(y, expected, rtol=1e-10)
+
+
+def test_predict_missing_covariate(harmonization):
+    with pytest.raises(ValueError):
+        NormativeModel(harmonization[0]).Predict(Age=50., Sex=0.)
+
+
+def test_normative_range(harmonization_model):
+    datamodel = DataModel()
+    datamodel.SetHarmonizationModel(harmonization_model)
+    age, y, z = datamodel.GetNormativeRange('MUSE_Volume_47', sex=1, icv=1450000)
+    expected = NormativeModel(harmonization_model).Predict(
+        Age=age.values, Sex=1, ICV=1450000, rois=['MUSE_Volume_47'])[:, 0]
+    np.testing.assert_allclose(y, expected, rtol=1e-12)
+    assert np.isfinite(y).any() and np.isfinite(z)
@@ -0,0 +1,35 @@
+# This Python file uses the following encoding: utf-8
+"""
+contact: software@cbica.upenn.edu
+Copyright (c) 2018 University of Pennsylvania. All rights reserved.
+Use of this source code is governed by license located in license file: https://github.com/CBICA/BrainChart/blob/main/LICENSE
+"""
+
+import numpy as np
+import pandas as pd
+from matplotlib.cbook import boxplot_stats
+
+from BrainChart.harmonization import SummarizeResiduals
+
+
+def test_summarize_residuals(harmonization_data):
+    data, ROIs = harmonization_data
+    data.loc[::11, ROIs[1]] = np.nan
+    data.loc[data.index[:50], ROIs[0]] = 1e5
+    # Groups with few and tied values, whose whiskers are the box
+    data.loc[data.index[:4], 'SITE'] = 'small'
+    data.loc[data.index[:4], ROIs[2]] = [0., 0., 0., 1.]
+    data.loc[data.index[4], 'SITE'] = 'one'
+
+    stats, sd = SummarizeResiduals(data, ROIs, chunksize=3)
+    assert list(stats.index) == sorted(data['SITE'].unique())
+    pd.testing.assert_series_equal(sd, data[ROIs].std())
+    for site, rows in data.groupby('SITE'):
+        for roi in ROIs:
+            values = rows[roi].dropna().values
+            expected = boxplot_stats(values)[0]
+            for name in ('q1', 'med', 'q3', 'whislo', 'whishi'):
+                assert np.isclose(stats.loc[site, (name, roi)], expected[name], rtol=1e-12), (site, roi, name)
+            assert stats.loc[site, ('n', roi)] == len(values)
+            if len(values) > 1:
+                assert np.isclose(stats.loc[site, ('sd', roi)], np.std(values, ddof=1), rtol=1e-12)
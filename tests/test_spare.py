@@ -0,0 +1,109 @@
+# This Python file uses the following encoding: utf-8
+"""
+contact: software@cbica.upenn.edu
+Copyright (c) 2018 University of Pennsylvania. All rights reserved.
+Use of this source code is governed by license located in license file: https://github.com/CBICA/BrainChart/blob/main/LICENSE
+"""
+
+import joblib
+import numpy as np
+import pytest
+
+from BrainChart.dataio import DataIO
+from BrainChart.spare import SPAREEnsemble
+
+# Tolerance of the linear fast path, which sums the folded weights in a
+# different order than the fold loop (AD scores can be close to zero)
+LINEAR_RTOL = 1e-10
+LINEAR_ATOL = 1e-10
+
+
+def PredictBaseline(data, model, kind):
+    """Returns the scores of the original fold loop."""
+    idx = ~data[model['predictors'][0]].isnull()
+    y_hat_test = np.zeros((np.sum(idx),))
+    n_ensembles = np.zeros((np.sum(idx),))
+    for i, _ in enumerate(model['scaler']):
+        test = (np.logical_not(data[idx]['participant_id'].isin(np.concatenate(model['train']))) |
+                data[idx]['participant_id'].isin(model['validation'][i]))
+        X = model['scaler'][i].transform(data[idx].loc[test, model['predictors']].values)
+        if kind == 'BrainAge':
+            y_hat_test[test] += (model['svm'][i].predict(X) - model['bias_ints'][i]) / model['bias_slopes'][i]
+        else:
+            y_hat_test[test] += model['svm'][i].decision_function(X)
+        n_ensembles[test] += 1.
+    y_hat_test /= n_ensembles
+    y_hat = np.full((data.shape[0],), np.nan)
+    y_hat[idx] = y_hat_test
+    return y_hat
+
+
+@pytest.mark.parametrize('kind', ['BrainAge', 'AD'])
+def test_predict_folds(kind, spare_data, make_spare_model):
+    data = spare_data
+    model = make_spare_model(data, kind, 'rbf')
+    ensemble = SPAREEnsemble(model, kind)
+    assert not ensemble.IsLinear()
+    y = ensemble.Predict(data)
+    assert np.array_equal(y, PredictBaseline(data, model, kind), equal_nan=True)
+
+
+@pytest.mark.parametrize('kind', ['BrainAge', 'AD'])
+def test_predict_folds_parallel(kind, spare_data, make_spare_model):
+    data = spare_data
+    model = make_spare_model(data, kind, 'rbf')
+    y = SPAREEnsemble(model, kind).Predict(data, n_jobs=2)
+    assert np.array_equal(y, PredictBaseline(data, model, kind), equal_nan=True)
+
+
+@pytest.mark.parametrize('kind', ['BrainAge', 'AD'])
+def test_predict_linear(kind, spare_data, make_spare_model):
+    data = spare_data
+    model = make_spare_model(data, kind, 'linear')
+    baseline = PredictBaseline(data, model, kind)
+
+    ensemble = SPAREEnsemble(model, kind)
+    assert ensemble.IsLinear()
+    y = ensemble.Predict(data)
+    assert np.array_equal(np.isnan(y), np.isnan(baseline))
+    np.testing.assert_allclose(y, baseline, rtol=LINEAR_RTOL, atol=LINEAR_ATOL)
+
+    # Without the fast path the folds give the baseline exactly
+    y = SPAREEnsemble(model, kind, compile_linear=False).Predict(data)
+    assert np.array_equal(y, baseline, equal_nan=True)
+
+
+@pytest.mark.parametrize('kernel', ['rbf', 'linear'])
+def test_bundle(kernel, spare_data, make_spare_model, tmp_path):
+    data = spare_data
+    models = (make_spare_model(data, 'BrainAge', kernel), make_spare_model(data, 'AD', kernel))
+    filename = str(tmp_path / 'spare.pkl.gz')
+    joblib.dump(models, filename)
+    dio = DataIO()
+    assert not dio.HasSPAREBundle(filename)
+    bundle = dio.ConvertSPAREModel(filename)
+    assert bundle == str(tmp_path / 'spare.spare')
+    assert dio.HasSPAREBundle(filename)
+
+    # Model files are read from their bundle with the same predictions
+    for kind, model, bundled in zip(('BrainAge', 'AD'), models, dio.ReadSPAREModel(filename)):
+        assert bundled['bundle'] == bundle
+        y = SPAREEnsemble(bundled, kind).Predict(data)
+        expected = SPAREEnsemble(model, kind).Predict(data)
+        assert np.array_equal(np.isnan(y), np.isnan(expected))
+        np.testing.assert_allclose(y, expected, rtol=LINEAR_RTOL, atol=LINEAR_ATOL)
+
+
+def test_bundle_checksum(spare_data, make_spare_model, tmp_path):
+    data = spare_data
+    dirname = str(tmp_path / 'spare.spare')
+    DataIO().SaveSPAREModel(make_spare_model(data, 'BrainAge', 'rbf'),
+                            make_spare_model(data, 'AD', 'rbf'), dirname)
+    # Changed arrays are rejected unless checksums are not verified
+    path = str(tmp_path / 'spare.spare' / 'AD_0_dual_coef.npy')
+    a = np.load(path)
+    a[0, 0] += 1.
+    np.save(path, a)
+    with pytest.raises(ValueError):
+        DataIO().ReadSPAREModel(dirname)
+    DataIO().ReadSPAREModel(dirname, verify=False)